@@ -1,15 +1,29 @@
 import os
 import uuid
 from datetime import datetime
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, Response, request, jsonify, send_file, stream_with_context
 from flask_cors import CORS
 import pymongo
 from pymongo import MongoClient
-import requests
 import json
+import base64
+import threading
+
+from renditions import ensure_rendition, generate_renditions, remove_renditions, mimetype as rendition_mimetype
+from indexes import ensure_indexes, verify_query_plans
+from search import build_highlights, parse_query, search_fields
+from http_cache import LRUCache, cache_immutable, cache_revalidate, diagram_etag, document_etag
+from engine_client import TeeUpload, file_chunks, post_document, post_reprocess
+from jobs import JobQueue, QueueFullError, serialize_job, JOB_QUEUED, JOB_RUNNING, JOB_DONE, JOB_FAILED
+from blobs import BlobCollector, BlobStore
+from batches import BatchIngestor, count_members, is_archive, iter_batch_entries, serialize_batch
+import exporters
+import metrics
+from metrics import stage
 
 app = Flask(__name__)
 CORS(app)
+metrics.init_app(app)
 
 # Configuration
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
@@ -22,6 +36,16 @@ client = MongoClient('mongodb://db:27017/')
 db = client['ocr_app']
 documents_collection = db['documents']
 settings_collection = db['settings']
+jobs_collection = db['jobs']
+diagrams_collection = db['diagrams']
+batches_collection = db['batches']
+batch_files_collection = db['batch_files']
+leases_collection = db['leases']
+
+# Create the indexes hot queries depend on, and refuse to start if any of them would scan
+ensure_indexes(db)
+if os.environ.get('VERIFY_QUERY_PLANS', 'true').lower() == 'true':
+    verify_query_plans(db)
 
 # Initialize default settings if not exists
 if settings_collection.count_documents({}) == 0:
@@ -39,6 +63,336 @@ if settings_collection.count_documents({}) == 0:
 # OCR Engine service URL
 OCR_ENGINE_URL = os.environ.get('OCR_ENGINE_URL', 'http://ocr-engine:6000')
 
+# OCR job queue and overload protection
+OCR_JOB_WORKERS = int(os.environ.get('OCR_JOB_WORKERS', '2'))
+OCR_JOB_MAX_QUEUE_DEPTH = int(os.environ.get('OCR_JOB_MAX_QUEUE_DEPTH', '100'))
+OCR_JOB_LEASE_SECONDS = int(os.environ.get('OCR_JOB_LEASE_SECONDS', '600'))
+MAX_INFLIGHT_OCR = int(os.environ.get('MAX_INFLIGHT_OCR', '4'))
+OVERLOAD_RETRY_AFTER = int(os.environ.get('OVERLOAD_RETRY_AFTER', '5'))
+
+# Batch ingestion (POST /api/ocr/batch)
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))
+BATCH_INSERT_SIZE = int(os.environ.get('BATCH_INSERT_SIZE', '50'))
+BATCH_MAX_FILE_BYTES = int(os.environ.get('BATCH_MAX_FILE_BYTES', str(50 * 1024 * 1024)))
+BATCH_STALE_SECONDS = int(os.environ.get('BATCH_STALE_SECONDS', '900'))
+BATCH_FILES_PAGE_SIZE = int(os.environ.get('BATCH_FILES_PAGE_SIZE', '200'))
+BATCH_FILES_MAX_PAGE_SIZE = int(os.environ.get('BATCH_FILES_MAX_PAGE_SIZE', '1000'))
+
+# Store diagrams in their own collection instead of embedding them in documents
+NORMALIZE_DIAGRAMS = os.environ.get('NORMALIZE_DIAGRAMS', 'false').lower() == 'true'
+
+# Document listing pagination
+DOCUMENTS_PAGE_SIZE = int(os.environ.get('DOCUMENTS_PAGE_SIZE', '50'))
+DOCUMENTS_MAX_PAGE_SIZE = int(os.environ.get('DOCUMENTS_MAX_PAGE_SIZE', '200'))
+
+# Fields needed to render a gallery tile; text, tables and diagrams stay in the database
+LISTING_PROJECTION = {
+    '_id': 0,
+    'id': 1,
+    'filename': 1,
+    'thumbnailUrl': 1,
+    'hasTable': 1,
+    'hasDiagram': 1,
+    'createdAt': 1,
+    'metadata.confidence': 1
+}
+
+# Fields needed to re-run OCR on a stored document
+REPROCESS_PROJECTION = {'_id': 0, 'id': 1, 'filename': 1, 'upload': 1, 'version': 1, 'contentHash': 1, 'ocrOptions': 1}
+
+# Full-text search pagination and the fields needed to build result snippets
+SEARCH_PAGE_SIZE = int(os.environ.get('SEARCH_PAGE_SIZE', '20'))
+SEARCH_MAX_PAGE_SIZE = int(os.environ.get('SEARCH_MAX_PAGE_SIZE', '100'))
+SEARCH_PROJECTION = {
+    '_id': 0,
+    'id': 1,
+    'filename': 1,
+    'thumbnailUrl': 1,
+    'createdAt': 1,
+    'text': 1,
+    'pages.pageNumber': 1,
+    'pages.text': 1,
+    'tables.rows': 1,
+    'tables.bbox': 1,
+    'tables.page': 1
+}
+
+# Fields needed to locate a document's upload
+UPLOAD_PROJECTION = {'_id': 0, 'id': 1, 'filename': 1, 'upload': 1, 'uploadReleasedAt': 1}
+
+# Per-process LRU of upload references and rendered diagrams. Upload references
+# change only when uploads are migrated or released, which document_upload() detects.
+METADATA_CACHE_SIZE = int(os.environ.get('METADATA_CACHE_SIZE', '10000'))
+document_files = LRUCache(METADATA_CACHE_SIZE)
+rendered_diagrams = LRUCache(METADATA_CACHE_SIZE)
+
+# Generated exports, keyed on document id + content version + format
+EXPORT_CACHE_FOLDER = os.path.join(PROCESSED_FOLDER, 'exports')
+EXPORT_CACHE_MAX_BYTES = int(os.environ.get('EXPORT_CACHE_MAX_BYTES', str(512 * 1024 * 1024)))
+os.makedirs(EXPORT_CACHE_FOLDER, exist_ok=True)
+
+# Uploads are stored once per distinct content, sharded by SHA-256 (see blobs.py)
+UPLOAD_STORE_FOLDER = os.environ.get('UPLOAD_STORE_FOLDER', os.path.join(UPLOAD_FOLDER, 'blobs'))
+UPLOAD_GC_INTERVAL = int(os.environ.get('UPLOAD_GC_INTERVAL', '3600'))
+UPLOAD_GC_GRACE_SECONDS = int(os.environ.get('UPLOAD_GC_GRACE_SECONDS', str(24 * 3600)))
+UPLOAD_RETENTION_DAYS = int(os.environ.get('UPLOAD_RETENTION_DAYS', '0'))
+UPLOAD_QUOTA_BYTES = int(os.environ.get('UPLOAD_QUOTA_BYTES', '0'))
+blob_store = BlobStore(UPLOAD_STORE_FOLDER)
+
+class OCREngineError(Exception):
+    """Raised when the OCR engine rejects or fails to process a document"""
+
+
+def legacy_upload_path(document_id, filename):
+    """Location of an upload in the flat layout used before uploads were content-addressed"""
+    return os.path.join(UPLOAD_FOLDER, f"{document_id}_{filename}")
+
+
+def document_upload_path(document):
+    """Location of a document's original upload, or None when it is no longer stored"""
+    if document.get('upload'):
+        path = blob_store.path(document['upload']['sha256'])
+    elif 'uploadReleasedAt' in document:
+        return None
+    else:
+        # Not moved into the blob store yet (flask migrate-uploads)
+        path = legacy_upload_path(document['id'], document['filename'])
+    return path if os.path.exists(path) else None
+
+
+def parse_ocr_options(form):
+    """Read the OCR option flags from a submitted form"""
+    return {
+        'detectTables': form.get('detectTables', 'true').lower() == 'true',
+        'detectHandwriting': form.get('detectHandwriting', 'true').lower() == 'true',
+        'multiLanguage': form.get('multiLanguage', 'false').lower() == 'true',
+        'preserveFormatting': form.get('preserveFormatting', 'true').lower() == 'true',
+        'detectDiagrams': form.get('detectDiagrams', 'true').lower() == 'true'  # Added for Mermaid.js
+    }
+
+
+def run_ocr(document_id, filename, upload, options, tee=None):
+    """Send an upload to the OCR engine and save the resulting document
+
+    upload is the reference ({'sha256', 'size'}) of a file in the blob store,
+    which is streamed from disk. A new upload is passed as tee instead: a
+    TeeUpload still writing it to the store, whose reference is only known once
+    the engine has read all of it.
+    """
+    document_data, diagrams = ocr_document(document_id, filename, upload, options, tee)
+    with stage('db_insert'):
+        documents_collection.insert_one(document_data)
+    store_document_extras([(document_data, diagrams)])
+    return document_data
+
+
+def ocr_document(document_id, filename, upload, options, tee=None):
+    """Send an upload to the OCR engine and build the document record without saving it
+
+    Returns the record and the document's diagrams (which are not embedded in
+    the record when diagrams are normalized).
+    """
+    chunks = tee if tee is not None else blob_store.chunks(upload['sha256'])
+    try:
+        with stage('engine'):
+            response = post_document(f"{OCR_ENGINE_URL}/process", filename, chunks, options)
+    finally:
+        if tee is not None:
+            upload = tee.finish()
+    metrics.add_remote_timing('engine', response.headers.get('Server-Timing'))
+
+    if response.status_code != 200:
+        raise OCREngineError('OCR processing failed')
+
+    ocr_result = response.json()
+    return document_record(document_id, filename, ocr_result, options, upload), ocr_result.get('diagrams', [])
+
+
+def document_record(document_id, filename, ocr_result, options, upload):
+    """Build a new document from an OCR engine result and the reference to its upload"""
+    return {
+        'id': document_id,
+        'filename': filename,
+        'upload': upload,
+        **ocr_fields(ocr_result, options),
+        'imageUrl': f"/api/documents/{document_id}/image",
+        'thumbnailUrl': f"/api/documents/{document_id}/thumbnail",
+        'previewUrl': f"/api/documents/{document_id}/preview",
+        'createdAt': datetime.now(),
+        'version': 1  # Bumped whenever the OCR output or upload changes; invalidates cached exports
+    }
+
+
+def ocr_fields(ocr_result, options):
+    """Document fields derived from an OCR engine result"""
+    diagrams = ocr_result.get('diagrams', [])
+    return {
+        'text': ocr_result.get('text', ''),
+        'tables': ocr_result.get('tables', []),
+        'diagrams': [] if NORMALIZE_DIAGRAMS else diagrams,  # Added for Mermaid.js
+        'diagramsNormalized': NORMALIZE_DIAGRAMS,
+        'hasDiagram': len(diagrams) > 0,  # Added for Mermaid.js
+        'hasTable': len(ocr_result.get('tables', [])) > 0,
+        'pages': ocr_result.get('pages', []),
+        'search': search_fields(ocr_result.get('tables', []), diagrams),
+        'metadata': {
+            'pageCount': ocr_result.get('pageCount', 1),
+            'languages': ocr_result.get('languages', ['eng']),
+            'confidence': ocr_result.get('confidence', 0)
+        },
+        # Lets the engine re-process the document from its stored artifacts
+        'contentHash': ocr_result.get('contentHash'),
+        'ocrOptions': options
+    }
+
+
+def reprocess_options(document, form):
+    """OCR options for re-processing: the form's flags over the ones the document was processed with"""
+    options = dict(document.get('ocrOptions') or parse_ocr_options({}))
+    options.update((name, value) for name, value in parse_ocr_options(form).items() if name in form)
+    return options
+
+
+def reprocess_ocr(document, options):
+    """OCR a stored document again and return (engine result, whether artifacts were reused)
+
+    The engine reruns only out-of-date stages when it still holds the document's
+    artifacts; otherwise the original upload is sent again.
+    """
+    if document.get('contentHash'):
+        with stage('engine'):
+            response = post_reprocess(f"{OCR_ENGINE_URL}/reprocess", document['contentHash'], options)
+        metrics.add_remote_timing('engine', response.headers.get('Server-Timing'))
+        if response.status_code == 200:
+            return response.json(), True
+        # 404: artifacts disabled or evicted; 409: stored threshold image is out of date
+        if response.status_code not in (404, 409):
+            raise OCREngineError('OCR processing failed')
+
+    file_path = document_upload_path(document)
+    if file_path is None:
+        raise FileNotFoundError('Original upload not found')
+    with stage('engine'):
+        response = post_document(f"{OCR_ENGINE_URL}/process", document['filename'], file_chunks(file_path), options)
+    metrics.add_remote_timing('engine', response.headers.get('Server-Timing'))
+    if response.status_code != 200:
+        raise OCREngineError('OCR processing failed')
+    return response.json(), False
+
+
+def store_document_extras(entries):
+    """Write normalized diagrams and renditions for (document, diagrams) entries"""
+    if NORMALIZE_DIAGRAMS:
+        records = [record for document, diagrams in entries
+                   for record in normalized_diagrams(document['id'], diagrams)]
+        if records:
+            with stage('db_insert'):
+                diagrams_collection.insert_many(records)
+
+    # Generate thumbnails up front; failures are retried on first request
+    for document, _ in entries:
+        try:
+            with stage('renditions'):
+                generate_renditions(blob_store.path(document['upload']['sha256']))
+        except Exception:
+            pass
+
+
+def store_documents(entries):
+    """Bulk-save (document, diagrams) entries produced by ocr_document"""
+    try:
+        with stage('db_insert'):
+            documents_collection.insert_many([document for document, _ in entries], ordered=False)
+    except pymongo.errors.BulkWriteError as e:
+        # Unordered inserts: every entry not reported was written and still needs its extras
+        failed = {error['index'] for error in e.details.get('writeErrors', [])}
+        store_document_extras([entry for index, entry in enumerate(entries) if index not in failed])
+        raise
+    store_document_extras(entries)
+
+
+def normalized_diagrams(document_id, diagrams):
+    """Diagram records for the diagrams collection, in document order"""
+    return [dict(diagram, documentId=document_id, position=position)
+            for position, diagram in enumerate(diagrams)]
+
+
+def process_ocr_job(payload):
+    """Job queue handler: OCR a previously stored upload"""
+    upload = payload.get('upload')
+    if upload is None:
+        # Queued before uploads were content-addressed
+        upload = blob_store.put_file(payload['filePath'], move=True)
+    run_ocr(payload['documentId'], payload['filename'], upload, payload['options'])
+    return {'documentId': payload['documentId']}
+
+
+# Background OCR job queue (POST /api/ocr with async=true)
+job_queue = JobQueue(
+    jobs_collection,
+    process_ocr_job,
+    workers=OCR_JOB_WORKERS,
+    max_depth=OCR_JOB_MAX_QUEUE_DEPTH,
+    lease_seconds=OCR_JOB_LEASE_SECONDS
+)
+job_queue.ensure_indexes()
+job_queue.start()
+
+def ocr_batch_file(document_id, filename, upload, options):
+    """Batch handler: OCR one extracted file and return the entry to bulk-save"""
+    return ocr_document(document_id, filename, upload, options)
+
+
+# Archive and multi-file ingestion; engine calls are shared across all running batches
+batch_ingestor = BatchIngestor(
+    batches_collection,
+    batch_files_collection,
+    ocr_batch_file,
+    store_documents,
+    concurrency=BATCH_CONCURRENCY,
+    insert_batch_size=BATCH_INSERT_SIZE,
+    stale_seconds=BATCH_STALE_SECONDS
+)
+batch_ingestor.ensure_indexes()
+# Batches run in the process that received them; fail those whose process has since died
+batch_ingestor.fail_interrupted()
+
+# Bounds the number of synchronous OCR requests a process holds open against the engine
+inflight_ocr = threading.BoundedSemaphore(MAX_INFLIGHT_OCR)
+
+
+def pending_job_uploads():
+    """Uploads of queued and running jobs, which no document references yet"""
+    jobs = jobs_collection.find({'status': {'$in': [JOB_QUEUED, JOB_RUNNING]}}, {'_id': 0, 'payload.upload': 1})
+    return {job['payload']['upload']['sha256'] for job in jobs if job.get('payload', {}).get('upload')}
+
+
+def evict_exports():
+    exporters.evict_exports(EXPORT_CACHE_FOLDER, EXPORT_CACHE_MAX_BYTES)
+
+
+# Garbage collection of unreferenced, expired and over-quota uploads; one process collects at a time
+upload_collector = BlobCollector(
+    blob_store,
+    documents_collection,
+    leases_collection,
+    interval=UPLOAD_GC_INTERVAL,
+    grace_seconds=UPLOAD_GC_GRACE_SECONDS,
+    retention_days=UPLOAD_RETENTION_DAYS,
+    quota_bytes=UPLOAD_QUOTA_BYTES,
+    pinned=pending_job_uploads,
+    after_pass=evict_exports
+)
+upload_collector.start()
+
+
+def overloaded(message):
+    response = jsonify({'error': message})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(OVERLOAD_RETRY_AFTER)
+    return response
+
+
 @app.route('/api/ocr', methods=['POST'])
 def process_document():
     if 'file' not in request.files:
@@ -49,56 +403,42 @@ def process_document():
         return jsonify({'error': 'No selected file'}), 400
     
     # Get OCR options from request
-    options = {
-        'detectTables': request.form.get('detectTables', 'true').lower() == 'true',
-        'detectHandwriting': request.form.get('detectHandwriting', 'true').lower() == 'true',
-        'multiLanguage': request.form.get('multiLanguage', 'false').lower() == 'true',
-        'preserveFormatting': request.form.get('preserveFormatting', 'true').lower() == 'true',
-        'detectDiagrams': request.form.get('detectDiagrams', 'true').lower() == 'true'  # Added for Mermaid.js
-    }
+    options = parse_ocr_options(request.form)
+    job_mode = request.values.get('async', 'false').lower() == 'true'
     
     # Generate unique document ID
     document_id = str(uuid.uuid4())
     
-    # Save uploaded file
     filename = file.filename
-    file_path = os.path.join(UPLOAD_FOLDER, f"{document_id}_{filename}")
-    file.save(file_path)
     
-    # Send to OCR Engine
-    try:
-        files = {'file': open(file_path, 'rb')}
-        response = requests.post(
-            f"{OCR_ENGINE_URL}/process",
-            files=files,
-            data=options
-        )
-        
-        if response.status_code != 200:
-            return jsonify({'error': 'OCR processing failed'}), 500
-        
-        ocr_result = response.json()
-        
-        # Save to database
-        document_data = {
-            'id': document_id,
-            'filename': filename,
-            'text': ocr_result.get('text', ''),
-            'tables': ocr_result.get('tables', []),
-            'diagrams': ocr_result.get('diagrams', []),  # Added for Mermaid.js
-            'hasDiagram': len(ocr_result.get('diagrams', [])) > 0,  # Added for Mermaid.js
-            'hasTable': len(ocr_result.get('tables', [])) > 0,
-            'imageUrl': f"/api/documents/{document_id}/image",
-            'thumbnailUrl': f"/api/documents/{document_id}/thumbnail",
-            'createdAt': datetime.now(),
-            'metadata': {
-                'pageCount': ocr_result.get('pageCount', 1),
-                'languages': ocr_result.get('languages', ['eng']),
-                'confidence': ocr_result.get('confidence', 0)
-            }
-        }
+    if job_mode:
+        # Save uploaded file for a worker to pick up later
+        upload = blob_store.put(file.stream)
+        try:
+            job_id = job_queue.enqueue({
+                'documentId': document_id,
+                'filename': filename,
+                'upload': upload,
+                'options': options
+            })
+        except QueueFullError as e:
+            # Left for the garbage collector: another document may share the blob
+            return overloaded(str(e))
         
-        documents_collection.insert_one(document_data)
+        return jsonify({
+            'success': True,
+            'jobId': job_id,
+            'documentId': document_id,
+            'status': JOB_QUEUED,
+            'statusUrl': f"/api/jobs/{job_id}"
+        }), 202
+    
+    if not inflight_ocr.acquire(blocking=False):
+        return overloaded('Too many OCR requests in progress')
+    
+    # Stream to the OCR Engine while saving the uploaded file
+    try:
+        run_ocr(document_id, filename, None, options, tee=TeeUpload(file.stream, blob_store.writer()))
         
         return jsonify({
             'success': True,
@@ -107,72 +447,392 @@ def process_document():
     
     except Exception as e:
         return jsonify({'error': str(e)}), 500
+    
+    finally:
+        inflight_ocr.release()
+
+@app.route('/api/ocr/batch', methods=['POST'])
+def process_batch():
+    """Ingest a ZIP/TAR archive or a multipart set of files in the background"""
+    files = [f for f in request.files.getlist('files') + request.files.getlist('archive') if f.filename]
+    if not files:
+        return jsonify({'error': 'No files or archive uploaded'}), 400
+    
+    options = parse_ocr_options(request.form)
+    
+    # Keep the uploads; archives are expanded member by member by the batch worker
+    sources = []
+    for file in files:
+        document_id = str(uuid.uuid4())
+        sources.append((file.filename, document_id, blob_store.put(file.stream)))
+    
+    paths = [blob_store.path(upload['sha256']) for _, _, upload in sources]
+    counts = [count_members(path) if is_archive(path) else 1 for path in paths]
+    total = None if None in counts else sum(counts)
+    
+    batch_id = batch_ingestor.create(total)
+    batch_ingestor.start(batch_id, iter_batch_entries(sources, blob_store, BATCH_MAX_FILE_BYTES), options)
+    
+    return jsonify({
+        'success': True,
+        'batchId': batch_id,
+        'total': total,
+        'statusUrl': f"/api/batches/{batch_id}"
+    }), 202
+
+@app.route('/api/batches/<batch_id>', methods=['GET'])
+def get_batch(batch_id):
+    batch = batch_ingestor.get(batch_id)
+    if not batch:
+        return jsonify({'error': 'Batch not found'}), 404
+    
+    # File outcomes are paged by position; the cursor is the position of the last file returned
+    try:
+        limit = min(int(request.args.get('limit', BATCH_FILES_PAGE_SIZE)), BATCH_FILES_MAX_PAGE_SIZE)
+        after = int(request.args.get('cursor', -1))
+        if limit < 1:
+            raise ValueError('limit must be positive')
+    except ValueError:
+        return jsonify({'error': 'limit and cursor must be integers'}), 400
+    
+    # One extra file tells whether there is another page
+    if 'files' in batch:
+        # Manifests written before file outcomes moved to their own collection
+        files = [dict(file, position=position) for position, file in enumerate(batch.pop('files'))]
+        files = files[after + 1:after + 2 + limit]
+    else:
+        files = batch_ingestor.files(batch_id, after, limit + 1)
+    
+    next_cursor = str(files[limit - 1]['position']) if len(files) > limit else None
+    files = files[:limit]
+    for file in files:
+        file.pop('position')
+    return jsonify(serialize_batch(batch, files, next_cursor))
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return jsonify(serialize_job(job))
+
+@app.route('/api/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = job_queue.get(job_id)
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    if job['status'] == JOB_FAILED:
+        return jsonify(serialize_job(job)), 500
+    
+    if job['status'] != JOB_DONE:
+        # Not finished yet: report the current status so clients can keep polling
+        return jsonify(serialize_job(job)), 202
+    
+    return get_document(job['result']['documentId'])
 
 @app.route('/api/documents', methods=['GET'])
 def get_documents():
-    documents = list(documents_collection.find({}, {'_id': 0}).sort('createdAt', pymongo.DESCENDING))
-    # Convert datetime objects to strings for JSON serialization
-    for doc in documents:
-        doc['createdAt'] = doc['createdAt'].isoformat()
-    return jsonify(documents)
+    """List documents newest first, one cursor-delimited page at a time"""
+    try:
+        limit = min(int(request.args.get('limit', DOCUMENTS_PAGE_SIZE)), DOCUMENTS_MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        query = build_listing_query(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    # Fetch one extra document to know whether another page follows
+    cursor = documents_collection.find(query, LISTING_PROJECTION) \
+        .sort([('createdAt', pymongo.DESCENDING), ('id', pymongo.DESCENDING)]) \
+        .limit(limit + 1)
+    
+    def generate():
+        # Serialize documents as they come off the cursor instead of building one big list
+        yield '{"documents": ['
+        last = None
+        for count, doc in enumerate(cursor):
+            if count == limit:
+                break
+            if last is not None:
+                yield ','
+            last = doc
+            yield json.dumps(serialize_listing(doc))
+        else:
+            last = None  # Cursor exhausted: there is no next page
+        
+        next_cursor = encode_listing_cursor(last) if last is not None else None
+        yield f'], "nextCursor": {json.dumps(next_cursor)}}}'
+    
+    return Response(stream_with_context(generate()), mimetype='application/json')
+
+def build_listing_query(args):
+    """Translate listing filters and the page cursor into a MongoDB query"""
+    query = {}
+    for flag in ('hasTable', 'hasDiagram'):
+        if flag in args:
+            query[flag] = args[flag].lower() == 'true'
+    
+    created = {}
+    if 'createdFrom' in args:
+        created['$gte'] = datetime.fromisoformat(args['createdFrom'])
+    if 'createdTo' in args:
+        created['$lte'] = datetime.fromisoformat(args['createdTo'])
+    if created:
+        query['createdAt'] = created
+    
+    if args.get('cursor'):
+        created_at, document_id = decode_listing_cursor(args['cursor'])
+        # Keyset pagination on (createdAt, id), matching the sort order
+        query = {'$and': [query, {'$or': [
+            {'createdAt': {'$lt': created_at}},
+            {'createdAt': created_at, 'id': {'$lt': document_id}}
+        ]}]}
+    
+    return query
+
+def encode_listing_cursor(doc):
+    raw = json.dumps([doc['createdAt'].isoformat(), doc['id']])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_listing_cursor(value):
+    try:
+        created_at, document_id = json.loads(base64.urlsafe_b64decode(value.encode('ascii')))
+        return datetime.fromisoformat(created_at), document_id
+    except (ValueError, TypeError):
+        raise ValueError('Invalid cursor')
+
+def serialize_listing(doc):
+    return {
+        'id': doc['id'],
+        'filename': doc['filename'],
+        'thumbnailUrl': doc.get('thumbnailUrl'),
+        'hasTable': doc.get('hasTable', False),
+        'hasDiagram': doc.get('hasDiagram', False),
+        'createdAt': doc['createdAt'].isoformat(),
+        'confidence': doc.get('metadata', {}).get('confidence', 0)
+    }
 
 @app.route('/api/documents/<document_id>', methods=['GET'])
 def get_document(document_id):
-    document = documents_collection.find_one({'id': document_id}, {'_id': 0})
+    # Documents only change when reprocessed or their upload is moved or released, which bumps
+    # their version: check it before loading the rest
+    meta = documents_collection.find_one({'id': document_id}, {'_id': 0, 'version': 1})
+    if not meta:
+        return jsonify({'error': 'Document not found'}), 404
+    
+    etag = document_etag(document_id, meta.get('version', 1))
+    if request.if_none_match.contains(etag):
+        return cache_revalidate(not_modified(etag), etag)
+    
+    document = documents_collection.find_one({'id': document_id}, {'_id': 0, 'search': 0})
     if not document:
         return jsonify({'error': 'Document not found'}), 404
     
+    if document.get('diagramsNormalized'):
+        document['diagrams'] = load_document_diagrams(document_id)
+    document.pop('diagramsNormalized', None)
+    
     # Convert datetime objects to strings for JSON serialization
     document['createdAt'] = document['createdAt'].isoformat()
-    return jsonify(document)
+    return cache_revalidate(jsonify(document), document_etag(document_id, document.get('version', 1)))
 
-@app.route('/api/documents/<document_id>/image', methods=['GET'])
-def get_document_image(document_id):
-    document = documents_collection.find_one({'id': document_id})
+def not_modified(etag):
+    """Empty 304 for a client whose cached copy matches etag"""
+    response = app.response_class(status=304)
+    response.set_etag(etag)
+    return response
+
+def document_upload(document_id):
+    """(upload fields, upload path) of a document; (None, None) when it does not exist
+
+    The upload fields come from the metadata LRU, but a cached entry whose file
+    is missing is read again: the upload may since have been moved into the
+    blob store (migrate-uploads) or released by the garbage collector.
+    """
+    document = document_files.get(document_id)
+    if document is not None:
+        file_path = document_upload_path(document)
+        if file_path is not None:
+            return document, file_path
+    document = documents_collection.find_one({'id': document_id}, UPLOAD_PROJECTION)
+    if not document:
+        return None, None
+    document_files.put(document_id, document)
+    return document, document_upload_path(document)
+
+def load_document_diagrams(document_id):
+    """Diagrams of a document stored in the normalized diagrams collection"""
+    return list(diagrams_collection.find(
+        {'documentId': document_id},
+        {'_id': 0, 'documentId': 0, 'position': 0}
+    ).sort('position', pymongo.ASCENDING))
+
+@app.route('/api/documents/<document_id>/reprocess', methods=['POST'])
+def reprocess_document(document_id):
+    """Re-run OCR on a stored document, e.g. after turning on table or diagram detection"""
+    document = documents_collection.find_one({'id': document_id}, REPROCESS_PROJECTION)
     if not document:
         return jsonify({'error': 'Document not found'}), 404
     
-    # Find the original image file
-    filename = document['filename']
-    file_path = os.path.join(UPLOAD_FOLDER, f"{document_id}_{filename}")
+    options = reprocess_options(document, request.form)
+    
+    if not inflight_ocr.acquire(blocking=False):
+        return overloaded('Too many OCR requests in progress')
     
-    if os.path.exists(file_path):
-        return send_file(file_path)
+    try:
+        ocr_result, incremental = reprocess_ocr(document, options)
+        diagrams = ocr_result.get('diagrams', [])
+        
+        # A new version invalidates exports cached for the old OCR output
+        version = document.get('version', 1) + 1
+        with stage('db_insert'):
+            documents_collection.update_one(
+                {'id': document_id},
+                {'$set': dict(ocr_fields(ocr_result, options), version=version)}
+            )
+            diagrams_collection.delete_many({'documentId': document_id})
+            if NORMALIZE_DIAGRAMS and diagrams:
+                diagrams_collection.insert_many(normalized_diagrams(document_id, diagrams))
+        
+        return jsonify({
+            'success': True,
+            'documentId': document_id,
+            'version': version,
+            'incremental': incremental
+        })
+    
+    except FileNotFoundError as e:
+        return jsonify({'error': str(e)}), 404
+    
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    finally:
+        inflight_ocr.release()
+
+@app.route('/api/search', methods=['GET'])
+def search_documents():
+    """Ranked full-text search over document text, table cells and diagram labels"""
+    query = request.args.get('q', '').strip()
+    if not query:
+        return jsonify({'error': 'Missing search query'}), 400
+    
+    try:
+        limit = min(int(request.args.get('limit', SEARCH_PAGE_SIZE)), SEARCH_MAX_PAGE_SIZE)
+        page = int(request.args.get('page', 1))
+        if limit < 1 or page < 1:
+            raise ValueError
+    except ValueError:
+        return jsonify({'error': 'page and limit must be positive integers'}), 400
+    
+    terms, phrases = parse_query(query)
+    
+    # Quoted phrases in the query are matched as phrases by the text index itself
+    cursor = documents_collection.find(
+        {'$text': {'$search': query}},
+        dict(SEARCH_PROJECTION, score={'$meta': 'textScore'})
+    ).sort([('score', {'$meta': 'textScore'})]).skip((page - 1) * limit).limit(limit + 1)
+    
+    results = []
+    with stage('search'):
+        for document in cursor:
+            if len(results) == limit:
+                break
+            results.append({
+                'id': document['id'],
+                'filename': document['filename'],
+                'thumbnailUrl': document.get('thumbnailUrl'),
+                'createdAt': document['createdAt'].isoformat(),
+                'score': document['score'],
+                'highlights': build_highlights(document, terms, phrases)
+            })
+        else:
+            document = None
+    
+    return jsonify({
+        'query': query,
+        'page': page,
+        'results': results,
+        'hasMore': document is not None
+    })
+
+@app.route('/api/documents/<document_id>/image', methods=['GET'])
+def get_document_image(document_id):
+    document, file_path = document_upload(document_id)
+    if document is None:
+        return jsonify({'error': 'Document not found'}), 404
+    
+    if file_path is not None:
+        # Uploads never change; send_file answers If-None-Match with 304 and Range with 206
+        return cache_immutable(send_file(file_path, conditional=True))
     else:
         return jsonify({'error': 'Image file not found'}), 404
 
 @app.route('/api/documents/<document_id>/thumbnail', methods=['GET'])
 def get_document_thumbnail(document_id):
-    document = documents_collection.find_one({'id': document_id})
-    if not document:
+    return send_rendition(document_id, 'thumbnail')
+
+@app.route('/api/documents/<document_id>/preview', methods=['GET'])
+def get_document_preview(document_id):
+    return send_rendition(document_id, 'preview')
+
+def send_rendition(document_id, name):
+    """Serve a thumbnail/preview rendition, preferring WebP when the client accepts it"""
+    document, file_path = document_upload(document_id)
+    if document is None:
         return jsonify({'error': 'Document not found'}), 404
     
-    # For simplicity, we're returning the original image as thumbnail
-    # In a production environment, you would generate and store actual thumbnails
-    filename = document['filename']
-    file_path = os.path.join(UPLOAD_FOLDER, f"{document_id}_{filename}")
+    if file_path is None:
+        return jsonify({'error': f'{name.capitalize()} not found'}), 404
     
-    if os.path.exists(file_path):
-        return send_file(file_path)
-    else:
-        return jsonify({'error': 'Thumbnail not found'}), 404
+    fmt = 'webp' if request.accept_mimetypes['image/webp'] else 'jpeg'
+    try:
+        rendition = ensure_rendition(file_path, name, fmt)
+    except Exception as e:
+        return jsonify({'error': f'Could not render {name}: {e}'}), 500
+    
+    # Renditions never change once written, so clients may cache them indefinitely
+    response = cache_immutable(send_file(rendition, mimetype=rendition_mimetype(fmt), conditional=True))
+    response.vary.add('Accept')
+    return response
 
 @app.route('/api/documents/<document_id>/export', methods=['GET'])
 def export_document(document_id):
-    format = request.args.get('format', 'PDF')
-    document = documents_collection.find_one({'id': document_id})
-    if not document:
-        return jsonify({'error': 'Document not found'}), 404
+    fmt = exporters.normalize_format(request.args.get('format', 'PDF'))
+    if fmt is None:
+        return jsonify({'error': f"Unsupported export format, expected one of: {', '.join(exporters.EXPORT_FORMATS)}"}), 400
     
-    # For the demo, we'll just return a simple text file with the OCR'd text
-    # In a real application, you would generate proper PDF, DOCX, etc.
-    text_content = document.get('text', '')
+    meta = documents_collection.find_one({'id': document_id}, {'_id': 0, 'id': 1, 'filename': 1, 'version': 1})
+    if not meta:
+        return jsonify({'error': 'Document not found'}), 404
     
-    temp_file_path = os.path.join(PROCESSED_FOLDER, f"{document_id}_export.txt")
-    with open(temp_file_path, 'w') as f:
-        f.write(text_content)
+    cache_path = exporters.export_path(EXPORT_CACHE_FOLDER, document_id, meta.get('version', 1), fmt)
+    if os.path.exists(cache_path):
+        # Mark as recently used for eviction
+        os.utime(cache_path)
+    else:
+        document = documents_collection.find_one({'id': document_id}, {'_id': 0, 'search': 0})
+        if not document:
+            # Deleted since the metadata was read
+            return jsonify({'error': 'Document not found'}), 404
+        if document.get('diagramsNormalized'):
+            document['diagrams'] = load_document_diagrams(document_id)
+        try:
+            with stage('export'):
+                exporters.write_export(document, fmt, cache_path, document_upload_path(document))
+        except Exception as e:
+            return jsonify({'error': f'Export failed: {e}'}), 500
+        exporters.evict_exports(EXPORT_CACHE_FOLDER, EXPORT_CACHE_MAX_BYTES, keep=cache_path)
     
-    return send_file(temp_file_path, as_attachment=True, download_name=f"{document['filename'].split('.')[0]}.txt")
+    # send_file streams the cached file in chunks instead of loading it into memory
+    return send_file(
+        cache_path,
+        mimetype=exporters.mimetype(fmt),
+        as_attachment=True,
+        download_name=f"{os.path.splitext(meta['filename'])[0]}.{exporters.extension(fmt)}"
+    )
 
 @app.route('/api/settings', methods=['GET'])
 def get_settings():
@@ -188,18 +848,112 @@ def update_settings():
 # Endpoint for diagram processing with Mermaid.js
 @app.route('/api/diagrams/<diagram_id>/render', methods=['GET'])
 def render_diagram(diagram_id):
-    document = documents_collection.find_one({'diagrams.id': diagram_id}, {'_id': 0})
-    if not document:
-        return jsonify({'error': 'Diagram not found'}), 404
+    # Reprocessing gives diagrams new IDs, so a diagram ID always names the same content
+    etag = diagram_etag(diagram_id)
+    if request.if_none_match.contains(etag):
+        return cache_immutable(not_modified(etag))
     
-    for diagram in document.get('diagrams', []):
-        if diagram.get('id') == diagram_id:
-            return jsonify({
-                'mermaidCode': diagram.get('mermaidCode', ''),
-                'type': diagram.get('type', 'flowchart')
-            })
+    rendered = rendered_diagrams.get(diagram_id)
+    if rendered is None:
+        # Normalized diagrams are a direct point lookup on their own collection
+        diagram = diagrams_collection.find_one({'id': diagram_id}, {'_id': 0, 'mermaidCode': 1, 'type': 1})
+        
+        if not diagram:
+            # Fall back to diagrams embedded in documents, fetching only the matching element
+            document = documents_collection.find_one({'diagrams.id': diagram_id}, {'_id': 0, 'diagrams.$': 1})
+            if not document:
+                return jsonify({'error': 'Diagram not found'}), 404
+            diagram = document['diagrams'][0]
+        
+        rendered = {
+            'mermaidCode': diagram.get('mermaidCode', ''),
+            'type': diagram.get('type', 'flowchart')
+        }
+        rendered_diagrams.put(diagram_id, rendered)
     
-    return jsonify({'error': 'Diagram not found'}), 404
+    response = jsonify(rendered)
+    response.set_etag(etag)
+    return cache_immutable(response)
+
+@app.cli.command('backfill-renditions')
+def backfill_renditions():
+    """Generate missing thumbnails and previews for existing documents"""
+    created = failed = 0
+    for document in documents_collection.find({}, UPLOAD_PROJECTION):
+        file_path = document_upload_path(document)
+        if file_path is None:
+            continue
+        try:
+            created += len(generate_renditions(file_path))
+        except Exception as e:
+            failed += 1
+            print(f"{document['id']}: {e}")
+    print(f"Created {created} renditions ({failed} documents failed)")
+
+@app.cli.command('migrate-uploads')
+def migrate_uploads():
+    """Move uploads stored in the flat upload folder into the blob store"""
+    migrated = missing = 0
+    for document in documents_collection.find({'upload': {'$exists': False}, 'uploadReleasedAt': {'$exists': False}},
+                                              dict(UPLOAD_PROJECTION, version=1)):
+        file_path = legacy_upload_path(document['id'], document['filename'])
+        if not os.path.exists(file_path):
+            missing += 1
+            continue
+        upload = blob_store.put_file(file_path, move=True)
+        # A new version, so clients revalidate the document and its exports
+        documents_collection.update_one(
+            {'id': document['id']},
+            {'$set': {'upload': upload, 'version': document.get('version', 1) + 1}}
+        )
+        # Renditions are regenerated next to the blob on first request
+        remove_renditions(file_path)
+        migrated += 1
+    print(f"Migrated {migrated} uploads ({missing} documents had no upload on disk)")
+
+@app.cli.command('gc-uploads')
+def gc_uploads():
+    """Run one upload garbage collection pass now"""
+    stats = upload_collector.collect()
+    print(f"Released {stats['released']} uploads, deleted {stats['deleted']} blobs "
+          f"({stats['freedBytes']} bytes freed, {stats['storedBytes']} bytes stored)")
+
+@app.cli.command('migrate-diagrams')
+def migrate_diagrams():
+    """Move diagrams embedded in documents into the diagrams collection"""
+    migrated = 0
+    for document in documents_collection.find({'diagrams.0': {'$exists': True}}, {'_id': 0, 'id': 1, 'diagrams': 1}):
+        for record in normalized_diagrams(document['id'], document['diagrams']):
+            diagrams_collection.replace_one({'id': record['id']}, record, upsert=True)
+        documents_collection.update_one(
+            {'id': document['id']},
+            {'$set': {'diagrams': [], 'diagramsNormalized': True}}
+        )
+        migrated += 1
+    print(f"Migrated diagrams of {migrated} documents")
+
+@app.cli.command('reindex-search')
+def reindex_search():
+    """Build the derived search fields for documents stored before search existed"""
+    updated = 0
+    for document in documents_collection.find({'search': {'$exists': False}},
+                                              {'_id': 0, 'id': 1, 'tables': 1, 'diagrams': 1, 'diagramsNormalized': 1}):
+        diagrams = document.get('diagrams', [])
+        if document.get('diagramsNormalized'):
+            diagrams = load_document_diagrams(document['id'])
+        documents_collection.update_one(
+            {'id': document['id']},
+            {'$set': {'search': search_fields(document.get('tables', []), diagrams)}}
+        )
+        updated += 1
+    print(f"Indexed {updated} documents")
+
+@app.cli.command('verify-indexes')
+def verify_indexes():
+    """Create the API indexes and fail if a hot query would use a collection scan"""
+    ensure_indexes(db)
+    verify_query_plans(db)
+    print('All hot queries are served by indexes')
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
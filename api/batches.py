@@ -0,0 +1,306 @@
+"""
+Batch ingestion of archives and multi-file uploads.
+
+A batch is a set of uploaded files, where ZIP and TAR archives are expanded
+into their member files. Members are streamed out of the archive one at a time
+straight into the upload blob store, so an archive is never extracted as a
+whole. Files are OCR'd through a shared, bounded thread pool, finished
+documents are written with insert_many, and a manifest in the `batches`
+collection records progress. The outcome of every file is a separate record in
+the `batch_files` collection, so batches of any size stay far below MongoDB's
+document size limit.
+
+A running batch refreshes its heartbeat as files finish. Batches whose process
+died (no heartbeat for stale_seconds) are marked failed by fail_interrupted(),
+which runs when the API starts.
+"""
+
+import os
+import tarfile
+import threading
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import pymongo
+
+BATCH_QUEUED = 'queued'
+BATCH_RUNNING = 'running'
+BATCH_DONE = 'done'
+BATCH_FAILED = 'failed'
+
+FILE_DONE = 'done'
+FILE_FAILED = 'failed'
+
+COPY_BUFFER_SIZE = 64 * 1024
+
+# Seconds between heartbeat writes of a running batch
+HEARTBEAT_INTERVAL = 60
+
+# Archive members that are never documents
+IGNORED_PREFIXES = ('__MACOSX/',)
+
+
+class EntryTooLargeError(Exception):
+    """Raised when an archive member exceeds the per-file size limit"""
+
+
+def is_archive(path):
+    return zipfile.is_zipfile(path) or tarfile.is_tarfile(path)
+
+
+def _store_limited(src, store, max_bytes):
+    """Copy a file object into a blob store, refusing to write more than max_bytes; returns its reference"""
+    with store.writer() as dst:
+        while True:
+            chunk = src.read(COPY_BUFFER_SIZE)
+            if not chunk:
+                break
+            if dst.size + len(chunk) > max_bytes:
+                raise EntryTooLargeError(f"File exceeds the {max_bytes} byte limit")
+            dst.write(chunk)
+    return dst.reference()
+
+
+def _member_name(name):
+    """Document filename for an archive member, or None if the member should be skipped"""
+    if name.startswith(IGNORED_PREFIXES):
+        return None
+    base = os.path.basename(name.rstrip('/'))
+    # basename() also strips any ../ components from the document filename
+    if not base or base.startswith('.'):
+        return None
+    return base
+
+
+def _iter_members(archive_path):
+    """Yield (filename, file object) for each regular file in a ZIP or TAR archive"""
+    if zipfile.is_zipfile(archive_path):
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                name = None if info.is_dir() else _member_name(info.filename)
+                if name:
+                    with archive.open(info) as member:
+                        yield name, member
+    else:
+        # Stream mode reads the archive sequentially, one member at a time
+        with tarfile.open(archive_path, 'r|*') as archive:
+            for info in archive:
+                name = _member_name(info.name) if info.isfile() else None
+                if name:
+                    yield name, archive.extractfile(info)
+
+
+def count_members(archive_path):
+    """Number of document members in an archive, or None when it cannot be known up front"""
+    if not zipfile.is_zipfile(archive_path):
+        return None
+    try:
+        with zipfile.ZipFile(archive_path) as archive:
+            return sum(1 for info in archive.infolist() if not info.is_dir() and _member_name(info.filename))
+    except zipfile.BadZipFile:
+        return None
+
+
+def iter_batch_entries(sources, store, max_file_bytes):
+    """Yield (filename, document_id, upload, error) for every document in a batch
+
+    sources are (filename, document_id, upload) tuples for the uploaded files,
+    where upload is a reference into store. Archives are expanded lazily: each
+    member is copied into store only when the consumer asks for it. Archives
+    are never referenced by a document, so the store's garbage collector
+    removes them once the batch no longer needs them.
+    """
+    for filename, document_id, upload in sources:
+        stored_path = store.path(upload['sha256'])
+        if not is_archive(stored_path):
+            yield filename, document_id, upload, None
+            continue
+
+        try:
+            for name, member in _iter_members(stored_path):
+                member_id = str(uuid.uuid4())
+                try:
+                    member_upload = _store_limited(member, store, max_file_bytes)
+                except Exception as e:
+                    yield name, member_id, None, str(e)
+                    continue
+                yield name, member_id, member_upload, None
+        except (zipfile.BadZipFile, tarfile.TarError) as e:
+            yield filename, document_id, None, f"Could not read archive: {e}"
+
+
+class BatchIngestor:
+    """Runs batches in background threads, sharing one bounded pool of OCR workers
+
+    ocr_file(document_id, filename, upload, options) returns a stored entry (for example
+    a (document, diagrams) tuple) and store(entries) saves a list of them in bulk.
+    """
+
+    def __init__(self, collection, files_collection, ocr_file, store, concurrency=4, insert_batch_size=50,
+                 stale_seconds=900):
+        self.collection = collection
+        self.files_collection = files_collection
+        self.ocr_file = ocr_file
+        self.store = store
+        self.concurrency = max(1, concurrency)
+        self.insert_batch_size = max(1, insert_batch_size)
+        self.stale_seconds = stale_seconds
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='ocr-batch')
+
+    def ensure_indexes(self):
+        self.collection.create_index([('id', pymongo.ASCENDING)], unique=True)
+        self.collection.create_index([('status', pymongo.ASCENDING), ('heartbeatAt', pymongo.ASCENDING)])
+        self.files_collection.create_index([('batchId', pymongo.ASCENDING), ('position', pymongo.ASCENDING)],
+                                           unique=True)
+
+    def fail_interrupted(self):
+        """Mark batches whose process stopped sending heartbeats as failed; returns how many"""
+        now = datetime.now()
+        return self.collection.update_many(
+            {'status': {'$in': [BATCH_QUEUED, BATCH_RUNNING]},
+             'heartbeatAt': {'$lt': now - timedelta(seconds=self.stale_seconds)}},
+            {'$set': {'status': BATCH_FAILED, 'error': 'Interrupted by an API restart', 'finishedAt': now}}
+        ).modified_count
+
+    def create(self, total=None):
+        """Persist a new batch manifest and return its ID"""
+        batch_id = str(uuid.uuid4())
+        now = datetime.now()
+        self.collection.insert_one({
+            'id': batch_id,
+            'status': BATCH_QUEUED,
+            'total': total,
+            'processed': 0,
+            'succeeded': 0,
+            'failed': 0,
+            'createdAt': now,
+            'heartbeatAt': now,
+            'startedAt': None,
+            'finishedAt': None
+        })
+        return batch_id
+
+    def get(self, batch_id):
+        return self.collection.find_one({'id': batch_id}, {'_id': 0})
+
+    def files(self, batch_id, after=-1, limit=200):
+        """Per-file outcomes of a batch in discovery order, starting after position after"""
+        return list(self.files_collection.find(
+            {'batchId': batch_id, 'position': {'$gt': after}},
+            {'_id': 0, 'batchId': 0}
+        ).sort('position', pymongo.ASCENDING).limit(limit))
+
+    def start(self, batch_id, entries, options):
+        """Process an iterator of batch entries (see iter_batch_entries) in the background"""
+        thread = threading.Thread(target=self._run, args=(batch_id, entries, options),
+                                  name=f"ocr-batch-{batch_id[:8]}", daemon=True)
+        thread.start()
+        return thread
+
+    def _run(self, batch_id, entries, options):
+        self.collection.update_one({'id': batch_id},
+                                   {'$set': {'status': BATCH_RUNNING, 'startedAt': datetime.now()}})
+        try:
+            total = self._ingest(batch_id, entries, options)
+        except Exception as e:
+            self.collection.update_one({'id': batch_id}, {'$set': {
+                'status': BATCH_FAILED,
+                'error': str(e),
+                'finishedAt': datetime.now()
+            }})
+            return
+
+        self.collection.update_one({'id': batch_id}, {'$set': {
+            'status': BATCH_DONE,
+            'total': total,
+            'finishedAt': datetime.now()
+        }})
+
+    def _ingest(self, batch_id, entries, options):
+        """Fan entries out to the pool and flush results in bulk; returns the number of files"""
+        # At most concurrency * 2 files are extracted but not yet OCR'd at any time
+        window = self.concurrency * 2
+        in_flight = deque()
+        pending = []
+        discovered = 0
+        heartbeat = datetime.now()
+
+        try:
+            for filename, document_id, upload, error in entries:
+                record = {'batchId': batch_id, 'position': discovered, 'filename': filename, 'documentId': document_id}
+                discovered += 1
+                if error:
+                    pending.append((dict(record, status=FILE_FAILED, error=error), None))
+                else:
+                    in_flight.append((record, self._executor.submit(self.ocr_file, document_id, filename, upload, options)))
+
+                while len(in_flight) >= window:
+                    pending.append(self._collect(*in_flight.popleft()))
+                if len(pending) >= self.insert_batch_size:
+                    self._flush(batch_id, pending)
+                    pending = []
+                if (datetime.now() - heartbeat).total_seconds() >= HEARTBEAT_INTERVAL:
+                    heartbeat = datetime.now()
+                    self.collection.update_one({'id': batch_id}, {'$set': {'heartbeatAt': heartbeat}})
+        finally:
+            # Files already sent to the engine are saved even when reading the entries failed
+            while in_flight:
+                pending.append(self._collect(*in_flight.popleft()))
+            self._flush(batch_id, pending)
+        return discovered
+
+    def _collect(self, record, future):
+        try:
+            return dict(record, status=FILE_DONE, error=None), future.result()
+        except Exception as e:
+            return dict(record, status=FILE_FAILED, error=str(e)), None
+
+    def _flush(self, batch_id, pending):
+        """Bulk-insert finished documents and record their outcome in the manifest"""
+        ok = [(record, entry) for record, entry in pending if entry is not None]
+        if ok:
+            try:
+                self.store([entry for _, entry in ok])
+            except pymongo.errors.BulkWriteError as e:
+                # Unordered inserts: only the reported entries were not written
+                for error in e.details.get('writeErrors', []):
+                    ok[error['index']][0].update(status=FILE_FAILED, error=f"Could not save document: {error.get('errmsg')}")
+            except Exception as e:
+                for record, _ in ok:
+                    record.update(status=FILE_FAILED, error=f"Could not save document: {e}")
+
+        records = [record for record, _ in pending]
+        if not records:
+            return
+        self.files_collection.insert_many(records)
+        succeeded = sum(1 for record in records if record['status'] == FILE_DONE)
+        self.collection.update_one({'id': batch_id}, {
+            '$set': {'heartbeatAt': datetime.now()},
+            '$inc': {
+                'processed': len(records),
+                'succeeded': succeeded,
+                'failed': len(records) - succeeded
+            }
+        })
+
+
+def serialize_batch(batch, files, next_cursor=None):
+    """Convert a stored batch manifest and a page of its file records into the JSON status representation"""
+    started, finished = batch.get('startedAt'), batch.get('finishedAt')
+    return {
+        'batchId': batch['id'],
+        'status': batch['status'],
+        'total': batch.get('total'),
+        'processed': batch.get('processed', 0),
+        'succeeded': batch.get('succeeded', 0),
+        'failed': batch.get('failed', 0),
+        'createdAt': batch['createdAt'].isoformat(),
+        'startedAt': started.isoformat() if started else None,
+        'finishedAt': finished.isoformat() if finished else None,
+        'error': batch.get('error'),
+        'files': files,
+        'nextCursor': next_cursor
+    }
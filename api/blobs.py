@@ -0,0 +1,362 @@
+"""
+Content-addressed storage for uploaded files.
+
+Uploads are stored once per distinct content, named by the SHA-256 of their
+bytes and sharded two directory levels deep (`ab/cd/abcd...`), so no directory
+holds more than a few thousand files however many documents there are.
+Documents reference their upload as {'sha256', 'size'} in an `upload` field, so
+uploading the same file twice costs no extra disk. Renditions are stored next
+to the blob they were made from and are shared the same way.
+
+Files are written through a BlobWriter, which hashes the stream while spooling
+it to a temp file and moves it into place when it is closed. Blobs are only
+ever deleted by the garbage collector:
+
+- blobs no document references are removed once they are older than a grace
+  period, which covers uploads still being processed, queued jobs and batch
+  archives being expanded
+- with a retention period, the uploads of documents older than it are released
+- with a quota, the uploads of the oldest documents are released until the
+  store is back under 90% of it
+
+Released documents keep their OCR results; only the original file is gone.
+"""
+
+import glob
+import hashlib
+import os
+import re
+import shutil
+import socket
+import tempfile
+import threading
+from datetime import datetime, timedelta
+
+import pymongo
+
+CHUNK_SIZE = 64 * 1024
+
+DIGEST = re.compile(r'[0-9a-f]{64}')
+
+TMP_DIR = 'tmp'
+
+# A blob being collected is renamed to this first (see delete_if_stale)
+COLLECTING_SUFFIX = '.collecting'
+
+
+class BlobWriter:
+    """Spool a stream of chunks to a temp file while hashing it; close() stores it"""
+
+    def __init__(self, store):
+        self.store = store
+        self.size = 0
+        self.digest = None
+        self._hash = hashlib.sha256()
+        fd, self._tmp_path = tempfile.mkstemp(dir=store.tmp_dir, suffix='.tmp')
+        self._file = os.fdopen(fd, 'wb')
+
+    def write(self, chunk):
+        self._hash.update(chunk)
+        self._file.write(chunk)
+        self.size += len(chunk)
+
+    def close(self):
+        """Move the file into the store (or drop it if the content is already there); returns its reference"""
+        if not self._file.closed:
+            self._file.close()
+            self.digest = self._hash.hexdigest()
+            self.store._commit(self._tmp_path, self.digest)
+        return self.reference()
+
+    def abort(self):
+        if not self._file.closed:
+            self._file.close()
+            os.remove(self._tmp_path)
+
+    def reference(self):
+        return {'sha256': self.digest, 'size': self.size}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class BlobStore:
+    """Files on disk named by the SHA-256 of their content"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.tmp_dir = os.path.join(directory, TMP_DIR)
+        os.makedirs(self.tmp_dir, exist_ok=True)
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest[2:4], digest)
+
+    def exists(self, digest):
+        return os.path.exists(self.path(digest))
+
+    def writer(self):
+        return BlobWriter(self)
+
+    def put(self, stream):
+        """Store a file object, reading it in chunks; returns its reference"""
+        with self.writer() as writer:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                writer.write(chunk)
+        return writer.reference()
+
+    def put_file(self, path, move=False):
+        """Store a file from disk, moving it into place when move is set; returns its reference"""
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        digest = digest.hexdigest()
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.tmp_dir, suffix='.tmp')
+        os.close(fd)
+        try:
+            if move:
+                # A rename when the upload folder and the store share a file system
+                shutil.move(path, tmp_path)
+            else:
+                shutil.copyfile(path, tmp_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        self._commit(tmp_path, digest)
+        return {'sha256': digest, 'size': size}
+
+    def chunks(self, digest):
+        """Read a blob in chunks"""
+        with open(self.path(digest), 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    def delete(self, digest):
+        """Remove a blob and the renditions stored next to it"""
+        path = self.path(digest)
+        for derived in glob.glob(glob.escape(path) + '.*'):
+            _remove(derived)
+        _remove(path)
+
+    def delete_if_stale(self, digest, cutoff):
+        """Remove a blob and its renditions unless it was written since cutoff; returns whether it was removed
+
+        The blob is moved aside before its mtime is checked. A writer storing the
+        same content at that moment either refreshed the mtime before the move, so
+        the blob is put back, or finds it missing and stores its own copy.
+        """
+        path = self.path(digest)
+        moved = path + COLLECTING_SUFFIX
+        try:
+            os.rename(path, moved)
+        except OSError:
+            if not os.path.exists(moved):
+                return False  # Already gone; a leftover of an interrupted pass is finished below
+        try:
+            recent = os.stat(moved).st_mtime >= cutoff
+        except OSError:
+            return False
+        if recent:
+            os.replace(moved, path)
+            return False
+        _remove(moved)
+        if os.path.exists(path):
+            return False  # Stored again while it was moved aside; its renditions still apply
+        self.delete(digest)
+        return True
+
+    def iter_shards(self):
+        """Yield {digest: (bytes including renditions, mtime)} for each leaf shard directory"""
+        for top in sorted(os.listdir(self.directory)):
+            top_dir = os.path.join(self.directory, top)
+            if top == TMP_DIR or not os.path.isdir(top_dir):
+                continue
+            for sub in sorted(os.listdir(top_dir)):
+                shard_dir = os.path.join(top_dir, sub)
+                if not os.path.isdir(shard_dir):
+                    continue
+                blobs = {}
+                sizes = {}
+                for name in os.listdir(shard_dir):
+                    try:
+                        st = os.stat(os.path.join(shard_dir, name))
+                    except OSError:
+                        continue
+                    digest = name.split('.', 1)[0]
+                    sizes[digest] = sizes.get(digest, 0) + st.st_size
+                    if DIGEST.fullmatch(name):
+                        blobs[digest] = st.st_mtime
+                    elif name == digest + COLLECTING_SUFFIX:
+                        blobs.setdefault(digest, st.st_mtime)
+                yield {digest: (sizes[digest], mtime) for digest, mtime in blobs.items()}
+
+    def remove_stale_temp_files(self, max_age):
+        """Delete temp files left behind by writers that died mid-upload"""
+        cutoff = datetime.now().timestamp() - max_age
+        for name in os.listdir(self.tmp_dir):
+            path = os.path.join(self.tmp_dir, name)
+            try:
+                if os.stat(path).st_mtime < cutoff:
+                    os.remove(path)
+            except OSError:
+                continue
+
+    def _commit(self, tmp_path, digest):
+        path = self.path(digest)
+        try:
+            # Same content already stored: restart its grace period instead. If the
+            # collector moved it aside first this fails and the new copy is stored
+            os.utime(path)
+        except OSError:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(tmp_path, path)
+        else:
+            os.remove(tmp_path)
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+class BlobCollector:
+    """Background garbage collection of a BlobStore referenced from a documents collection
+
+    Only one process collects at a time: each pass first takes a lease in the
+    leases collection. pinned() returns digests that must be kept even though
+    no document references them yet (e.g. uploads of queued jobs).
+    """
+
+    LEASE_ID = 'upload-gc'
+
+    def __init__(self, store, documents, leases, interval=3600, grace_seconds=24 * 3600,
+                 retention_days=0, quota_bytes=0, pinned=None, after_pass=None):
+        self.store = store
+        self.documents = documents
+        self.leases = leases
+        self.interval = interval
+        self.grace_seconds = grace_seconds
+        self.retention_days = retention_days
+        self.quota_bytes = quota_bytes
+        self.pinned = pinned or set
+        self.after_pass = after_pass
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the collector thread for this process (idempotent)"""
+        with self._lock:
+            if self._thread is not None or self.interval <= 0:
+                return
+            self._thread = threading.Thread(target=self._loop, name='upload-gc', daemon=True)
+            self._thread.start()
+
+    def _loop(self):
+        stop = threading.Event()
+        while not stop.wait(self.interval):
+            try:
+                if self._claim():
+                    self.collect()
+            except Exception:
+                continue
+
+    def _claim(self):
+        """Take the collection lease for one interval; False when another process holds it"""
+        now = datetime.now()
+        try:
+            self.leases.find_one_and_update(
+                {'_id': self.LEASE_ID, 'leaseExpiresAt': {'$lt': now}},
+                {'$set': {'leaseExpiresAt': now + timedelta(seconds=self.interval), 'worker': self.worker_id}},
+                upsert=True
+            )
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+
+    def collect(self):
+        """Run one collection pass and return counts of what it did"""
+        now = datetime.now()
+        stats = {'released': 0, 'deleted': 0, 'freedBytes': 0, 'storedBytes': 0}
+
+        if self.retention_days > 0:
+            cutoff = now - timedelta(days=self.retention_days)
+            stats['released'] += self._release({'createdAt': {'$lt': cutoff}, 'upload': {'$exists': True}}, now)
+
+        grace_cutoff = now.timestamp() - self.grace_seconds
+        pinned = self.pinned()
+        for shard in self.store.iter_shards():
+            referenced = {document['upload']['sha256'] for document in self.documents.find(
+                {'upload.sha256': {'$in': list(shard)}}, {'_id': 0, 'upload.sha256': 1})}
+            for digest, (size, mtime) in shard.items():
+                # mtime is re-checked on delete: the same content may have been uploaded since
+                if digest in referenced or digest in pinned or mtime >= grace_cutoff or \
+                        not self.store.delete_if_stale(digest, grace_cutoff):
+                    stats['storedBytes'] += size
+                    continue
+                stats['deleted'] += 1
+                stats['freedBytes'] += size
+
+        if self.quota_bytes > 0 and stats['storedBytes'] > self.quota_bytes:
+            self._enforce_quota(stats, now, grace_cutoff)
+
+        self.store.remove_stale_temp_files(self.grace_seconds)
+        if self.after_pass is not None:
+            self.after_pass()
+        return stats
+
+    def _release(self, query, now):
+        """Drop the uploads of the documents matching query; returns how many were released
+
+        Their version is bumped so clients revalidate them and cached exports
+        are regenerated. Documents stored before versioning count as version 1.
+        """
+        self.documents.update_many(dict(query, version={'$exists': False}), {'$set': {'version': 1}})
+        return self.documents.update_many(
+            query,
+            {'$unset': {'upload': ''}, '$set': {'uploadReleasedAt': now}, '$inc': {'version': 1}}
+        ).modified_count
+
+    def _enforce_quota(self, stats, now, grace_cutoff):
+        """Release the uploads of the oldest documents until the store is under 90% of the quota"""
+        target = self.quota_bytes * 0.9
+        oldest = self.documents.find({'upload': {'$exists': True}}, {'_id': 0, 'id': 1, 'upload': 1}) \
+            .sort([('createdAt', pymongo.ASCENDING), ('id', pymongo.ASCENDING)])
+        for document in oldest:
+            if stats['storedBytes'] <= target:
+                break
+            digest = document['upload']['sha256']
+            # Releasing one of several documents sharing a blob frees nothing
+            if self.documents.count_documents({'upload.sha256': digest}, limit=2) > 1:
+                continue
+            path = self.store.path(digest)
+            try:
+                if os.stat(path).st_mtime >= grace_cutoff:
+                    continue  # Uploaded again just now
+                size = sum(os.stat(p).st_size for p in [path] + glob.glob(glob.escape(path) + '.*'))
+            except OSError:
+                size = 0
+            self._release({'id': document['id']}, now)
+            stats['released'] += 1
+            if not self.store.delete_if_stale(digest, grace_cutoff):
+                continue  # Uploaded again while it was being released
+            stats['deleted'] += 1
+            stats['freedBytes'] += size
+            stats['storedBytes'] -= size
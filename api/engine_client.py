@@ -0,0 +1,118 @@
+"""
+Streaming client for the OCR engine.
+
+Uploads are sent to the engine as a hand-built multipart body generated from an
+iterator of chunks, so requests never buffers the whole file in memory. For
+fresh uploads the chunks are teed to the blob store while they are being sent,
+which means each upload is read once and written to disk once. All calls share one
+pooled keep-alive session.
+"""
+
+import os
+import uuid
+
+import requests
+from requests.adapters import HTTPAdapter
+
+CHUNK_SIZE = 64 * 1024
+
+ENGINE_POOL_SIZE = int(os.environ.get('ENGINE_POOL_SIZE', '16'))
+ENGINE_TIMEOUT = int(os.environ.get('ENGINE_TIMEOUT', '300'))
+
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=1, pool_maxsize=ENGINE_POOL_SIZE)
+session.mount('http://', adapter)
+session.mount('https://', adapter)
+
+
+class TeeUpload:
+    """Iterate over an upload stream while copying every chunk to a sink (e.g. a BlobWriter)"""
+
+    def __init__(self, stream, sink):
+        self.stream = stream
+        self.sink = sink
+        self._result = None
+        self._finished = False
+
+    def __iter__(self):
+        while True:
+            chunk = self.stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            self.sink.write(chunk)
+            yield chunk
+
+    def finish(self):
+        """Copy whatever the engine did not consume (e.g. after an error), close the sink and return what closing it returned"""
+        if self._finished:
+            return self._result
+        self._finished = True
+        try:
+            for _ in self:
+                pass
+        except Exception:
+            self.sink.abort()
+            raise
+        self._result = self.sink.close()
+        return self._result
+
+
+def file_chunks(path):
+    """Read a stored file in chunks"""
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+def form_fields(fields):
+    """Form values as the engine expects them: booleans as 'true'/'false'"""
+    return {name: ('true' if value else 'false') if isinstance(value, bool) else value
+            for name, value in fields.items()}
+
+
+def _field_parts(boundary, fields):
+    return ''.join(f'--{boundary}\r\n'
+                   f'Content-Disposition: form-data; name="{name}"\r\n\r\n'
+                   f'{value}\r\n' for name, value in form_fields(fields).items())
+
+
+def multipart_head(boundary, fields, filename):
+    """Multipart field parts followed by the headers of the file part"""
+    safe_name = filename.replace('"', '%22').replace('\r', '').replace('\n', '')
+    return (_field_parts(boundary, fields) +
+            f'--{boundary}\r\n'
+            f'Content-Disposition: form-data; name="file"; filename="{safe_name}"\r\n'
+            f'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8')
+
+
+def multipart_tail(boundary, fields=None):
+    """End of the file part, then fields only known once the file has been sent (the engine reads the whole form first)"""
+    return f'\r\n{_field_parts(boundary, fields or {})}--{boundary}--\r\n'.encode('utf-8')
+
+
+def multipart_body(boundary, fields, filename, chunks):
+    """Yield a multipart/form-data body with the given fields and one streamed file part"""
+    yield multipart_head(boundary, fields, filename)
+    for chunk in chunks:
+        yield chunk
+    yield multipart_tail(boundary)
+
+
+def post_document(url, filename, chunks, fields):
+    """Stream a document to the engine and return the response"""
+    boundary = uuid.uuid4().hex
+    return session.post(
+        url,
+        data=multipart_body(boundary, fields, filename, chunks),
+        headers={'Content-Type': f'multipart/form-data; boundary={boundary}'},
+        timeout=ENGINE_TIMEOUT
+    )
+
+
+def post_reprocess(url, content_hash, fields):
+    """Ask the engine to re-process a document from its stored artifacts"""
+    data = dict(form_fields(fields), contentHash=content_hash)
+    return session.post(url, data=data, timeout=ENGINE_TIMEOUT)
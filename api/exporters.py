@@ -0,0 +1,398 @@
+"""
+Document export engine.
+
+Turns a stored document into a searchable PDF (the original page images with an
+invisible text layer), DOCX with real tables, Markdown with Mermaid blocks,
+structured JSON, plain text, or hOCR and ALTO XML built from the stored word
+boxes. Exports are cached on disk under a key made of
+the document id, its content version and the format, and the cache is kept
+under a size budget by evicting the least recently used files.
+"""
+
+import io
+import json
+import os
+import re
+import tempfile
+from xml.sax.saxutils import escape, quoteattr
+
+from PIL import Image, ImageSequence
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+# Format name -> (file extension, MIME type)
+EXPORT_FORMATS = {
+    'PDF': ('pdf', 'application/pdf'),
+    'DOCX': ('docx', 'application/vnd.openxmlformats-officedocument.wordprocessingml.document'),
+    'MD': ('md', 'text/markdown'),
+    'JSON': ('json', 'application/json'),
+    'TXT': ('txt', 'text/plain'),
+    'HOCR': ('hocr', 'text/vnd.hocr+html'),
+    'ALTO': ('xml', 'application/xml')
+}
+
+FORMAT_ALIASES = {
+    'MARKDOWN': 'MD'
+}
+
+# Resolution used when placing page images in PDF exports
+EXPORT_IMAGE_DPI = 150
+
+
+def normalize_format(fmt):
+    """Canonical export format name, or None if the format is not supported"""
+    fmt = (fmt or '').upper()
+    fmt = FORMAT_ALIASES.get(fmt, fmt)
+    return fmt if fmt in EXPORT_FORMATS else None
+
+
+def export_path(cache_dir, document_id, version, fmt):
+    return os.path.join(cache_dir, f"{document_id}_v{version}.{EXPORT_FORMATS[fmt][0]}")
+
+
+def mimetype(fmt):
+    return EXPORT_FORMATS[fmt][1]
+
+
+def extension(fmt):
+    return EXPORT_FORMATS[fmt][0]
+
+
+def write_export(document, fmt, dest, source_path=None):
+    """Render a document in the given format to dest (atomically)"""
+    writer = {
+        'PDF': lambda f: write_pdf(document, f, source_path),
+        'DOCX': lambda f: write_docx(document, f),
+        'MD': lambda f: f.write(to_markdown(document).encode('utf-8')),
+        'JSON': lambda f: f.write(json.dumps(to_json(document), indent=2).encode('utf-8')),
+        'TXT': lambda f: f.write(document.get('text', '').encode('utf-8')),
+        'HOCR': lambda f: f.write(to_hocr(document).encode('utf-8')),
+        'ALTO': lambda f: f.write(to_alto(document).encode('utf-8'))
+    }[fmt]
+
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            writer(f)
+        os.replace(tmp_path, dest)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def evict_exports(cache_dir, max_bytes, keep=None):
+    """Delete the least recently used exports (other than keep) until the cache fits in max_bytes"""
+    files = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        if name.endswith('.tmp') or path == keep:
+            continue
+        try:
+            st = os.stat(path)
+        except OSError:
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            continue
+        total -= size
+
+
+def document_pages(document):
+    """Per-page text (and layout data when present), falling back to the whole text as one page"""
+    return document.get('pages') or [{'pageNumber': 1, 'text': document.get('text', '')}]
+
+
+def to_json(document):
+    return {
+        'id': document['id'],
+        'filename': document['filename'],
+        'createdAt': document['createdAt'].isoformat(),
+        'metadata': document.get('metadata', {}),
+        'pages': document_pages(document),
+        'tables': [{key: table.get(key) for key in ('id', 'page', 'bbox', 'rows')}
+                   for table in document.get('tables', [])],
+        'diagrams': document.get('diagrams', [])
+    }
+
+
+def _markdown_cell(cell):
+    return cell.replace('|', '\\|').replace('\n', ' ')
+
+
+def to_markdown(document):
+    parts = [f"# {document['filename']}\n"]
+
+    pages = document_pages(document)
+    for page in pages:
+        if len(pages) > 1:
+            parts.append(f"## Page {page['pageNumber']}\n")
+        parts.append(page.get('text', '').strip() + '\n')
+
+    tables = [table for table in document.get('tables', []) if table.get('rows')]
+    if tables:
+        parts.append('## Tables\n')
+    for table in tables:
+        rows = table['rows']
+        parts.append('| ' + ' | '.join(_markdown_cell(cell) for cell in rows[0]) + ' |')
+        parts.append('|' + ' --- |' * len(rows[0]))
+        for row in rows[1:]:
+            parts.append('| ' + ' | '.join(_markdown_cell(cell) for cell in row) + ' |')
+        parts.append('')
+
+    diagrams = document.get('diagrams', [])
+    if diagrams:
+        parts.append('## Diagrams\n')
+    for diagram in diagrams:
+        parts.append(f"```mermaid\n{diagram.get('mermaidCode', '').rstrip()}\n```\n")
+
+    return '\n'.join(parts)
+
+
+def write_docx(document, f):
+    import docx
+
+    doc = docx.Document()
+    doc.add_heading(document['filename'], level=1)
+
+    pages = document_pages(document)
+    for index, page in enumerate(pages):
+        if index > 0:
+            doc.add_page_break()
+        for paragraph in re.split(r'\n\s*\n', page.get('text', '').strip()):
+            if paragraph:
+                doc.add_paragraph(paragraph)
+
+    for table in document.get('tables', []):
+        rows = table.get('rows')
+        if not rows:
+            continue
+        doc.add_heading(f"Table (page {table.get('page', 1)})", level=2)
+        grid = doc.add_table(rows=len(rows), cols=len(rows[0]))
+        grid.style = 'Table Grid'
+        for r, row in enumerate(rows):
+            for c, cell in enumerate(row):
+                grid.cell(r, c).text = cell
+                if r == 0:
+                    for run in grid.cell(r, c).paragraphs[0].runs:
+                        run.bold = True
+
+    for diagram in document.get('diagrams', []):
+        doc.add_heading(f"Diagram: {diagram.get('type', 'flowchart')}", level=2)
+        code = doc.add_paragraph().add_run(diagram.get('mermaidCode', ''))
+        code.font.name = 'Courier New'
+
+    doc.save(f)
+
+
+def iter_source_images(source_path):
+    """Yield (PIL image, page width pt, page height pt) for each page of the original upload"""
+    with open(source_path, 'rb') as src:
+        is_pdf = src.read(5) == b'%PDF-'
+
+    if is_pdf:
+        if pdfium is None:
+            raise ValueError('PDF export of PDF uploads requires the pypdfium2 package')
+        pdf = pdfium.PdfDocument(source_path)
+        try:
+            for index in range(len(pdf)):
+                page = pdf[index]
+                width, height = page.get_size()
+                yield page.render(scale=EXPORT_IMAGE_DPI / 72).to_pil(), width, height
+                page.close()
+        finally:
+            pdf.close()
+        return
+
+    with Image.open(source_path) as image:
+        for frame in ImageSequence.Iterator(image):
+            dpi = frame.info.get('dpi', (300, 300))[0] or 300
+            page_image = frame.convert('RGB')
+            yield page_image, page_image.width * 72 / dpi, page_image.height * 72 / dpi
+
+
+def _page_words(page):
+    """(text, left, top, width, height) word boxes in OCR pixel coordinates, if stored"""
+    words = page.get('words')
+    if not words:
+        return []
+    return [(text, left, top, width, height) for text, left, top, width, height
+            in zip(words['text'], words['left'], words['top'], words['width'], words['height'])
+            if text.strip()]
+
+
+def _bounds(boxes):
+    """[left, top, right, bottom] around (left, top, width, height) boxes"""
+    return [min(b[0] for b in boxes), min(b[1] for b in boxes),
+            max(b[0] + b[2] for b in boxes), max(b[1] + b[3] for b in boxes)]
+
+
+def _page_blocks(page):
+    """Blocks of lines of word dicts, from the page's columnar word boxes"""
+    words = page.get('words') or {}
+    blocks = []
+    last_block = last_line = None
+    for i, text in enumerate(words.get('text', [])):
+        block, line = words['block'][i], words['line'][i]
+        if block != last_block:
+            blocks.append([])
+            last_block, last_line = block, None
+        if line != last_line:
+            blocks[-1].append([])
+            last_line = line
+        blocks[-1][-1].append({
+            'text': text,
+            'box': (words['left'][i], words['top'][i], words['width'][i], words['height'][i]),
+            'conf': words['conf'][i]
+        })
+    return blocks
+
+
+def _hocr_bbox(box):
+    return 'bbox {} {} {} {}'.format(*box)
+
+
+def to_hocr(document):
+    """hOCR (HTML with ocr_page/ocr_carea/ocr_line/ocrx_word elements) of the stored word boxes"""
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN" '
+             '"http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">',
+             '<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">',
+             '<head>',
+             f"<title>{escape(document['filename'])}</title>",
+             '<meta http-equiv="Content-Type" content="text/html;charset=utf-8" />',
+             '<meta name="ocr-system" content="ai-agent-ocr-app" />',
+             '<meta name="ocr-capabilities" content="ocr_page ocr_carea ocr_line ocrx_word" />',
+             '</head>',
+             '<body>']
+
+    for page in document_pages(document):
+        number = page['pageNumber']
+        image_name = document['filename'].replace('"', '')
+        title = f'image "{image_name}"; ppageno {number - 1}'
+        if page.get('width') and page.get('height'):
+            title += f"; bbox 0 0 {page['width']} {page['height']}"
+        parts.append(f"<div class='ocr_page' id='page_{number}' title={quoteattr(title)}>")
+        for b, block in enumerate(_page_blocks(page), start=1):
+            block_box = _bounds([word['box'] for line in block for word in line])
+            parts.append(f"<div class='ocr_carea' id='block_{number}_{b}' title='{_hocr_bbox(block_box)}'>")
+            for l, line in enumerate(block, start=1):
+                line_box = _bounds([word['box'] for word in line])
+                parts.append(f"<span class='ocr_line' id='line_{number}_{b}_{l}' title='{_hocr_bbox(line_box)}'>")
+                for w, word in enumerate(line, start=1):
+                    left, top, width, height = word['box']
+                    title = f"{_hocr_bbox((left, top, left + width, top + height))}; x_wconf {word['conf']}"
+                    parts.append(f"<span class='ocrx_word' id='word_{number}_{b}_{l}_{w}' "
+                                 f"title='{title}'>{escape(word['text'])}</span>")
+                parts.append('</span>')
+            parts.append('</div>')
+        parts.append('</div>')
+
+    parts += ['</body>', '</html>', '']
+    return '\n'.join(parts)
+
+
+def _alto_box(box):
+    left, top, right, bottom = box
+    return f'HPOS="{left}" VPOS="{top}" WIDTH="{right - left}" HEIGHT="{bottom - top}"'
+
+
+def to_alto(document):
+    """ALTO v4 XML (TextBlock/TextLine/String elements) of the stored word boxes"""
+    parts = ['<?xml version="1.0" encoding="UTF-8"?>',
+             '<alto xmlns="http://www.loc.gov/standards/alto/ns-v4#">',
+             '<Description>',
+             '<MeasurementUnit>pixel</MeasurementUnit>',
+             f"<sourceImageInformation><fileName>{escape(document['filename'])}</fileName></sourceImageInformation>",
+             '</Description>',
+             '<Layout>']
+
+    for page in document_pages(document):
+        number = page['pageNumber']
+        parts.append(f'<Page ID="page_{number}" PHYSICAL_IMG_NR="{number}" '
+                     f'WIDTH="{page.get("width", 0)}" HEIGHT="{page.get("height", 0)}">')
+        parts.append('<PrintSpace>')
+        for b, block in enumerate(_page_blocks(page), start=1):
+            block_box = _bounds([word['box'] for line in block for word in line])
+            parts.append(f'<TextBlock ID="block_{number}_{b}" {_alto_box(block_box)}>')
+            for l, line in enumerate(block, start=1):
+                parts.append(f'<TextLine ID="line_{number}_{b}_{l}" {_alto_box(_bounds([w["box"] for w in line]))}>')
+                for w, word in enumerate(line):
+                    if w:
+                        parts.append('<SP/>')
+                    left, top, width, height = word['box']
+                    parts.append(f'<String CONTENT={quoteattr(word["text"])} WC="{word["conf"] / 100:.2f}" '
+                                 f'{_alto_box((left, top, left + width, top + height))}/>')
+                parts.append('</TextLine>')
+            parts.append('</TextBlock>')
+        parts.append('</PrintSpace>')
+        parts.append('</Page>')
+
+    parts += ['</Layout>', '</alto>', '']
+    return '\n'.join(parts)
+
+
+def write_pdf(document, f, source_path):
+    """Searchable PDF: page images with an invisible (render mode 3) text layer"""
+    from reportlab.lib.utils import ImageReader
+    from reportlab.pdfgen import canvas
+
+    pdf = canvas.Canvas(f)
+    pages = document_pages(document)
+    sources = iter_source_images(source_path) if source_path and os.path.exists(source_path) else iter(())
+
+    for index, page in enumerate(pages):
+        source = next(sources, None)
+        if source is not None:
+            image, page_w, page_h = source
+        else:
+            # No original image: fall back to an A4 page with only the text layer
+            image, page_w, page_h = None, 595.0, 842.0
+
+        pdf.setPageSize((page_w, page_h))
+        if image is not None:
+            buffer = io.BytesIO()
+            image.save(buffer, 'JPEG', quality=85)
+            buffer.seek(0)
+            pdf.drawImage(ImageReader(buffer), 0, 0, page_w, page_h)
+
+        text_layer = pdf.beginText()
+        text_layer.setTextRenderMode(3)  # Invisible, but selectable and searchable
+
+        ocr_w = page.get('width') or (image.width if image is not None else page_w)
+        ocr_h = page.get('height') or (image.height if image is not None else page_h)
+        sx, sy = page_w / ocr_w, page_h / ocr_h
+
+        words = _page_words(page)
+        if words:
+            for text, left, top, width, height in words:
+                size = max(height * sy, 1)
+                text_layer.setFont('Helvetica', size)
+                natural = pdf.stringWidth(text, 'Helvetica', size)
+                text_layer.setHorizScale(100 * width * sx / natural if natural else 100)
+                text_layer.setTextOrigin(left * sx, page_h - (top + height) * sy)
+                text_layer.textOut(text)
+        else:
+            # Without word boxes, spread the lines evenly down the page
+            lines = [line for line in page.get('text', '').splitlines() if line.strip()]
+            leading = min(15, page_h / max(len(lines), 1))
+            text_layer.setFont('Helvetica', leading * 0.8)
+            text_layer.setLeading(leading)
+            text_layer.setTextOrigin(page_w * 0.05, page_h - leading * 0.8)
+            for line in lines:
+                text_layer.textLine(line)
+
+        pdf.drawText(text_layer)
+        pdf.showPage()
+
+    pdf.save()
@@ -0,0 +1,519 @@
+"""
+Asyncio serving mode for the API service.
+
+`hypercorn gateway:application` serves the API from one event loop instead of
+gunicorn's sync workers, where every in-flight request holds a worker. The
+routes that spend their time waiting on the OCR engine, MongoDB or the disk
+are implemented natively on Quart:
+
+- POST /api/ocr and POST /api/documents/<id>/reprocess call the engine through
+  a pooled httpx client and save results with motor. Uploads are decoded from
+  the request body as it arrives and each chunk is sent to the engine while it
+  is written to the blob store, like the Flask app's TeeUpload
+- GET /api/documents and GET /api/documents/<id> read with motor
+- GET /api/documents/<id>/image, /thumbnail and /preview stream files
+  asynchronously
+
+Every other route (batches, jobs, search, export, settings, /metrics) falls
+through to the Flask app in app.py, which runs on a thread pool. Both modes
+therefore serve the same API, from the same database and upload store.
+"""
+
+import asyncio
+import json
+import os
+import uuid
+
+import aiofiles
+import httpx
+import pymongo
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from motor.motor_asyncio import AsyncIOMotorClient
+from quart import Quart, Response, jsonify, request, send_file
+from quart.utils import run_sync
+from werkzeug.exceptions import MethodNotAllowed, NotFound
+from werkzeug.http import parse_options_header
+from werkzeug.routing import RequestRedirect
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData, Preamble
+
+import app as sync_app
+import metrics
+from http_cache import cache_immutable, cache_revalidate, document_etag
+from engine_client import CHUNK_SIZE, ENGINE_TIMEOUT, form_fields, multipart_head, multipart_tail
+from jobs import JOB_QUEUED, QueueFullError
+from metrics import stage
+from renditions import ensure_rendition, generate_renditions, mimetype as rendition_mimetype
+
+# OCR calls one process keeps in flight, and the engine connection pool they share
+GATEWAY_MAX_INFLIGHT_OCR = int(os.environ.get('GATEWAY_MAX_INFLIGHT_OCR', '256'))
+GATEWAY_ENGINE_POOL_SIZE = int(os.environ.get('GATEWAY_ENGINE_POOL_SIZE', '64'))
+
+# Requests served by the Flask app are buffered in memory; this caps batch uploads
+GATEWAY_MAX_BODY_BYTES = int(os.environ.get('GATEWAY_MAX_BODY_BYTES', str(512 * 1024 * 1024)))
+
+# Largest form field (other than the file) read from a streamed upload
+GATEWAY_MAX_FIELD_BYTES = int(os.environ.get('GATEWAY_MAX_FIELD_BYTES', str(500 * 1024)))
+
+app = Quart(__name__)
+app.config['MAX_CONTENT_LENGTH'] = GATEWAY_MAX_BODY_BYTES
+metrics.init_async_app(app)
+
+# Created on startup, inside the event loop they belong to
+db = None
+engine = None
+inflight_ocr = None
+
+
+@app.before_serving
+async def open_clients():
+    global db, engine, inflight_ocr
+    db = AsyncIOMotorClient('mongodb://db:27017/')['ocr_app']
+    engine = httpx.AsyncClient(
+        base_url=sync_app.OCR_ENGINE_URL,
+        timeout=ENGINE_TIMEOUT,
+        limits=httpx.Limits(max_connections=GATEWAY_ENGINE_POOL_SIZE,
+                            max_keepalive_connections=GATEWAY_ENGINE_POOL_SIZE)
+    )
+    inflight_ocr = asyncio.Semaphore(GATEWAY_MAX_INFLIGHT_OCR)
+
+
+@app.after_serving
+async def close_clients():
+    await engine.aclose()
+    db.client.close()
+
+
+@app.after_request
+async def allow_cross_origin(response):
+    # Preflight requests are answered by flask-cors on the Flask app
+    response.headers.setdefault('Access-Control-Allow-Origin', '*')
+    return response
+
+
+def overloaded(message):
+    response = jsonify({'error': message})
+    response.status_code = 429
+    response.headers['Retry-After'] = str(sync_app.OVERLOAD_RETRY_AFTER)
+    return response
+
+
+async def file_stream(path):
+    """Read a stored file in chunks without blocking the event loop"""
+    async with aiofiles.open(path, 'rb') as f:
+        while True:
+            chunk = await f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            yield chunk
+
+
+class InvalidUpload(Exception):
+    """The request body is not a complete multipart form"""
+
+
+class MultipartUpload:
+    """Incremental reader of a multipart/form-data body with a streamed 'file' part
+
+    Fields are collected into `fields` as they arrive. The file part is handed
+    out chunk by chunk as it is received, so the upload is never buffered.
+    """
+
+    def __init__(self, body, boundary):
+        self.fields = {}
+        self._body = body.__aiter__()
+        self._decoder = MultipartDecoder(boundary.encode('latin-1'), GATEWAY_MAX_FIELD_BYTES)
+
+    async def _next_event(self):
+        """Next part or data event; None at the end of the body"""
+        while True:
+            try:
+                event = self._decoder.next_event()
+            except ValueError as e:
+                raise InvalidUpload(str(e))
+            if isinstance(event, Epilogue):
+                return None
+            if isinstance(event, Preamble):
+                continue
+            if not isinstance(event, NeedData):
+                return event
+            try:
+                chunk = await self._body.__anext__()
+            except StopAsyncIteration:
+                chunk = None
+            self._decoder.receive_data(chunk)
+
+    async def _data(self):
+        while True:
+            event = await self._next_event()
+            if not isinstance(event, Data):
+                raise InvalidUpload('Incomplete multipart body')
+            if event.data:
+                yield event.data
+            if not event.more_data:
+                return
+
+    async def _read_parts(self, stop_at_file):
+        while True:
+            event = await self._next_event()
+            if event is None:
+                return None
+            if isinstance(event, File) and event.name == 'file' and stop_at_file:
+                return event.filename or ''
+            chunks = [chunk async for chunk in self._data()]
+            if isinstance(event, Field):
+                self.fields.setdefault(event.name, b''.join(chunks).decode('utf-8', 'replace'))
+
+    async def next_file(self):
+        """Read up to the start of the file part; returns its filename, or None without one"""
+        return await self._read_parts(stop_at_file=True)
+
+    def file_chunks(self):
+        """Chunks of the file part; call after next_file()"""
+        return self._data()
+
+    async def read_fields(self):
+        """Read the rest of the body, collecting fields sent after the file"""
+        await self._read_parts(stop_at_file=False)
+
+
+class JobModeRequested(Exception):
+    """An async=true field arrived after the file, so the upload is queued instead of OCR'd"""
+
+
+def job_mode(fields):
+    return (request.args.get('async') or fields.get('async', 'false')).lower() == 'true'
+
+
+async def store_file(upload, writer):
+    """Write the rest of an upload's file part to a blob writer and read the remaining fields"""
+    async for chunk in upload.file_chunks():
+        await run_sync(writer.write)(chunk)
+    await upload.read_fields()
+
+
+async def post_upload(filename, upload, writer):
+    """Stream an upload to the engine's /process while writing it to the blob store
+
+    OCR options are sent after the file, since clients commonly send the file
+    first. If the remaining fields ask for a job the request is abandoned before
+    the body is complete, so the engine never processes it.
+    """
+    boundary = uuid.uuid4().hex
+
+    async def body():
+        yield multipart_head(boundary, {}, filename)
+        async for chunk in upload.file_chunks():
+            await run_sync(writer.write)(chunk)
+            yield chunk
+        await upload.read_fields()
+        if job_mode(upload.fields):
+            raise JobModeRequested()
+        yield multipart_tail(boundary, sync_app.parse_ocr_options(upload.fields))
+
+    with stage('engine'):
+        response = await engine.post(
+            '/process',
+            content=body(),
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        )
+    metrics.add_remote_timing('engine', response.headers.get('Server-Timing'))
+    if response.status_code != 200:
+        raise sync_app.OCREngineError('OCR processing failed')
+    return response.json()
+
+
+async def multipart_stream(boundary, fields, filename, path):
+    yield multipart_head(boundary, fields, filename)
+    async for chunk in file_stream(path):
+        yield chunk
+    yield multipart_tail(boundary)
+
+
+async def post_document(filename, path, options):
+    """Stream a stored upload to the engine's /process and return its result"""
+    boundary = uuid.uuid4().hex
+    with stage('engine'):
+        response = await engine.post(
+            '/process',
+            content=multipart_stream(boundary, options, filename, path),
+            headers={'Content-Type': f'multipart/form-data; boundary={boundary}'}
+        )
+    metrics.add_remote_timing('engine', response.headers.get('Server-Timing'))
+    if response.status_code != 200:
+        raise sync_app.OCREngineError('OCR processing failed')
+    return response.json()
+
+
+async def reprocess_ocr(document, options):
+    """Async counterpart of app.reprocess_ocr: reuse engine artifacts, else resend the upload"""
+    if document.get('contentHash'):
+        with stage('engine'):
+            response = await engine.post(
+                '/reprocess', data=dict(form_fields(options), contentHash=document['contentHash']))
+        metrics.add_remote_timing('engine', response.headers.get('Server-Timing'))
+        if response.status_code == 200:
+            return response.json(), True
+        if response.status_code not in (404, 409):
+            raise sync_app.OCREngineError('OCR processing failed')
+
+    file_path = await run_sync(sync_app.document_upload_path)(document)
+    if file_path is None:
+        raise FileNotFoundError('Original upload not found')
+    return await post_document(document['filename'], file_path, options), False
+
+
+async def store_diagrams(document_id, diagrams):
+    if sync_app.NORMALIZE_DIAGRAMS and diagrams:
+        await db['diagrams'].insert_many(sync_app.normalized_diagrams(document_id, diagrams))
+
+
+@app.route('/api/ocr', methods=['POST'])
+async def process_document():
+    mimetype, params = parse_options_header(request.headers.get('Content-Type', ''))
+    if mimetype != 'multipart/form-data' or not params.get('boundary'):
+        return jsonify({'error': 'No file part'}), 400
+
+    upload = MultipartUpload(request.body, params['boundary'])
+    try:
+        filename = await upload.next_file()
+    except InvalidUpload as e:
+        return jsonify({'error': f'Invalid upload: {e}'}), 400
+    if filename is None:
+        return jsonify({'error': 'No file part'}), 400
+    if filename == '':
+        return jsonify({'error': 'No selected file'}), 400
+
+    document_id = str(uuid.uuid4())
+    writer = await run_sync(sync_app.blob_store.writer)()
+    ocr_result = None
+    try:
+        if job_mode(upload.fields) or inflight_ocr.locked():
+            # Queued, or the engine has no room for it: store it and decide once every field is read
+            await store_file(upload, writer)
+        else:
+            async with inflight_ocr:
+                try:
+                    ocr_result = await post_upload(filename, upload, writer)
+                except JobModeRequested:
+                    pass
+        stored = await run_sync(writer.close)()
+    except InvalidUpload as e:
+        await run_sync(writer.abort)()
+        return jsonify({'error': f'Invalid upload: {e}'}), 400
+    except Exception as e:
+        await run_sync(writer.abort)()
+        return jsonify({'error': str(e)}), 500
+
+    options = sync_app.parse_ocr_options(upload.fields)
+    if job_mode(upload.fields):
+        try:
+            job_id = await run_sync(sync_app.job_queue.enqueue)({
+                'documentId': document_id,
+                'filename': filename,
+                'upload': stored,
+                'options': options
+            })
+        except QueueFullError as e:
+            # Left for the garbage collector, like in app.py
+            return overloaded(str(e))
+
+        return jsonify({
+            'success': True,
+            'jobId': job_id,
+            'documentId': document_id,
+            'status': JOB_QUEUED,
+            'statusUrl': f"/api/jobs/{job_id}"
+        }), 202
+
+    if ocr_result is None:
+        return overloaded('Too many OCR requests in progress')
+
+    try:
+        document = sync_app.document_record(document_id, filename, ocr_result, options, stored)
+        with stage('db_insert'):
+            await db['documents'].insert_one(document)
+            await store_diagrams(document_id, ocr_result.get('diagrams', []))
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+    # Thumbnails are CPU-bound; failures are retried on first request
+    try:
+        with stage('renditions'):
+            await run_sync(generate_renditions)(sync_app.blob_store.path(stored['sha256']))
+    except Exception:
+        pass
+
+    return jsonify({
+        'success': True,
+        'documentId': document_id
+    })
+
+
+@app.route('/api/documents/<document_id>/reprocess', methods=['POST'])
+async def reprocess_document(document_id):
+    document = await db['documents'].find_one({'id': document_id}, sync_app.REPROCESS_PROJECTION)
+    if not document:
+        return jsonify({'error': 'Document not found'}), 404
+
+    options = sync_app.reprocess_options(document, await request.form)
+
+    if inflight_ocr.locked():
+        return overloaded('Too many OCR requests in progress')
+
+    async with inflight_ocr:
+        try:
+            ocr_result, incremental = await reprocess_ocr(document, options)
+            version = document.get('version', 1) + 1
+            with stage('db_insert'):
+                await db['documents'].update_one(
+                    {'id': document_id},
+                    {'$set': dict(sync_app.ocr_fields(ocr_result, options), version=version)}
+                )
+                await db['diagrams'].delete_many({'documentId': document_id})
+                await store_diagrams(document_id, ocr_result.get('diagrams', []))
+        except FileNotFoundError as e:
+            return jsonify({'error': str(e)}), 404
+        except Exception as e:
+            return jsonify({'error': str(e)}), 500
+
+    return jsonify({
+        'success': True,
+        'documentId': document_id,
+        'version': version,
+        'incremental': incremental
+    })
+
+
+@app.route('/api/documents', methods=['GET'])
+async def get_documents():
+    """List documents newest first, one cursor-delimited page at a time"""
+    try:
+        limit = min(int(request.args.get('limit', sync_app.DOCUMENTS_PAGE_SIZE)), sync_app.DOCUMENTS_MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        query = sync_app.build_listing_query(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    cursor = db['documents'].find(query, sync_app.LISTING_PROJECTION) \
+        .sort([('createdAt', pymongo.DESCENDING), ('id', pymongo.DESCENDING)]) \
+        .limit(limit + 1)
+
+    async def generate():
+        yield '{"documents": ['
+        last, count = None, 0
+        async for doc in cursor:
+            if count == limit:
+                break
+            if last is not None:
+                yield ','
+            last, count = doc, count + 1
+            yield json.dumps(sync_app.serialize_listing(doc))
+        else:
+            last = None  # Cursor exhausted: there is no next page
+
+        next_cursor = sync_app.encode_listing_cursor(last) if last is not None else None
+        yield f'], "nextCursor": {json.dumps(next_cursor)}}}'
+
+    return Response(generate(), mimetype='application/json')
+
+
+@app.route('/api/documents/<document_id>', methods=['GET'])
+async def get_document(document_id):
+    meta = await db['documents'].find_one({'id': document_id}, {'_id': 0, 'version': 1})
+    if not meta:
+        return jsonify({'error': 'Document not found'}), 404
+
+    etag = document_etag(document_id, meta.get('version', 1))
+    if request.if_none_match.contains(etag):
+        return cache_revalidate(Response('', status=304), etag)
+
+    document = await db['documents'].find_one({'id': document_id}, {'_id': 0, 'search': 0})
+    if not document:
+        return jsonify({'error': 'Document not found'}), 404
+
+    if document.get('diagramsNormalized'):
+        document['diagrams'] = await db['diagrams'].find(
+            {'documentId': document_id},
+            {'_id': 0, 'documentId': 0, 'position': 0}
+        ).sort('position', pymongo.ASCENDING).to_list(None)
+    document.pop('diagramsNormalized', None)
+
+    document['createdAt'] = document['createdAt'].isoformat()
+    return cache_revalidate(jsonify(document), document_etag(document_id, document.get('version', 1)))
+
+
+async def document_upload(document_id):
+    """Async counterpart of app.document_upload, sharing the Flask app's metadata LRU"""
+    document = sync_app.document_files.get(document_id)
+    if document is not None:
+        file_path = await run_sync(sync_app.document_upload_path)(document)
+        if file_path is not None:
+            return document, file_path
+    document = await db['documents'].find_one({'id': document_id}, sync_app.UPLOAD_PROJECTION)
+    if not document:
+        return None, None
+    sync_app.document_files.put(document_id, document)
+    return document, await run_sync(sync_app.document_upload_path)(document)
+
+
+@app.route('/api/documents/<document_id>/image', methods=['GET'])
+async def get_document_image(document_id):
+    document, file_path = await document_upload(document_id)
+    if document is None:
+        return jsonify({'error': 'Document not found'}), 404
+
+    if file_path is None:
+        return jsonify({'error': 'Image file not found'}), 404
+    return cache_immutable(await send_file(file_path, conditional=True))
+
+
+@app.route('/api/documents/<document_id>/thumbnail', methods=['GET'])
+async def get_document_thumbnail(document_id):
+    return await send_rendition(document_id, 'thumbnail')
+
+
+@app.route('/api/documents/<document_id>/preview', methods=['GET'])
+async def get_document_preview(document_id):
+    return await send_rendition(document_id, 'preview')
+
+
+async def send_rendition(document_id, name):
+    document, file_path = await document_upload(document_id)
+    if document is None:
+        return jsonify({'error': 'Document not found'}), 404
+
+    if file_path is None:
+        return jsonify({'error': f'{name.capitalize()} not found'}), 404
+
+    fmt = 'webp' if request.accept_mimetypes['image/webp'] else 'jpeg'
+    try:
+        rendition = await run_sync(ensure_rendition)(file_path, name, fmt)
+    except Exception as e:
+        return jsonify({'error': f'Could not render {name}: {e}'}), 500
+
+    response = cache_immutable(await send_file(rendition, mimetype=rendition_mimetype(fmt), conditional=True))
+    response.vary.add('Accept')
+    return response
+
+
+def serves(scope):
+    """True when the gateway implements the request's route itself"""
+    if scope['method'] == 'OPTIONS':
+        return False
+    try:
+        app.url_map.bind('').match(scope['path'], method=scope['method'])
+    except (NotFound, MethodNotAllowed, RequestRedirect):
+        return False
+    return True
+
+
+flask_app = AsyncioWSGIMiddleware(sync_app.app, max_body_size=GATEWAY_MAX_BODY_BYTES)
+
+
+async def application(scope, receive, send):
+    """ASGI entry point: gateway routes on the event loop, everything else on the Flask app"""
+    if scope['type'] == 'http' and not serves(scope):
+        await flask_app(scope, receive, send)
+    else:
+        await app(scope, receive, send)
@@ -0,0 +1,64 @@
+"""
+HTTP caching helpers for the document, image and diagram endpoints.
+
+Uploads, renditions and diagrams never change once written, so they are served
+with long-lived immutable Cache-Control headers and their metadata is kept in a
+small per-process LRU. Documents change only when they are reprocessed, which
+bumps their version. Their ETag is built from that version, so a repeat view
+costs one indexed single-field lookup and an empty 304.
+"""
+
+import threading
+from collections import OrderedDict
+
+# Uploads, thumbnails, previews and rendered diagrams are cached by clients for a year
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+class LRUCache:
+    """Thread-safe least-recently-used map for values that never go stale"""
+
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if not self.max_entries:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def document_etag(document_id, version):
+    return f"{document_id}-v{version}"
+
+
+def diagram_etag(diagram_id):
+    return f"diagram-{diagram_id}"
+
+
+def cache_immutable(response):
+    """Let clients and shared caches keep a response for a year without revalidating"""
+    response.cache_control.no_cache = None  # send_file defaults to no-cache
+    response.cache_control.public = True
+    response.cache_control.max_age = IMMUTABLE_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+
+def cache_revalidate(response, etag):
+    """Let clients keep a response but check its ETag before every reuse"""
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
@@ -0,0 +1,84 @@
+"""
+Index bootstrap and query-plan verification for the API database.
+
+ensure_indexes() creates (or confirms) every index the hot API queries rely on.
+verify_query_plans() asks MongoDB to explain those queries and raises if any of
+them would fall back to a full collection scan.
+"""
+
+import pymongo
+
+from search import TEXT_INDEX_WEIGHTS
+
+DOCUMENT_INDEXES = [
+    ([('id', pymongo.ASCENDING)], {'unique': True, 'name': 'id_unique'}),
+    ([('diagrams.id', pymongo.ASCENDING)], {'name': 'diagrams_id'}),
+    # Covers the version lookup behind document ETags, so a 304 never loads the document
+    ([('id', pymongo.ASCENDING), ('version', pymongo.ASCENDING)], {'name': 'id_version'}),
+    # Serves the newest-first listing and its (createdAt, id) cursor
+    ([('createdAt', pymongo.DESCENDING), ('id', pymongo.DESCENDING)], {'name': 'createdAt_id'}),
+    # Reference checks of the upload garbage collector
+    ([('upload.sha256', pymongo.ASCENDING)], {'name': 'upload_sha256'}),
+    # Inverted index behind /api/search
+    ([(field, pymongo.TEXT) for field in TEXT_INDEX_WEIGHTS],
+     {'name': 'fulltext', 'weights': TEXT_INDEX_WEIGHTS, 'default_language': 'english',
+      'language_override': 'searchLanguage'})
+]
+
+DIAGRAM_INDEXES = [
+    ([('id', pymongo.ASCENDING)], {'unique': True, 'name': 'id_unique'}),
+    ([('documentId', pymongo.ASCENDING), ('position', pymongo.ASCENDING)], {'name': 'documentId_position'})
+]
+
+
+class QueryPlanError(RuntimeError):
+    """Raised when a hot query is not served by an index"""
+
+
+def ensure_indexes(db):
+    """Create the indexes used by the API and check that they exist"""
+    for collection, indexes in ((db['documents'], DOCUMENT_INDEXES), (db['diagrams'], DIAGRAM_INDEXES)):
+        for keys, kwargs in indexes:
+            collection.create_index(keys, **kwargs)
+
+        existing = collection.index_information()
+        missing = [kwargs['name'] for _, kwargs in indexes if kwargs['name'] not in existing]
+        if missing:
+            raise QueryPlanError(f"Missing indexes on {collection.name}: {', '.join(missing)}")
+
+
+def hot_queries(db):
+    """(name, cursor) pairs for the queries that must never scan a whole collection"""
+    documents, diagrams = db['documents'], db['diagrams']
+    return [
+        ('document by id', documents.find({'id': ''})),
+        ('document by diagram id', documents.find({'diagrams.id': ''})),
+        ('document listing', documents.find({}).sort([('createdAt', pymongo.DESCENDING),
+                                                      ('id', pymongo.DESCENDING)]).limit(1)),
+        ('full-text search', documents.find({'$text': {'$search': 'invoice'}})),
+        ('documents by upload', documents.find({'upload.sha256': {'$in': ['']}})),
+        ('diagram by id', diagrams.find({'id': ''})),
+        ('diagrams of document', diagrams.find({'documentId': ''}).sort('position', pymongo.ASCENDING))
+    ]
+
+
+def _has_collscan(plan):
+    if isinstance(plan, dict):
+        if plan.get('stage') == 'COLLSCAN':
+            return True
+        return any(_has_collscan(value) for value in plan.values())
+    if isinstance(plan, list):
+        return any(_has_collscan(value) for value in plan)
+    return False
+
+
+def verify_query_plans(db):
+    """Explain every hot query and raise QueryPlanError if any would use a COLLSCAN"""
+    regressions = []
+    for name, cursor in hot_queries(db):
+        plan = cursor.explain().get('queryPlanner', {}).get('winningPlan', {})
+        if _has_collscan(plan):
+            regressions.append(name)
+
+    if regressions:
+        raise QueryPlanError(f"Queries regressed to COLLSCAN: {', '.join(regressions)}")
@@ -0,0 +1,206 @@
+"""
+Persistent OCR job queue for the API service.
+
+Jobs are stored in a MongoDB collection so they survive API restarts and can be
+drained by every API process. Each process runs a small pool of worker threads
+that atomically claim the oldest queued job, hand its payload to a handler and
+record the outcome together with queue/run timings.
+
+A claimed job is leased to its worker, which keeps renewing the lease while the
+handler runs. Jobs whose worker died are claimed again once the lease expires,
+up to max_attempts times, and then marked failed.
+"""
+
+import os
+import socket
+import threading
+import uuid
+from datetime import datetime, timedelta
+
+import pymongo
+from pymongo import ReturnDocument
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_DONE = 'done'
+JOB_FAILED = 'failed'
+
+
+class QueueFullError(Exception):
+    """Raised when the queue already holds the maximum number of pending jobs"""
+
+
+class JobQueue:
+    """MongoDB-backed job queue drained by a pool of worker threads"""
+
+    def __init__(self, collection, handler, workers=2, max_depth=100,
+                 lease_seconds=600, max_attempts=3, poll_interval=1.0):
+        self.collection = collection
+        self.handler = handler
+        self.workers = workers
+        self.max_depth = max_depth
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._wakeup = threading.Event()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def ensure_indexes(self):
+        self.collection.create_index([('id', pymongo.ASCENDING)], unique=True)
+        self.collection.create_index([('status', pymongo.ASCENDING), ('createdAt', pymongo.ASCENDING)])
+
+    def depth(self):
+        """Number of jobs waiting to be picked up"""
+        return self.collection.count_documents({'status': JOB_QUEUED})
+
+    def enqueue(self, payload):
+        """Persist a new job and return its ID, or raise QueueFullError
+
+        The depth is counted again after the insert, so enqueues racing from
+        several processes cannot push the queue past max_depth: a job that finds
+        the queue over the limit is withdrawn again (unless a worker already took it).
+        """
+        if self.depth() >= self.max_depth:
+            raise QueueFullError(f"Job queue is full ({self.max_depth} pending jobs)")
+
+        job_id = str(uuid.uuid4())
+        self.collection.insert_one({
+            'id': job_id,
+            'status': JOB_QUEUED,
+            'payload': payload,
+            'attempts': 0,
+            'createdAt': datetime.now(),
+            'startedAt': None,
+            'finishedAt': None,
+            'result': None,
+            'error': None
+        })
+        if self.depth() > self.max_depth and \
+                self.collection.delete_one({'id': job_id, 'status': JOB_QUEUED}).deleted_count:
+            raise QueueFullError(f"Job queue is full ({self.max_depth} pending jobs)")
+        self._wakeup.set()
+        return job_id
+
+    def get(self, job_id):
+        return self.collection.find_one({'id': job_id}, {'_id': 0})
+
+    def start(self):
+        """Start the worker threads for this process (idempotent)"""
+        with self._lock:
+            if self._threads or self.workers <= 0:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f"ocr-job-worker-{i}", daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _claim(self):
+        """Atomically move the oldest runnable job to the running state"""
+        now = datetime.now()
+        return self.collection.find_one_and_update(
+            {'$or': [
+                {'status': JOB_QUEUED},
+                # Jobs whose worker died mid-run are picked up again once the lease expires
+                {'status': JOB_RUNNING, 'leaseExpiresAt': {'$lt': now}, 'attempts': {'$lt': self.max_attempts}}
+            ]},
+            {
+                '$set': {
+                    'status': JOB_RUNNING,
+                    'startedAt': now,
+                    'leaseExpiresAt': now + timedelta(seconds=self.lease_seconds),
+                    'worker': self.worker_id
+                },
+                '$inc': {'attempts': 1}
+            },
+            sort=[('createdAt', pymongo.ASCENDING)],
+            return_document=ReturnDocument.AFTER
+        )
+
+    def _fail_abandoned(self):
+        """Fail jobs whose lease expired on their last allowed attempt"""
+        now = datetime.now()
+        self.collection.update_many(
+            {'status': JOB_RUNNING, 'leaseExpiresAt': {'$lt': now}, 'attempts': {'$gte': self.max_attempts}},
+            {'$set': {
+                'status': JOB_FAILED,
+                'error': f"Worker stopped responding ({self.max_attempts} attempts)",
+                'finishedAt': now
+            }}
+        )
+
+    def _work(self):
+        while True:
+            try:
+                job = self._claim()
+                if job is None:
+                    self._fail_abandoned()
+                else:
+                    self._run(job)
+                    continue
+            except pymongo.errors.PyMongoError:
+                pass
+
+            self._wakeup.wait(self.poll_interval)
+            self._wakeup.clear()
+
+    def _lease(self, job):
+        # attempts changes on every claim, so it identifies this run of the job
+        return {'id': job['id'], 'worker': self.worker_id, 'attempts': job['attempts']}
+
+    def _renew_lease(self, job, finished):
+        """Extend the job's lease every third of lease_seconds until finished is set"""
+        while not finished.wait(self.lease_seconds / 3):
+            try:
+                self.collection.update_one(
+                    dict(self._lease(job), status=JOB_RUNNING),
+                    {'$set': {'leaseExpiresAt': datetime.now() + timedelta(seconds=self.lease_seconds)}}
+                )
+            except pymongo.errors.PyMongoError:
+                continue
+
+    def _run(self, job):
+        finished = threading.Event()
+        threading.Thread(target=self._renew_lease, args=(job, finished), daemon=True).start()
+        update = {}
+        try:
+            update['result'] = self.handler(job['payload'])
+            update['status'] = JOB_DONE
+        except Exception as e:
+            update['error'] = str(e)
+            update['status'] = JOB_FAILED
+        finally:
+            finished.set()
+
+        update['finishedAt'] = datetime.now()
+        # A run that lost its lease to another worker must not overwrite that worker's outcome
+        self.collection.update_one(self._lease(job), {'$set': update})
+
+
+def serialize_job(job):
+    """Convert a stored job into its JSON status representation"""
+    created, started, finished = job['createdAt'], job.get('startedAt'), job.get('finishedAt')
+    timings = {
+        'queuedMs': None,
+        'runMs': None,
+        'totalMs': None
+    }
+    if started:
+        timings['queuedMs'] = round((started - created).total_seconds() * 1000)
+    if started and finished:
+        timings['runMs'] = round((finished - started).total_seconds() * 1000)
+        timings['totalMs'] = round((finished - created).total_seconds() * 1000)
+
+    return {
+        'jobId': job['id'],
+        'documentId': job.get('payload', {}).get('documentId'),
+        'status': job['status'],
+        'attempts': job.get('attempts', 0),
+        'createdAt': created.isoformat(),
+        'startedAt': started.isoformat() if started else None,
+        'finishedAt': finished.isoformat() if finished else None,
+        'timings': timings,
+        'result': job.get('result'),
+        'error': job.get('error')
+    }
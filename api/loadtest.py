@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+
+"""
+Load comparison of the API serving modes.
+
+Fires the same workload at several running API instances, e.g. the sync
+gunicorn mode and the async gateway (API_MODE=async), at increasing
+concurrency. Reports requests/sec, latency percentiles, rejected (429) and
+failed requests for each.
+
+Scenarios:
+    ocr    POST /api/ocr with the given file (includes the OCR engine round trip)
+    read   GET /api/documents, /api/documents/<id> and the thumbnail of one uploaded document
+
+Usage:
+    python loadtest.py sync=http://localhost:5000 async=http://localhost:5001 \\
+        --scenario read --concurrency 16,64,256 --requests 2000
+    python loadtest.py sync=http://localhost:5000 async=http://localhost:5001 \\
+        --scenario ocr --file ../samples/table.jpg --concurrency 8,32,128 --output loadtest.json
+"""
+
+import argparse
+import itertools
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+SAMPLE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'samples', 'table.jpg')
+
+_local = threading.local()
+
+
+def session():
+    # One keep-alive connection per client thread
+    if not hasattr(_local, 'session'):
+        _local.session = requests.Session()
+    return _local.session
+
+
+def percentiles(samples_ms):
+    ordered = sorted(samples_ms)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        'p50': round(pick(0.5), 1),
+        'p90': round(pick(0.9), 1),
+        'p99': round(pick(0.99), 1),
+        'mean': round(statistics.fmean(ordered), 1)
+    }
+
+
+def ocr_requests(base_url, data, filename):
+    def send():
+        return session().post(f"{base_url}/api/ocr", files={'file': (filename, data)}, timeout=600)
+    return itertools.repeat(send)
+
+
+def read_requests(base_url, data, filename):
+    # Upload one document to read back
+    response = requests.post(f"{base_url}/api/ocr", files={'file': (filename, data)}, timeout=600)
+    response.raise_for_status()
+    document_id = response.json()['documentId']
+    urls = (f"{base_url}/api/documents?limit=20",
+            f"{base_url}/api/documents/{document_id}",
+            f"{base_url}/api/documents/{document_id}/thumbnail")
+    return (lambda url=url: session().get(url, timeout=60) for url in itertools.cycle(urls))
+
+
+SCENARIOS = {
+    'ocr': ocr_requests,
+    'read': read_requests
+}
+
+
+def timed_request(send):
+    start = time.perf_counter()
+    try:
+        status = send().status_code
+    except requests.RequestException:
+        status = None
+    return status, (time.perf_counter() - start) * 1000
+
+
+def run_level(requests_iter, concurrency, total):
+    """Send total requests with concurrency in flight; return the summary"""
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(timed_request, itertools.islice(requests_iter, total)))
+        elapsed = time.perf_counter() - start
+
+    ok = [ms for status, ms in results if status is not None and status < 400]
+    summary = {
+        'concurrency': concurrency,
+        'requests': total,
+        'seconds': round(elapsed, 2),
+        'requestsPerSec': round(len(ok) / elapsed, 1),
+        'rejected': sum(1 for status, _ in results if status == 429),
+        'failed': sum(1 for status, _ in results if status is None or (status >= 400 and status != 429))
+    }
+    if ok:
+        summary['latencyMs'] = percentiles(ok)
+    return summary
+
+
+def print_summary(results):
+    print(f"{'target':<10} {'conc':>5} {'req/s':>8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'429':>6} {'fail':>6}")
+    for name, levels in results.items():
+        for level in levels:
+            latency = level.get('latencyMs', {})
+            print(f"{name:<10} {level['concurrency']:>5} {level['requestsPerSec']:>8} "
+                  f"{latency.get('p50', '-'):>9} {latency.get('p90', '-'):>9} {latency.get('p99', '-'):>9} "
+                  f"{level['rejected']:>6} {level['failed']:>6}")
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def target(value):
+    name, sep, url = value.partition('=')
+    if not sep or not url:
+        raise argparse.ArgumentTypeError('targets look like name=http://host:port')
+    return name, url.rstrip('/')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare API serving modes under concurrent load')
+    parser.add_argument('targets', nargs='+', type=target, help='name=base URL of each running API')
+    parser.add_argument('--scenario', choices=sorted(SCENARIOS), default='read')
+    parser.add_argument('--file', default=SAMPLE_FILE, help='Document to upload')
+    parser.add_argument('--concurrency', type=int_list, default=[16, 64, 256],
+                        help='Requests in flight, e.g. 16,64,256')
+    parser.add_argument('--requests', type=int, default=1000, help='Requests per concurrency level')
+    parser.add_argument('--output', help='Write the results as JSON')
+    args = parser.parse_args(argv)
+
+    with open(args.file, 'rb') as f:
+        data = f.read()
+    filename = os.path.basename(args.file)
+
+    results = {}
+    for name, base_url in args.targets:
+        requests_iter = SCENARIOS[args.scenario](base_url, data, filename)
+        results[name] = [run_level(requests_iter, concurrency, args.requests) for concurrency in args.concurrency]
+
+    print_summary(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'scenario': args.scenario, 'results': results}, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
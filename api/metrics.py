@@ -0,0 +1,143 @@
+"""
+Request timing for the API service.
+
+Most of an API request is spent waiting: on the OCR engine, on MongoDB, on
+rendition generation. Those waits are timed with `stage()` and reported per
+request in the `Server-Timing` header, with the engine's own entries folded in
+under an `engine-` prefix, so a slow upload can be traced to the engine
+pipeline stage without profiling the API process itself (the engine offers
+sampling profiles for that). Stages run by jobs and batches outside a request
+only feed the `ocr_api_stage_seconds` histogram.
+
+Both the Flask app (`init_app()`) and the async gateway (`init_async_app()`)
+are instrumented; `/metrics` is served by the Flask app. prometheus_client is
+optional; without it timings are only reported through Server-Timing.
+"""
+
+import contextvars
+import os
+import re
+import resource
+import time
+from contextlib import contextmanager
+
+from flask import Response, g, jsonify, request
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+SERVER_TIMING_ENTRY = re.compile(r'([\w-]+);dur=([\d.]+)')
+
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Histogram(
+        'ocr_api_stage_seconds', 'Time spent in each request stage', ['stage'], buckets=STAGE_BUCKETS)
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        'ocr_api_request_seconds', 'Request latency', ['endpoint', 'status'], buckets=STAGE_BUCKETS)
+    PEAK_RSS = prometheus_client.Gauge(
+        'ocr_api_peak_rss_bytes', 'Peak resident set size of the process', multiprocess_mode='max')
+
+_current = contextvars.ContextVar('api_request_stats', default=None)
+
+
+@contextmanager
+def stage(name):
+    """Time a request stage; also records stages run outside requests (jobs, batches)"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if prometheus_client is not None:
+            STAGE_SECONDS.labels(name).observe(elapsed)
+        stages = _current.get()
+        if stages is not None:
+            stages[name] = stages.get(name, 0.0) + elapsed
+
+
+def add_remote_timing(prefix, header):
+    """Fold another service's Server-Timing header into the current request's stages"""
+    stages = _current.get()
+    if stages is None or not header:
+        return
+    for name, duration in SERVER_TIMING_ENTRY.findall(header):
+        if name != 'total':
+            key = f"{prefix}-{name}"
+            stages[key] = stages.get(key, 0.0) + float(duration) / 1000
+
+
+def peak_rss_bytes():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def server_timing(stages, total):
+    """Server-Timing header value: one entry per stage plus the request total, in ms"""
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in stages.items()]
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ', '.join(entries)
+
+
+def _finish_request(response, endpoint, start, stages):
+    total = time.perf_counter() - start
+    if prometheus_client is not None and endpoint != 'metrics_endpoint':
+        REQUEST_SECONDS.labels(endpoint or 'unknown', str(response.status_code)).observe(total)
+        PEAK_RSS.set(peak_rss_bytes())
+    # Streamed responses are timed up to the first byte
+    response.headers['Server-Timing'] = server_timing(stages, total)
+    return response
+
+
+def init_app(app):
+    """Time every request of the Flask app and register GET /metrics"""
+
+    @app.before_request
+    def start_request_stats():
+        g.metrics_start = time.perf_counter()
+        g.metrics_stages = {}
+        g.metrics_token = _current.set(g.metrics_stages)
+
+    @app.after_request
+    def finish_request_stats(response):
+        if 'metrics_start' not in g:
+            return response
+        return _finish_request(response, request.endpoint, g.metrics_start, g.metrics_stages)
+
+    @app.teardown_request
+    def reset_request_stats(exc):
+        # Streamed responses tear the request down twice; only the first reset applies
+        token = g.pop('metrics_token', None)
+        if token is not None:
+            _current.reset(token)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        if prometheus_client is None:
+            return jsonify({'error': 'Metrics require the prometheus_client package'}), 501
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = prometheus_client.REGISTRY
+        return Response(prometheus_client.generate_latest(registry), mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def init_async_app(app):
+    """Time the routes of the async gateway (a Quart app); /metrics stays on the Flask app"""
+    from quart import g as async_g, request as async_request
+
+    @app.before_request
+    async def start_async_request_stats():
+        async_g.metrics_start = time.perf_counter()
+        async_g.metrics_stages = {}
+        _current.set(async_g.metrics_stages)
+
+    @app.after_request
+    async def finish_async_request_stats(response):
+        if not hasattr(async_g, 'metrics_start'):
+            return response
+        return _finish_request(response, async_request.endpoint, async_g.metrics_start, async_g.metrics_stages)
@@ -0,0 +1,111 @@
+"""
+Thumbnail and preview renditions of uploaded documents.
+
+Renditions are small WebP and JPEG derivatives stored next to the upload's
+blob (`<blob>.<name>.<ext>`), so documents sharing an upload share them too.
+They are generated once, either right after ingest or on first request, and are
+never modified afterwards so they can be served with long-lived cache headers.
+"""
+
+import os
+import tempfile
+
+from PIL import Image
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+# Rendition name -> longest edge in pixels
+RENDITIONS = {
+    'preview': 1024,
+    'thumbnail': 256
+}
+
+# Format name -> (Pillow format, file extension, MIME type)
+FORMATS = {
+    'webp': ('WEBP', 'webp', 'image/webp'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg')
+}
+
+QUALITY = 80
+
+
+def rendition_path(upload_path, name, fmt):
+    return f"{upload_path}.{name}.{FORMATS[fmt][1]}"
+
+
+def mimetype(fmt):
+    return FORMATS[fmt][2]
+
+
+def open_first_page(upload_path, max_size):
+    """Open the first page of an upload, decoding at reduced size where the format allows"""
+    with open(upload_path, 'rb') as f:
+        is_pdf = f.read(5) == b'%PDF-'
+
+    if is_pdf:
+        if pdfium is None:
+            raise ValueError('PDF renditions require the pypdfium2 package')
+        pdf = pdfium.PdfDocument(upload_path)
+        try:
+            page = pdf[0]
+            width, height = page.get_size()
+            scale = max_size / max(width, height)
+            return page.render(scale=scale).to_pil()
+        finally:
+            pdf.close()
+
+    image = Image.open(upload_path)
+    # JPEG can be decoded straight at 1/2, 1/4 or 1/8 scale, which avoids
+    # materializing a full-resolution bitmap for large scans
+    image.draft('RGB', (max_size, max_size))
+    return image
+
+
+def generate_renditions(upload_path):
+    """Create every missing rendition of an upload and return their paths"""
+    missing = [(name, fmt) for name in RENDITIONS for fmt in FORMATS
+               if not os.path.exists(rendition_path(upload_path, name, fmt))]
+    if not missing:
+        return []
+
+    image = open_first_page(upload_path, max(RENDITIONS.values()))
+    try:
+        image = image.convert('RGB')
+        created = []
+        # Largest rendition first so each smaller one is downscaled from the previous result
+        for name, size in sorted(RENDITIONS.items(), key=lambda item: -item[1]):
+            image.thumbnail((size, size), Image.LANCZOS)
+            for fmt, (pil_format, _, _) in FORMATS.items():
+                if (name, fmt) not in missing:
+                    continue
+                path = rendition_path(upload_path, name, fmt)
+                # Concurrent first requests may race; each writes its own temp file
+                fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+                with os.fdopen(fd, 'wb') as f:
+                    image.save(f, pil_format, quality=QUALITY)
+                os.replace(tmp_path, path)
+                created.append(path)
+        return created
+    finally:
+        image.close()
+
+
+def ensure_rendition(upload_path, name, fmt):
+    """Return the path of a rendition, generating it on first request"""
+    path = rendition_path(upload_path, name, fmt)
+    if not os.path.exists(path):
+        generate_renditions(upload_path)
+    return path
+
+
+def remove_renditions(upload_path):
+    """Delete every rendition of an upload"""
+    for name in RENDITIONS:
+        for fmt in FORMATS:
+            try:
+                os.remove(rendition_path(upload_path, name, fmt))
+            except OSError:
+                pass
@@ -0,0 +1,103 @@
+"""
+Full-text search over OCR output.
+
+MongoDB's text index is the inverted index: it covers the document text plus a
+derived `search` sub-document holding table cell contents and diagram labels,
+and is updated incrementally on every insert. This module builds those derived
+fields, parses queries and turns matches into highlight snippets that point
+back to the page (and, for tables, the bounding box) they came from.
+"""
+
+import re
+
+SNIPPET_RADIUS = 60
+MAX_HIGHLIGHTS = 5
+
+# Node labels in generated Mermaid code: A0[Label], participant Name, class Name
+MERMAID_LABEL_PATTERNS = [
+    re.compile(r'\[([^\]]+)\]'),
+    re.compile(r'^\s*participant\s+(.+)$', re.MULTILINE),
+    re.compile(r'^\s*class\s+(\w+)', re.MULTILINE)
+]
+
+TEXT_INDEX_WEIGHTS = {
+    'text': 5,
+    'search.tables': 3,
+    'search.diagrams': 2,
+    'filename': 10
+}
+
+
+def diagram_labels(diagram):
+    """Extract the human-readable labels from a diagram's Mermaid code"""
+    code = diagram.get('mermaidCode', '')
+    labels = []
+    for pattern in MERMAID_LABEL_PATTERNS:
+        labels.extend(label.strip() for label in pattern.findall(code))
+    return labels
+
+
+def search_fields(tables, diagrams):
+    """Derived fields indexed alongside the document text"""
+    return {
+        'tables': ' '.join(cell for table in tables for row in table.get('rows', []) for cell in row if cell),
+        'diagrams': ' '.join(label for diagram in diagrams for label in diagram_labels(diagram))
+    }
+
+
+def parse_query(query):
+    """Split a query into quoted phrases and loose terms"""
+    phrases = [p.strip() for p in re.findall(r'"([^"]+)"', query) if p.strip()]
+    terms = [t for t in re.findall(r'\w+', re.sub(r'"[^"]*"', ' ', query)) if len(t) > 1]
+    return terms, phrases
+
+
+def _match_patterns(terms, phrases):
+    patterns = [re.compile(re.escape(phrase).replace(r'\ ', r'\s+'), re.IGNORECASE) for phrase in phrases]
+    # Loose terms match as word prefixes, approximating the index's stemming
+    patterns.extend(re.compile(rf'\b{re.escape(term)}\w*', re.IGNORECASE) for term in terms)
+    return patterns
+
+
+def _snippet(text, start, end):
+    left = max(0, start - SNIPPET_RADIUS)
+    right = min(len(text), end + SNIPPET_RADIUS)
+    snippet = text[left:right]
+    return {
+        'text': ('...' if left > 0 else '') + snippet + ('...' if right < len(text) else ''),
+        # Offsets of the match inside the returned snippet text
+        'match': [start - left + (3 if left > 0 else 0), end - left + (3 if left > 0 else 0)]
+    }
+
+
+def build_highlights(document, terms, phrases):
+    """Snippets around the query matches, each referencing its page and bbox where known"""
+    patterns = _match_patterns(terms, phrases)
+    highlights = []
+
+    pages = document.get('pages') or [{'pageNumber': 1, 'text': document.get('text', '')}]
+    for page in pages:
+        text = page.get('text', '')
+        for pattern in patterns:
+            match = pattern.search(text)
+            if match:
+                highlight = _snippet(text, match.start(), match.end())
+                highlight.update({'source': 'text', 'page': page.get('pageNumber', 1), 'bbox': None})
+                highlights.append(highlight)
+                break
+        if len(highlights) >= MAX_HIGHLIGHTS:
+            return highlights
+
+    for table in document.get('tables', []):
+        cells = ' | '.join(' | '.join(row) for row in table.get('rows', []))
+        for pattern in patterns:
+            match = pattern.search(cells)
+            if match:
+                highlight = _snippet(cells, match.start(), match.end())
+                highlight.update({'source': 'table', 'page': table.get('page', 1), 'bbox': table.get('bbox')})
+                highlights.append(highlight)
+                break
+        if len(highlights) >= MAX_HIGHLIGHTS:
+            break
+
+    return highlights
@@ -0,0 +1,175 @@
+"""
+Document stores for the model-runner API.
+
+MemoryDocumentStore keeps documents in a dict index with least-recently-used
+eviction once a document count or size budget is exceeded. SQLiteDocumentStore
+keeps them in an embedded database in WAL mode, so documents survive restarts
+and readers never block the writer. Both stores look documents up by ID in
+constant time and list them newest first, one cursor-delimited page at a time.
+The cursor is the insertion sequence number of the last document returned.
+"""
+
+import bisect
+import json
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Fields returned by list_documents(); fetch a document for its text, tables and diagrams
+SUMMARY_FIELDS = ('id', 'filename', 'thumbnailUrl', 'hasTable', 'hasDiagram', 'createdAt', 'confidence')
+
+
+def summarize(document):
+    return {field: document.get(field) for field in SUMMARY_FIELDS}
+
+
+def parse_cursor(cursor):
+    """Sequence number encoded in a listing cursor; raises ValueError when malformed"""
+    if not cursor:
+        return None
+    if not cursor.isdigit():
+        raise ValueError('Invalid cursor')
+    return int(cursor)
+
+
+class MemoryDocumentStore:
+    """In-memory documents with LRU eviction by count and approximate JSON size"""
+
+    def __init__(self, max_documents=1000, max_bytes=256 * 1024 * 1024):
+        self.max_documents = max_documents
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._documents = OrderedDict()  # id -> (seq, document, size), least recently used first
+        self._ids = {}  # seq -> id
+        self._seqs = []  # Ascending; may hold sequence numbers of evicted documents
+        self._next_seq = 1
+        self._bytes = 0
+
+    def put(self, document):
+        size = len(json.dumps(document, default=str))
+        with self._lock:
+            if document['id'] in self._documents:
+                self._remove(document['id'])
+            seq = self._next_seq
+            self._next_seq += 1
+            self._documents[document['id']] = (seq, document, size)
+            self._ids[seq] = document['id']
+            self._seqs.append(seq)
+            self._bytes += size
+            self._evict(keep=document['id'])
+
+    def get(self, document_id):
+        with self._lock:
+            entry = self._documents.get(document_id)
+            if entry is None:
+                return None
+            self._documents.move_to_end(document_id)
+            return entry[1]
+
+    def list_documents(self, limit, cursor=None):
+        """Return (summaries newest first, next cursor or None)"""
+        before = parse_cursor(cursor)
+        with self._lock:
+            end = len(self._seqs) if before is None else bisect.bisect_left(self._seqs, before)
+            summaries, last = [], None
+            for index in range(end - 1, -1, -1):
+                document_id = self._ids.get(self._seqs[index])
+                if document_id is None:
+                    continue  # Evicted
+                if len(summaries) == limit:
+                    return summaries, str(last)
+                last = self._seqs[index]
+                summaries.append(summarize(self._documents[document_id][1]))
+        return summaries, None
+
+    def __len__(self):
+        return len(self._documents)
+
+    def _evict(self, keep):
+        while len(self._documents) > 1 and (
+                (self.max_documents and len(self._documents) > self.max_documents) or
+                (self.max_bytes and self._bytes > self.max_bytes)):
+            document_id = next(iter(self._documents))
+            if document_id == keep:
+                break
+            self._remove(document_id)
+
+    def _remove(self, document_id):
+        seq, _, size = self._documents.pop(document_id)
+        del self._ids[seq]
+        self._bytes -= size
+        # Drop evicted sequence numbers once they make up half of the index
+        if len(self._seqs) > 2 * len(self._ids) + 64:
+            self._seqs = [s for s in self._seqs if s in self._ids]
+
+
+class SQLiteDocumentStore:
+    """Documents persisted in an SQLite database in WAL mode; optionally capped to the newest max_documents"""
+
+    def __init__(self, path, max_documents=0):
+        self.max_documents = max_documents
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute('''CREATE TABLE IF NOT EXISTS documents (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            summary TEXT NOT NULL,
+            body TEXT NOT NULL
+        )''')
+        self._db.commit()
+
+    def put(self, document):
+        summary = json.dumps(summarize(document), default=str)
+        body = json.dumps(document, default=str)
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM documents WHERE id = ?', (document['id'],))
+            self._db.execute('INSERT INTO documents (id, summary, body) VALUES (?, ?, ?)',
+                             (document['id'], summary, body))
+            if self.max_documents:
+                self._db.execute('DELETE FROM documents WHERE seq <= '
+                                 '(SELECT seq FROM documents ORDER BY seq DESC LIMIT 1 OFFSET ?)',
+                                 (self.max_documents,))
+
+    def get(self, document_id):
+        with self._lock:
+            row = self._db.execute('SELECT body FROM documents WHERE id = ?', (document_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def list_documents(self, limit, cursor=None):
+        """Return (summaries newest first, next cursor or None)"""
+        before = parse_cursor(cursor)
+        query = 'SELECT seq, summary FROM documents'
+        params = []
+        if before is not None:
+            query += ' WHERE seq < ?'
+            params.append(before)
+        query += ' ORDER BY seq DESC LIMIT ?'
+        params.append(limit + 1)  # One extra row tells whether another page follows
+        with self._lock:
+            rows = self._db.execute(query, params).fetchall()
+
+        next_cursor = str(rows[limit - 1][0]) if len(rows) > limit else None
+        return [json.loads(summary) for _, summary in rows[:limit]], next_cursor
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM documents').fetchone()[0]
+
+
+def create_store(backend, path=None, max_documents=None, max_bytes=256 * 1024 * 1024):
+    """Build the store named by backend ('memory' or 'sqlite')
+
+    Without max_documents the memory store keeps 1000 documents and SQLite,
+    which is on disk, keeps every document.
+    """
+    if backend == 'memory':
+        return MemoryDocumentStore(1000 if max_documents is None else max_documents, max_bytes)
+    if backend == 'sqlite':
+        return SQLiteDocumentStore(path, max_documents or 0)
+    raise ValueError(f"Unknown document store: {backend}")
@@ -15,15 +15,24 @@ import axios from 'axios';
 
 const Gallery = () => {
   const [documents, setDocuments] = useState([]);
+  const [nextCursor, setNextCursor] = useState(null);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [searchTerm, setSearchTerm] = useState('');
   const [error, setError] = useState(null);
 
+  const fetchDocuments = async (cursor) => {
+    const response = await axios.get('http://localhost:5000/api/documents', {
+      params: cursor ? { cursor } : {}
+    });
+    setDocuments(previous => (cursor ? [...previous, ...response.data.documents] : response.data.documents));
+    setNextCursor(response.data.nextCursor);
+  };
+
   useEffect(() => {
-    const fetchDocuments = async () => {
+    const fetchFirstPage = async () => {
       try {
-        const response = await axios.get('http://localhost:5000/api/documents');
-        setDocuments(response.data);
+        await fetchDocuments(null);
       } catch (err) {
         setError('Failed to load documents. Please try again.');
         console.error(err);
@@ -32,16 +41,26 @@ const Gallery = () => {
       }
     };
 
-    fetchDocuments();
+    fetchFirstPage();
   }, []);
 
+  const handleLoadMore = async () => {
+    setLoadingMore(true);
+    try {
+      await fetchDocuments(nextCursor);
+    } catch (err) {
+      console.error(err);
+    } finally {
+      setLoadingMore(false);
+    }
+  };
+
   const handleSearchChange = (event) => {
     setSearchTerm(event.target.value);
   };
 
   const filteredDocuments = documents.filter(doc => 
-    doc.filename.toLowerCase().includes(searchTerm.toLowerCase()) ||
-    (doc.text && doc.text.toLowerCase().includes(searchTerm.toLowerCase()))
+    doc.filename.toLowerCase().includes(searchTerm.toLowerCase())
   );
 
   if (loading) {
@@ -78,11 +97,11 @@ const Gallery = () => {
             label="Search Documents"
             value={searchTerm}
             onChange={handleSearchChange}
-            placeholder="Search by filename or content..."
+            placeholder="Search by filename..."
           />
         </Box>
 
-        {filteredDocuments.length > 0 ? (
+        {filteredDocuments.length > 0 && (
           <Grid container spacing={4}>
             {filteredDocuments.map((doc) => (
               <Grid item xs={12} sm={6} md={4} key={doc.id}>
@@ -102,7 +121,9 @@ const Gallery = () => {
                         {new Date(doc.createdAt).toLocaleDateString()}
                       </Typography>
                       <Typography variant="body2" color="text.secondary" sx={{ mt: 1 }}>
-                        {doc.text ? `${doc.text.substring(0, 100)}...` : 'No text content'}
+                        {`Confidence: ${Math.round(doc.confidence || 0)}%`}
+                        {doc.hasTable ? ' · Tables' : ''}
+                        {doc.hasDiagram ? ' · Diagrams' : ''}
                       </Typography>
                     </CardContent>
                   </CardActionArea>
@@ -110,7 +131,17 @@ const Gallery = () => {
               </Grid>
             ))}
           </Grid>
-        ) : (
+        )}
+
+        {nextCursor && (
+          <Box sx={{ textAlign: 'center', mt: 4 }}>
+            <Button variant="outlined" onClick={handleLoadMore} disabled={loadingMore}>
+              {loadingMore ? 'Loading...' : 'Load More'}
+            </Button>
+          </Box>
+        )}
+
+        {filteredDocuments.length === 0 && (
           <Box sx={{ textAlign: 'center', py: 4 }}>
             <Typography variant="h6" color="text.secondary" gutterBottom>
               No documents found
@@ -5,21 +5,26 @@ Docker Model Runner API for OCR Application
 
 This script provides a simplified API for Docker Model Runner to interact with the OCR engine.
 It wraps the OCR engine functionality with a standard API interface compatible with model-runner.
+Run with image paths, directories or globs instead to OCR them offline into JSONL (see --help).
 """
 
 import os
 import sys
 import uuid
 import json
+import time
+import argparse
+import glob
+import itertools
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from datetime import datetime
 from flask import Flask, request, jsonify
 from flask_cors import CORS
 import pytesseract
-from PIL import Image
-import numpy as np
-import cv2
 import re
 
+from document_store import create_store
+
 app = Flask(__name__)
 CORS(app)
 
@@ -29,28 +34,107 @@ PROCESSED_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pro
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 os.makedirs(PROCESSED_FOLDER, exist_ok=True)
 
-# In-memory database for the model runner demo
+# Document store: a bounded in-memory LRU, or SQLite (WAL) to keep documents across restarts
 # In a real app, this would be MongoDB as in the full application
-DOCUMENTS_DB = []
+DOCUMENT_STORE = os.environ.get('DOCUMENT_STORE', 'memory')
+DOCUMENT_DB_PATH = os.environ.get('DOCUMENT_DB_PATH', os.path.join(PROCESSED_FOLDER, 'documents.db'))
+# Unset: 1000 for the memory store, unlimited for SQLite
+DOCUMENT_STORE_MAX_DOCUMENTS = os.environ.get('DOCUMENT_STORE_MAX_DOCUMENTS')
+DOCUMENT_STORE_MAX_BYTES = int(os.environ.get('DOCUMENT_STORE_MAX_BYTES', str(256 * 1024 * 1024)))
+DOCUMENTS_PAGE_SIZE = 50
+DOCUMENTS_MAX_PAGE_SIZE = 200
+
+documents_db = create_store(
+    DOCUMENT_STORE,
+    DOCUMENT_DB_PATH,
+    int(DOCUMENT_STORE_MAX_DOCUMENTS) if DOCUMENT_STORE_MAX_DOCUMENTS else None,
+    DOCUMENT_STORE_MAX_BYTES
+)
 
 # Import diagram pattern detection from OCR engine
 sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'ocr-engine'))
 try:
-    from app import detect_tables, detect_diagrams, calculate_confidence
+    from app import detect_tables, detect_diagrams
 except ImportError:
     # Fallback implementations if import fails
-    def detect_tables(img, thresh):
+    def detect_tables(img, thresh, word_data=None):
         return []
     
     def detect_diagrams(text):
         return []
+
+# Text, word boxes and confidence all come from one Tesseract pass
+import wordboxes
+
+# Grayscale decode, resolution normalization and in-place thresholding shared with the OCR engine
+from preprocess import binarize, decode_grayscale, start_memory_tracking, track_peak_memory
+# Language identification, so multi-language OCR only loads the languages a page is in
+from langid import choose_languages, identify_languages
+from layout import analyze_layout
+
+# Per-stage timings, as reported by the OCR engine
+from metrics import collect_stats, stage
+
+start_memory_tracking()
+
+def ocr_image(data, options):
+    """OCR an encoded image; returns the result with timings in ms, or None if it cannot be decoded"""
+    start = time.perf_counter()
+    with collect_stats() as stats, track_peak_memory() as memory:
+        # Decode straight to normalized grayscale and threshold it in place
+        with stage('decode'):
+            thresh = decode_grayscale(data)
+        if thresh is None:
+            return None
+        with stage('threshold'):
+            binarize(thresh)
+        
+        # Configure OCR parameters
+        config = '--psm 1'  # Automatic page segmentation with OSD
+        if options['detect_handwriting']:
+            config += ' --oem 1'  # LSTM only
+        
+        # Determine language
+        languages = ['eng']
+        if options['multi_language']:
+            with stage('langid'):
+                languages, _ = identify_languages(thresh, analyze_layout(thresh))
+        lang = '+'.join(languages)
+        
+        # Perform OCR: one pass yields the text, word boxes and word confidences
+        with stage('ocr'):
+            word_data = pytesseract.image_to_data(thresh, lang=lang, config=config, output_type=pytesseract.Output.DICT)
+            words = wordboxes.from_data(word_data)
+            text = wordboxes.to_text(words)
+        if len(languages) > 1:
+            languages = choose_languages(text, languages) or languages
+        
+        # Detect tables if required
+        tables = []
+        if options['detect_tables']:
+            with stage('tables'):
+                tables = detect_tables(thresh, thresh, word_data=word_data)
+        
+        # Detect diagrams if required
+        diagrams = []
+        if options['detect_diagrams']:
+            with stage('diagrams'):
+                diagrams = detect_diagrams(text)
+        
+        confidence = wordboxes.confidence([words])
     
-    def calculate_confidence(text):
-        if not text:
-            return 0
-        alpha_numeric = sum(c.isalnum() or c.isspace() for c in text)
-        total_length = len(text)
-        return (alpha_numeric / total_length) * 100 if total_length > 0 else 0
+    timings = {name: round(seconds * 1000, 1) for name, seconds in stats.stages.items()}
+    timings['total'] = round((time.perf_counter() - start) * 1000, 1)
+    return {
+        'text': text,
+        'tables': tables,
+        'diagrams': diagrams,
+        'words': words,
+        'confidence': confidence,
+        'languages': languages if text.strip() else [],
+        'peakMemoryBytes': memory['peakBytes'],
+        'timings': timings
+    }
 
 @app.route('/api/ocr', methods=['POST'])
 def process_document():
@@ -83,42 +167,12 @@ def process_document():
     
     # Process the image
     try:
-        # Open the image
-        image = Image.open(file_path)
-        
-        # Convert to OpenCV format for preprocessing
-        img_cv = np.array(image.convert('RGB'))
-        img_cv = cv2.cvtColor(img_cv, cv2.COLOR_RGB2BGR)
-        
-        # Apply preprocessing for better OCR results
-        gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-        thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
-        
-        # Configure OCR parameters
-        config = '--psm 1'  # Automatic page segmentation with OSD
-        if options['detect_handwriting']:
-            config += ' --oem 1'  # LSTM only
-        
-        # Determine language
-        lang = 'eng'
-        if options['multi_language']:
-            lang = 'eng+fra+deu+spa+ita'  # Add more languages as needed
-        
-        # Perform OCR
-        text = pytesseract.image_to_string(thresh, lang=lang, config=config)
-        
-        # Detect tables if required
-        tables = []
-        if options['detect_tables']:
-            tables = detect_tables(img_cv, thresh)
-        
-        # Detect diagrams if required
-        diagrams = []
-        if options['detect_diagrams']:
-            diagrams = detect_diagrams(text)
-        
-        # Calculate confidence
-        confidence = calculate_confidence(text)
+        with open(file_path, 'rb') as f:
+            ocr_result = ocr_image(f.read(), options)
+        if ocr_result is None:
+            return jsonify({'error': 'Unsupported image format'}), 400
+        text, tables, diagrams = ocr_result['text'], ocr_result['tables'], ocr_result['diagrams']
+        confidence = ocr_result['confidence']
         
         # Store document in our in-memory database
         document_data = {
@@ -132,10 +186,13 @@ def process_document():
             'imageUrl': f"/api/documents/{document_id}/image",
             'thumbnailUrl': f"/api/documents/{document_id}/thumbnail",
             'createdAt': datetime.now().isoformat(),
-            'confidence': confidence
+            'confidence': confidence,
+            'words': ocr_result['words'],
+            'languages': ocr_result['languages'],
+            'peakMemoryBytes': ocr_result['peakMemoryBytes']
         }
         
-        DOCUMENTS_DB.append(document_data)
+        documents_db.put(document_data)
         
         # Prepare the response in Docker Model Runner compatible format
         result = {
@@ -144,6 +201,7 @@ def process_document():
             'confidence': confidence,
             'hasTable': len(tables) > 0,
             'hasDiagram': len(diagrams) > 0,
+            'peakMemoryBytes': ocr_result['peakMemoryBytes'],
             'success': True
         }
         
@@ -155,23 +213,160 @@ def process_document():
 @app.route('/api/documents', methods=['GET'])
 def get_documents():
     """
-    List all processed documents
+    List processed documents newest first, one cursor-delimited page at a time
     """
-    return jsonify(DOCUMENTS_DB)
+    try:
+        limit = min(int(request.args.get('limit', DOCUMENTS_PAGE_SIZE)), DOCUMENTS_MAX_PAGE_SIZE)
+        if limit < 1:
+            raise ValueError('limit must be positive')
+        documents, next_cursor = documents_db.list_documents(limit, request.args.get('cursor'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    return jsonify({'documents': documents, 'nextCursor': next_cursor})
 
 @app.route('/api/documents/<document_id>', methods=['GET'])
 def get_document(document_id):
     """
     Get a specific document by ID
     """
-    for doc in DOCUMENTS_DB:
-        if doc['id'] == document_id:
-            return jsonify(doc)
+    doc = documents_db.get(document_id)
+    if doc is None:
+        return jsonify({'error': 'Document not found'}), 404
     
-    return jsonify({'error': 'Document not found'}), 404
+    return jsonify(doc)
+
+# Batch command-line interface: OCR many images across a process pool, one JSONL record per document
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.tif', '.tiff', '.bmp', '.gif', '.webp')
+
+def is_single_image_args(args):
+    """True for the original `model-runner-api.py image.jpg` form, which prints a readable report"""
+    return len(args) == 1 and args[0] != '-' and not args[0].startswith('-') and \
+        not os.path.isdir(args[0]) and not glob.has_magic(args[0])
+
+def iter_image_paths(sources):
+    """Expand files, directories (recursively), globs and '-' (paths on stdin) into unique absolute paths"""
+    seen = set()
+    
+    def expand(source):
+        if source == '-':
+            for line in sys.stdin:
+                if line.strip():
+                    yield from expand(line.strip())
+        elif os.path.isdir(source):
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                for name in sorted(files):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        yield os.path.join(root, name)
+        elif glob.has_magic(source):
+            for path in sorted(glob.glob(source, recursive=True)):
+                if os.path.isfile(path):
+                    yield path
+        else:
+            yield source
+    
+    for source in sources:
+        for path in expand(source):
+            path = os.path.abspath(path)
+            if path not in seen:
+                seen.add(path)
+                yield path
+
+def completed_paths(output_path):
+    """Paths already processed successfully in a previous (possibly interrupted) run's output"""
+    done = set()
+    if not os.path.exists(output_path):
+        return done
+    with open(output_path, 'rb+') as f:
+        data = f.read()
+        # A run killed mid-write leaves a partial last line; drop it so appended records stay valid
+        end = data.rfind(b'\n') + 1
+        if end < len(data):
+            f.truncate(end)
+    for line in data[:end].splitlines():
+        try:
+            record = json.loads(line)
+        except ValueError:
+            continue
+        if record.get('status') == 'done':
+            done.add(record['path'])
+    return done
+
+def ocr_path(path, options):
+    """Pool worker: OCR one file into a JSONL record"""
+    record = {'path': path, 'filename': os.path.basename(path)}
+    try:
+        with open(path, 'rb') as f:
+            result = ocr_image(f.read(), options)
+        if result is None:
+            raise ValueError('Unsupported image format')
+    except Exception as e:
+        return dict(record, status='failed', error=str(e))
+    result['hasTable'] = len(result['tables']) > 0
+    result['hasDiagram'] = len(result['diagrams']) > 0
+    return dict(record, status='done', error=None, **result)
+
+def run_batch_cli(argv):
+    parser = argparse.ArgumentParser(
+        prog='model-runner-api.py',
+        description='OCR images in parallel and write one JSON record per document (JSONL)')
+    parser.add_argument('paths', nargs='+', help="Image files, directories, globs, or '-' to read paths from stdin")
+    parser.add_argument('-o', '--output', help='JSONL output file (default: stdout)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count() or 1, help='Worker processes (default: CPU count)')
+    parser.add_argument('--resume', action='store_true', help='Skip documents already recorded as done in --output and append to it')
+    parser.add_argument('--no-tables', action='store_true', help='Disable table detection')
+    parser.add_argument('--no-diagrams', action='store_true', help='Disable diagram detection')
+    parser.add_argument('--handwriting', action='store_true', help='Use the LSTM engine for handwriting')
+    parser.add_argument('--multi-language', action='store_true', help='Detect and OCR languages other than English')
+    args = parser.parse_args(argv)
+    if args.resume and not args.output:
+        parser.error('--resume requires --output')
+    
+    options = {
+        'detect_tables': not args.no_tables,
+        'detect_handwriting': args.handwriting,
+        'multi_language': args.multi_language,
+        'preserve_formatting': True,
+        'detect_diagrams': not args.no_diagrams
+    }
+    skip = completed_paths(args.output) if args.resume else set()
+    paths = (path for path in iter_image_paths(args.paths) if path not in skip)
+    
+    # Each worker runs one Tesseract process at a time; keep its OpenMP threads from competing
+    os.environ.setdefault('OMP_THREAD_LIMIT', '1')
+    out = open(args.output, 'a' if args.resume else 'w') if args.output else sys.stdout
+    done = failed = 0
+    start = time.perf_counter()
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            # Keep a bounded number of documents queued so huge inputs are never listed up front
+            window = max(1, args.workers) * 2
+            in_flight = set()
+            for path in itertools.chain(paths, [None]):
+                if path is not None:
+                    in_flight.add(executor.submit(ocr_path, path, options))
+                while in_flight and (path is None or len(in_flight) >= window):
+                    finished, in_flight = wait(in_flight, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        record = future.result()
+                        out.write(json.dumps(record, default=str) + '\n')
+                        out.flush()
+                        if record['status'] == 'done':
+                            done += 1
+                        else:
+                            failed += 1
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    
+    elapsed = time.perf_counter() - start
+    print(f"Processed {done + failed} documents ({failed} failed, {len(skip)} skipped) in {elapsed:.1f}s",
+          file=sys.stderr)
+    return 1 if failed else 0
 
 # Command-line interface for direct script execution with image path
-if __name__ == '__main__' and len(sys.argv) > 1:
+if __name__ == '__main__' and len(sys.argv) > 1 and is_single_image_args(sys.argv[1:]):
     image_path = sys.argv[1]
     if not os.path.exists(image_path):
         print(f"Error: File not found at {image_path}")
@@ -179,19 +374,23 @@ if __name__ == '__main__' and len(sys.argv) > 1:
     
     try:
         # Process the image directly
-        image = Image.open(image_path)
-        img_cv = np.array(image.convert('RGB'))
-        img_cv = cv2.cvtColor(img_cv, cv2.COLOR_RGB2BGR)
-        gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-        thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
-        
-        # Perform OCR
-        text = pytesseract.image_to_string(thresh)
-        confidence = calculate_confidence(text)
+        with track_peak_memory() as memory:
+            with open(image_path, 'rb') as f:
+                thresh = decode_grayscale(f.read())
+            if thresh is None:
+                raise ValueError('Unsupported image format')
+            binarize(thresh)
+            
+            # Perform OCR
+            words = wordboxes.from_data(pytesseract.image_to_data(thresh, output_type=pytesseract.Output.DICT))
+            text = wordboxes.to_text(words)
+        confidence = wordboxes.confidence([words])
         
         # Print results to stdout
         print(f"OCR Processing Results:\n")
         print(f"Confidence: {confidence:.2f}%\n")
+        if memory['peakBytes'] is not None:
+            print(f"Peak memory: {memory['peakBytes'] / (1024 * 1024):.1f} MB\n")
         print(f"Extracted Text:\n{text}")
         
         # Detect diagrams
@@ -205,6 +404,10 @@ if __name__ == '__main__' and len(sys.argv) > 1:
         print(f"Error processing image: {str(e)}")
         sys.exit(1)
 
+# Batch mode for directories, globs, several files or stdin
+elif __name__ == '__main__' and len(sys.argv) > 1:
+    sys.exit(run_batch_cli(sys.argv[1:]))
+
 # Standard web server when run without arguments
 elif __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000, debug=True)
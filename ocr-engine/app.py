@@ -2,18 +2,52 @@ import os
 import uuid
 from flask import Flask, request, jsonify
 from flask_cors import CORS
-import pytesseract
-from PIL import Image
-import numpy as np
-import cv2
 import re
+import bisect
+import collections
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from html import escape
+
+import engine_pool
+import tiling
+import wordboxes
+from artifacts import ArtifactStore, PageArtifacts, StaleArtifactsError, region_key
+from cache import ResultCache, image_digest, make_key
+from langid import choose_languages, identify_languages
+from layout import PageLayout, analyze_layout
+from pages import iter_pages
+from preprocess import binarize, start_memory_tracking, track_peak_memory
+import metrics
+from metrics import stage
 
 app = Flask(__name__)
 CORS(app)
+metrics.init_app(app)
 
 # Configuration
-UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+# Bump whenever a pipeline change alters OCR output so stale cache entries are ignored
+PIPELINE_VERSION = '8'
+
+# Result cache: in-memory LRU plus an optional on-disk tier shared across restarts
+OCR_CACHE_MAX_BYTES = int(os.environ.get('OCR_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+OCR_CACHE_DIR = os.environ.get('OCR_CACHE_DIR', '')
+OCR_CACHE_DISK_MAX_BYTES = int(os.environ.get('OCR_CACHE_DISK_MAX_BYTES', str(1024 * 1024 * 1024)))
+result_cache = ResultCache(OCR_CACHE_MAX_BYTES, OCR_CACHE_DIR, OCR_CACHE_DISK_MAX_BYTES)
+
+# Per-page intermediate artifacts (thresholded image, layout, OCR text, tables) for POST /reprocess
+OCR_ARTIFACT_DIR = os.environ.get('OCR_ARTIFACT_DIR', '')
+OCR_ARTIFACT_MAX_BYTES = int(os.environ.get('OCR_ARTIFACT_MAX_BYTES', str(4 * 1024 * 1024 * 1024)))
+artifact_store = ArtifactStore(OCR_ARTIFACT_DIR, OCR_ARTIFACT_MAX_BYTES) if OCR_ARTIFACT_DIR else None
+
+# Multi-page documents are OCR'd in parallel across a process pool created on first use;
+# with 1 they are OCR'd in the serving process. gunicorn.conf.py splits the CPUs between workers
+PAGE_WORKERS = int(os.environ.get('PAGE_WORKERS', str(os.cpu_count() or 1)))
+page_executor = None
+
+# With OCR_TRACK_MEMORY=true, trace allocations so every request can report its peak memory
+start_memory_tracking()
 
 # Diagram patterns for detection
 DIAGRAM_PATTERNS = {
@@ -36,145 +70,453 @@ def process_image():
         return jsonify({'error': 'No selected file'}), 400
     
     # Get OCR options from request
-    options = {
-        'detect_tables': request.form.get('detectTables', 'true').lower() == 'true',
-        'detect_handwriting': request.form.get('detectHandwriting', 'true').lower() == 'true',
-        'multi_language': request.form.get('multiLanguage', 'false').lower() == 'true',
-        'preserve_formatting': request.form.get('preserveFormatting', 'true').lower() == 'true',
-        'detect_diagrams': request.form.get('detectDiagrams', 'true').lower() == 'true'
-    }
+    options = parse_options(request.form)
     
-    # Save uploaded file
-    file_path = os.path.join(UPLOAD_FOLDER, file.filename)
-    file.save(file_path)
+    # Identical uploads with identical options are served from the result cache
+    data = file.read()
+    digest = image_digest(data)
+    with stage('cache'):
+        cache_key = make_key(digest, options, PIPELINE_VERSION)
+        cached = result_cache.get(cache_key)
+    if cached is not None:
+        response = jsonify(refresh_ids(cached))
+        response.headers['X-Cache'] = 'HIT'
+        return response
     
-    # Process the image
+    # Process the image straight from the in-memory upload
     try:
-        # Open the image
-        image = Image.open(file_path)
-        
-        # Convert to OpenCV format for preprocessing
-        img_cv = np.array(image.convert('RGB'))
-        img_cv = cv2.cvtColor(img_cv, cv2.COLOR_RGB2BGR)
-        
-        # Apply preprocessing for better OCR results
-        gray = cv2.cvtColor(img_cv, cv2.COLOR_BGR2GRAY)
-        thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)[1]
-        
-        # Configure OCR parameters
-        config = '--psm 1'  # Automatic page segmentation with OSD
-        if options['detect_handwriting']:
-            config += ' --oem 1'  # LSTM only
-        
-        # Determine language
-        lang = 'eng'
+        with track_peak_memory() as memory:
+            result = run_pipeline(data, options, digest)
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    
+    return pipeline_response(result, cache_key, memory, file.filename)
+
+@app.route('/reprocess', methods=['POST'])
+def reprocess_image():
+    """Re-run only the out-of-date stages of a previously processed document, by content hash"""
+    digest = request.form.get('contentHash', '')
+    if not re.fullmatch(r'[0-9a-f]{64}', digest):
+        return jsonify({'error': 'Invalid contentHash'}), 400
+    if artifact_store is None:
+        return jsonify({'error': 'Artifacts are not enabled (set OCR_ARTIFACT_DIR)'}), 404
+    
+    options = parse_options(request.form)
+    cache_key = make_key(digest, options, PIPELINE_VERSION)
+    try:
+        with track_peak_memory() as memory:
+            result = reprocess_pipeline(digest, options)
+    except StaleArtifactsError as e:
+        return jsonify({'error': f"{e}; process the document again"}), 409
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+    if result is None:
+        return jsonify({'error': 'No artifacts for this document'}), 404
+    
+    return pipeline_response(result, cache_key, memory, digest)
+
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    return jsonify(result_cache.stats())
+
+def parse_options(form):
+    """Read the OCR option flags from a submitted form"""
+    return {
+        'detect_tables': form.get('detectTables', 'true').lower() == 'true',
+        'detect_handwriting': form.get('detectHandwriting', 'true').lower() == 'true',
+        'multi_language': form.get('multiLanguage', 'false').lower() == 'true',
+        'preserve_formatting': form.get('preserveFormatting', 'true').lower() == 'true',
+        'detect_diagrams': form.get('detectDiagrams', 'true').lower() == 'true'
+    }
+
+def pipeline_response(result, cache_key, memory, name):
+    """Cache a fresh pipeline result and build its response"""
+    # Pages OCR'd in the page pool report their own peak; the request peak is the largest
+    worker_peak = result.pop('peakMemoryBytes', None)
+    
+    with stage('cache'):
+        result_cache.put(cache_key, result)
+    
+    response = jsonify(result)
+    response.headers['X-Cache'] = 'MISS'
+    if memory['peakBytes'] is not None:
+        peak = max(memory['peakBytes'], worker_peak or 0)
+        response.headers['X-Peak-Memory-Bytes'] = str(peak)
+        metrics.observe_peak_memory(peak)
+        app.logger.info('Processed %s with peak memory %d bytes', name, peak)
+    return response
+
+def run_pipeline(data, options, digest=None):
+    """Run preprocessing, OCR, table and diagram detection on every page of an uploaded document
+    
+    With an artifact store, each page's intermediate results are saved under the
+    document's digest so it can later be re-processed without decoding it again.
+    """
+    digest = digest or image_digest(data)
+    pages = metrics.timed_iter(iter_pages(data), 'decode')
+    jobs = ((page, PageArtifacts(artifact_store, digest, number))
+            for number, page in enumerate(pages, start=1))
+    return finish_pipeline(digest, run_pages(jobs, options), options)
+
+def reprocess_pipeline(digest, options):
+    """Re-process a document from its saved artifacts; None when there are none"""
+    manifest = artifact_store.load(digest)
+    if manifest is None:
+        return None
+    jobs = (artifact_store.page(digest, number, record)
+            for number, record in enumerate(manifest['pages'], start=1))
+    return finish_pipeline(digest, run_pages(((None, page) for page in jobs), options), options)
+
+def run_pages(jobs, options):
+    """Process (page image, PageArtifacts) jobs, in parallel when there is more than one page"""
+    first = next(jobs, None)
+    if first is None:
+        raise ValueError('Document has no pages')
+    second = next(jobs, None)
+    
+    if second is None:
+        # Single image: no need to pay for inter-process transfer
+        page, artifacts = first
+        page_results = [process_page(page, options, artifacts)]
+    elif PAGE_WORKERS <= 1:
+        page_results = [process_page(page, options, artifacts)
+                        for page, artifacts in itertools.chain([first, second], jobs)]
+    else:
+        page_results = process_pages_parallel(itertools.chain([first, second], jobs), options)
+    
+    # Stage timings of pages OCR'd in the page pool are added to this request's totals
+    stats = metrics.current_stats()
+    for page_result in page_results:
+        worker_stats = page_result.pop('stats', None)
+        if worker_stats and stats is not None:
+            stats.merge(worker_stats)
+    return page_results
+
+def finish_pipeline(digest, page_results, options):
+    """Save page artifacts and merge page results into the document result"""
+    records = [page_result.pop('artifacts') for page_result in page_results]
+    if artifact_store is not None:
+        # Artifacts only speed up re-processing; a failed save must not fail the OCR
+        try:
+            with stage('artifacts'):
+                artifact_store.save(digest, records)
+        except OSError as e:
+            app.logger.warning('Could not save artifacts for %s: %s', digest, e)
+    
+    result = merge_page_results(page_results, options)
+    result['contentHash'] = digest
+    peaks = [r['peakMemoryBytes'] for r in page_results if r.get('peakMemoryBytes') is not None]
+    if peaks:
+        result['peakMemoryBytes'] = max(peaks)
+    return result
+
+def process_pages_parallel(jobs, options):
+    """OCR pages across the page process pool, keeping only a bounded window in flight"""
+    executor = get_page_executor()
+    window = PAGE_WORKERS * 2
+    in_flight = collections.deque()
+    results = []
+    
+    for page, artifacts in jobs:
+        in_flight.append(executor.submit(process_page_tracked, page, options, artifacts))
+        # Wait for the oldest page before decoding more, so results stay in page order
+        # and the number of decoded pages held in memory is bounded
+        if len(in_flight) >= window:
+            results.append(in_flight.popleft().result())
+    
+    while in_flight:
+        results.append(in_flight.popleft().result())
+    
+    return results
+
+def get_page_executor():
+    global page_executor
+    if page_executor is None:
+        page_executor = ProcessPoolExecutor(max_workers=PAGE_WORKERS)
+    return page_executor
+
+def read_regions(image, boxes, lang='eng', oem=3):
+    """OCR the boxes of a thresholded page into compact word boxes, in parallel tiles when the page is very large"""
+    if not tiling.needs_tiling(image.shape):
+        data = engine_pool.image_regions_to_data(image, boxes, lang=lang, oem=oem)
+    else:
+        data = tiling.image_regions_to_data(image, boxes, lang=lang, oem=oem, executor=tile_executor())
+    return [wordboxes.from_data(region_data) for region_data in data]
+
+def tile_executor():
+    """Pool for the tiles of a large page; None inside the page pool, whose pages are already parallel"""
+    if PAGE_WORKERS <= 1 or multiprocessing.parent_process() is not None:
+        return None
+    return get_page_executor()
+
+def process_page_tracked(page, options, artifacts=None):
+    """process_page for the page pool, reporting the worker's peak memory and stage timings"""
+    with metrics.collect_stats(deferred=True) as stats, track_peak_memory() as memory:
+        result = process_page(page, options, artifacts)
+    result['peakMemoryBytes'] = memory['peakBytes']
+    result['stats'] = stats.as_dict()
+    return result
+
+def process_page(page, options, artifacts=None):
+    """Run preprocessing, OCR, table and diagram detection on one grayscale page image
+    
+    Stage outputs are recorded in artifacts (a PageArtifacts). With page=None the
+    page is re-processed from previously saved artifacts instead: stages whose
+    output is still current are reused and only the others run again.
+    """
+    if artifacts is None:
+        artifacts = PageArtifacts()
+    if page is not None:
+        height, width = page.shape
+        artifacts.record.update(width=int(width), height=int(height))
+    width, height = artifacts.record['width'], artifacts.record['height']
+    metrics.observe_page(width, height)
+    
+    # Binarize in place: the grayscale page is not needed once it is thresholded
+    if page is not None:
+        with stage('threshold'):
+            artifacts.put_threshold(binarize(page))
+    
+    # Configure OCR parameters
+    oem = 3  # Default engine mode
+    if options['detect_handwriting']:
+        oem = 1  # LSTM only
+    # OCR output (and table cell text) depends on the engine mode and language selection
+    ocr_key = f"{'multi' if options['multi_language'] else 'eng'}:{oem}"
+    
+    # One layout pass drives OCR, table and diagram detection
+    if artifacts.fresh('layout'):
+        layout = PageLayout.from_dict(artifacts.get('layout'))
+    else:
+        with stage('layout'):
+            layout = analyze_layout(artifacts.threshold())
+        artifacts.put('layout', **layout.to_dict())
+    
+    # Determine language: multi-language pages are identified first and OCR'd with only the languages found
+    ocr_fresh = artifacts.fresh('ocr', ocr_key)
+    if ocr_fresh:
+        languages, region_words = artifacts.get('ocr')['languages'], dict(artifacts.get('ocr')['words'])
+    else:
+        languages, region_words = ['eng'], {}
         if options['multi_language']:
-            lang = 'eng+fra+deu+spa+ita'  # Add more languages as needed
-        
-        # Perform OCR
-        text = pytesseract.image_to_string(thresh, lang=lang, config=config)
+            with stage('langid'):
+                languages, sampled = identify_languages(artifacts.threshold(), layout, oem=oem)
+            region_words = {region_key(bbox): wordboxes.from_data(data) for bbox, data in sampled.items()}
+    lang = '+'.join(languages)
+    
+    # Detect tables if required
+    tables = []
+    if options['detect_tables']:
+        if artifacts.fresh('tables', ocr_key):
+            tables = [dict(table, id=str(uuid.uuid4())) for table in artifacts.get('tables')['tables']]
+        else:
+            with stage('tables'):
+                tables = detect_tables(None, artifacts.threshold(), layout=layout, lang=lang, oem=oem)
+            artifacts.put('tables', ocr_key, tables=[dict(table) for table in tables])
+    
+    # Perform OCR on text regions only; detected tables contribute their cell text instead
+    with stage('ocr'):
+        table_text = {region_key(table['bbox']): table_to_text(table) for table in tables}
+        # Table cell words were read with the table; they join the page words in reading order
+        table_words = {region_key(table['bbox']): table.pop('words', None) or wordboxes.empty() for table in tables}
+        diagram_regions = layout.diagram_regions()
         
-        # Detect tables if required
-        tables = []
-        if options['detect_tables']:
-            tables = detect_tables(img_cv, thresh)
+        # Text blocks and diagram node labels not read before are read in one batch
+        boxes = [r['bbox'] for r in layout.reading_order() if region_key(r['bbox']) not in table_text]
+        boxes += [node for region in diagram_regions for node in region['nodes']]
+        unread = [bbox for bbox in boxes if region_key(bbox) not in region_words]
+        if unread:
+            read = read_regions(artifacts.threshold(), unread, lang=lang, oem=oem)
+            region_words.update((region_key(bbox), words) for bbox, words in zip(unread, read))
+        if unread or not ocr_fresh:
+            artifacts.put('ocr', ocr_key, languages=languages, words=region_words)
         
-        # Detect diagrams if required
-        diagrams = []
-        if options['detect_diagrams']:
-            diagrams = detect_diagrams(text)
+        blocks = []
+        for region in layout.reading_order(include_diagrams=True):
+            key = region_key(region['bbox'])
+            if region.get('nodes'):
+                node_words = [region_words[region_key(node)] for node in region['nodes']]
+                region['labels'] = [clean_label(wordboxes.to_text(words)) for words in node_words]
+                region['text'] = '\n'.join(filter(None, region['labels']))
+                blocks.extend(node_words)
+            elif key in table_text:
+                region['text'] = table_text[key]
+                blocks.append(table_words[key])
+            else:
+                region['text'] = wordboxes.to_text(region_words[key]).strip()
+                blocks.append(region_words[key])
         
-        # Prepare the response
-        result = {
-            'text': text,
-            'tables': tables,
-            'diagrams': diagrams,
-            'pageCount': 1,  # For multi-page documents, this would be calculated
-            'languages': [lang.split('+')[0]],  # Primary language
-            'confidence': calculate_confidence(text)
-        }
+        text = '\n\n'.join(r['text'] for r in layout.reading_order(include_diagrams=True) if r['text'])
+        words = wordboxes.concat(blocks)
+    
+    # Detect diagrams if required: drawn flowcharts first, then diagrams described in the text
+    diagrams = []
+    if options['detect_diagrams']:
+        with stage('diagrams'):
+            diagrams = diagrams_from_layout(diagram_regions) or detect_diagrams(text)
+    
+    # Report the languages the text is actually in; blank pages have none
+    if not text.strip():
+        languages = []
+    elif len(languages) > 1:
+        languages = choose_languages(text, languages) or languages
+    
+    return {
+        'text': text,
+        'tables': tables,
+        'diagrams': diagrams,
+        'languages': languages,
+        'words': words,
+        'confidence': wordboxes.confidence([words]),
+        'width': int(width),
+        'height': int(height),
+        'artifacts': artifacts.record
+    }
+
+def merge_page_results(page_results, options):
+    """Combine per-page results, in page order, into one document result"""
+    pages = []
+    tables = []
+    diagrams = []
+    languages = []
+    
+    for number, page in enumerate(page_results, start=1):
+        for table in page['tables']:
+            table['page'] = number
+        for diagram in page['diagrams']:
+            diagram['page'] = number
+        tables.extend(page['tables'])
+        diagrams.extend(page['diagrams'])
+        languages.extend(lang for lang in page['languages'] if lang not in languages)
         
-        return jsonify(result)
+        # Pages reference their tables and diagrams by ID to avoid storing them twice
+        pages.append({
+            'pageNumber': number,
+            'text': page['text'],
+            'tables': [table['id'] for table in page['tables']],
+            'diagrams': [diagram['id'] for diagram in page['diagrams']],
+            'languages': page['languages'],
+            'confidence': page['confidence'],
+            'width': page['width'],
+            'height': page['height'],
+            'words': page['words']
+        })
     
-    except Exception as e:
-        return jsonify({'error': str(e)}), 500
+    # Document confidence is the mean word confidence over every page
+    confidence = wordboxes.confidence(page['words'] for page in page_results)
+    
+    # Prepare the response
+    return {
+        'text': '\n\n'.join(page['text'] for page in page_results),
+        'tables': tables,
+        'diagrams': diagrams,
+        'pages': pages,
+        'pageCount': len(pages),
+        'languages': languages,
+        'confidence': confidence
+    }
 
-def detect_tables(img, thresh):
-    """Detect tables in the image and return structured data"""
-    # This is a simplified table detection algorithm
-    # In a real application, you would use more advanced techniques
+def refresh_ids(result):
+    """Give tables and diagrams of a cached result fresh IDs so documents never share them"""
+    new_ids = {}
+    for item in result.get('tables', []) + result.get('diagrams', []):
+        new_ids[item['id']] = str(uuid.uuid4())
+        item['id'] = new_ids[item['id']]
+    for page in result.get('pages', []):
+        page['tables'] = [new_ids.get(i, i) for i in page['tables']]
+        page['diagrams'] = [new_ids.get(i, i) for i in page['diagrams']]
+    return result
+
+def detect_tables(img, thresh, word_data=None, layout=None, lang='eng', oem=3):
+    """Detect ruled tables in the image and return structured data
     
-    # Find contours in the thresholded image
-    contours, hierarchy = cv2.findContours(thresh, cv2.RETR_TREE, cv2.CHAIN_APPROX_SIMPLE)
+    Table regions come from the page layout (analyze_layout() is run when no
+    layout is given). Cell text comes from word boxes: either a full-page pass
+    passed in as word_data (pytesseract's Output.DICT layout), or one pass over
+    each table region, so text outside tables is never read twice. Words read
+    by a table's own pass are returned with it under 'words', in the compact
+    page layout of wordboxes.
+    """
+    if layout is None:
+        layout = analyze_layout(thresh)
     
     tables = []
-    for i, contour in enumerate(contours):
-        # Filter contours based on area and aspect ratio
-        area = cv2.contourArea(contour)
-        if area < 10000:  # Minimum area threshold
-            continue
+    for region in layout.table_regions():
+        x, y, w, h = region['bbox']
+        table_words = None
+        if word_data is None and tiling.needs_tiling((h, w)):
+            # Very large tables (drawing schedules, posters) are read in parallel tiles
+            data, = tiling.image_regions_to_data(thresh, [region['bbox']], lang=lang, oem=oem, executor=tile_executor())
+            table_words = wordboxes.from_data(data)
+        elif word_data is None:
+            data = engine_pool.image_to_data(thresh[y:y+h, x:x+w], lang=lang, oem=oem)
+            table_words = wordboxes.from_data(data, x, y)
+        if table_words is not None:
+            rows = fill_table_cells(wordboxes.to_data(table_words), x, y, region['rows'], region['cols'])
+        else:
+            rows = fill_table_cells(word_data, x, y, region['rows'], region['cols'])
+        table_html = table_rows_to_html(rows)
         
-        # Get bounding rectangle
-        x, y, w, h = cv2.boundingRect(contour)
-        aspect_ratio = w / h
-        
-        # Tables usually have an aspect ratio close to 1 or wider
-        if 0.5 <= aspect_ratio <= 5:
-            # Extract the potential table region
-            table_region = thresh[y:y+h, x:x+w]
-            
-            # Apply OCR with table structure detection
-            table_data = pytesseract.image_to_data(table_region, output_type=pytesseract.Output.DICT)
-            
-            # Process table data and convert to HTML format
-            table_html = convert_table_data_to_html(table_data)
-            
-            if table_html:  # If a valid table was detected
-                table_id = str(uuid.uuid4())
-                tables.append({
-                    'id': table_id,
-                    'html': table_html,
-                    'bbox': [x, y, w, h]
-                })
+        if table_html:  # If a valid table was detected
+            table_id = str(uuid.uuid4())
+            table = {
+                'id': table_id,
+                'html': table_html,
+                'rows': rows,
+                'bbox': [x, y, w, h]
+            }
+            if table_words is not None:
+                table['words'] = table_words
+            tables.append(table)
     
     return tables
 
-def convert_table_data_to_html(table_data):
-    """Convert OCR table data to HTML format"""
-    # This is a simplified version - in a real app, you'd implement more robust table structure detection
-    
-    # Group text by lines
-    lines = {}
-    for i in range(len(table_data['text'])):
-        if int(table_data['conf'][i]) > 0:  # Filter out low confidence results
-            line_num = table_data['block_num'][i]
-            if line_num not in lines:
-                lines[line_num] = []
-            lines[line_num].append(table_data['text'][i])
-    
-    # If we have at least 2 lines, assume it's a table
-    if len(lines) >= 2:
-        html = '<table border="1" cellpadding="3" cellspacing="0">'
-        
-        # First line is header
-        html += '<thead><tr>'
-        for cell in lines[min(lines.keys())]:
-            html += f'<th>{cell}</th>'
-        html += '</tr></thead>'
-        
-        # Remaining lines are data
-        html += '<tbody>'
-        for line_num in sorted(lines.keys())[1:]:
-            html += '<tr>'
-            for cell in lines[line_num]:
-                html += f'<td>{cell}</td>'
-            html += '</tr>'
-        html += '</tbody>'
+def table_to_text(table):
+    """Plain-text rendering of a table for the page text, one line per row"""
+    return '\n'.join(' '.join(cell for cell in row if cell) for row in table['rows']).strip()
+
+def fill_table_cells(word_data, x, y, row_lines, col_lines):
+    """Assign recognised words to the grid cells of a table at (x, y)"""
+    rows = [['' for _ in range(len(col_lines) - 1)] for _ in range(len(row_lines) - 1)]
+    
+    for i in range(len(word_data['text'])):
+        word = word_data['text'][i].strip()
+        if not word or float(word_data['conf'][i]) <= 0:  # Filter out low confidence results
+            continue
         
-        html += '</table>'
-        return html
+        # Place each word by its centre, relative to the table origin
+        cx = word_data['left'][i] + word_data['width'][i] / 2 - x
+        cy = word_data['top'][i] + word_data['height'][i] / 2 - y
+        row = bisect.bisect_right(row_lines, cy) - 1
+        col = bisect.bisect_right(col_lines, cx) - 1
+        if 0 <= row < len(rows) and 0 <= col < len(rows[row]):
+            rows[row][col] = f"{rows[row][col]} {word}" if rows[row][col] else word
     
-    return None
+    return rows
+
+def table_rows_to_html(rows):
+    """Convert table cell rows to HTML format"""
+    # Need a header and at least one data row with some content
+    if len(rows) < 2 or not any(cell for row in rows for cell in row):
+        return None
+    
+    html_parts = ['<table border="1" cellpadding="3" cellspacing="0">']
+    
+    # First line is header
+    html_parts.append('<thead><tr>')
+    html_parts.extend(f'<th>{escape(cell)}</th>' for cell in rows[0])
+    html_parts.append('</tr></thead>')
+    
+    # Remaining lines are data
+    html_parts.append('<tbody>')
+    for row in rows[1:]:
+        html_parts.append('<tr>')
+        html_parts.extend(f'<td>{escape(cell)}</td>' for cell in row)
+        html_parts.append('</tr>')
+    html_parts.append('</tbody>')
+    
+    html_parts.append('</table>')
+    return ''.join(html_parts)
 
 def detect_diagrams(text):
     """Detect potential diagrams in the text and generate Mermaid.js code"""
@@ -255,19 +597,33 @@ def generate_mermaid_diagram(text, diagram_type):
     
     return None
 
-def calculate_confidence(text):
-    """Calculate a simple confidence score for the OCR result"""
-    if not text:
-        return 0
-    
-    # Calculate the ratio of alphanumeric characters to total length
-    alpha_numeric = sum(c.isalnum() or c.isspace() for c in text)
-    total_length = len(text)
+def clean_label(text):
+    """Collapse OCR'd node text into a single-line diagram label"""
+    return ' '.join(text.split())
+
+def diagrams_from_layout(diagram_regions):
+    """Generate Mermaid.js flowcharts from diagram figures found by the layout pass
     
-    if total_length == 0:
-        return 0
+    Nodes are the closed shapes of the figure, labelled with their OCR'd text,
+    and edges are the connectors drawn between them.
+    """
+    diagrams = []
+    for region in diagram_regions:
+        mermaid_code = "flowchart TD\n"
+        for i, label in enumerate(region['labels']):
+            label = (label or f"Node {i + 1}").replace('"', "'")
+            mermaid_code += f'    N{i}["{label}"]\n'
+        for source, target in region['edges']:
+            mermaid_code += f"    N{source} --> N{target}\n"
+        
+        diagrams.append({
+            'id': str(uuid.uuid4()),
+            'type': 'flowchart',
+            'mermaidCode': mermaid_code,
+            'bbox': region['bbox']
+        })
     
-    return (alpha_numeric / total_length) * 100
+    return diagrams
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=6000, debug=True)
@@ -0,0 +1,266 @@
+"""
+Per-document intermediate artifacts for incremental re-processing.
+
+When OCR_ARTIFACT_DIR is set, the engine keeps three intermediate results for
+every page of a processed document:
+
+- the thresholded image, bit-packed and compressed
+- the layout regions
+- the word boxes of each region, and the detected tables
+
+They are stored under the SHA-256 of the upload. Every stage output carries
+the stage's version from STAGE_VERSIONS and a key for the options it depends
+on. POST /reprocess therefore reruns only the stages that are missing, out of
+date, or downstream of a stage that was rerun. Enabling table detection after
+upload, or upgrading a detector, then costs a fraction of a full re-OCR.
+
+Bump a stage's version whenever its output changes. The threshold stage cannot
+be rerun without the original upload; a document whose threshold artifact is
+stale has to be processed again from scratch.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+
+import numpy as np
+
+STAGE_VERSIONS = {
+    'threshold': '1',
+    'layout': '1',
+    'ocr': '2',
+    'tables': '2'
+}
+
+# Stages whose output each stage is computed from
+STAGE_INPUTS = {
+    'threshold': (),
+    'layout': ('threshold',),
+    'ocr': ('threshold', 'layout'),
+    'tables': ('threshold', 'layout')
+}
+
+MANIFEST = 'manifest.json'
+
+
+class StaleArtifactsError(Exception):
+    """Raised when a page cannot be re-processed because its thresholded image is missing or out of date"""
+
+
+def region_key(bbox):
+    """JSON object key for a region's [x, y, w, h] bounding box"""
+    return ','.join(str(int(v)) for v in bbox)
+
+
+class PageArtifacts:
+    """Stage outputs of one page, with version stamps
+
+    record is JSON-serializable: {'width', 'height', 'stages': {stage: {'version', 'key', ...}}}.
+    Without a store, artifacts only live for the duration of the request.
+    """
+
+    def __init__(self, store=None, digest=None, number=1, record=None):
+        self.store = store
+        self.digest = digest
+        self.number = number
+        self.record = record or {'stages': {}}
+        self.recomputed = set()
+        self._image = None
+
+    def fresh(self, stage, key=''):
+        """True when the stored output of stage can be reused"""
+        entry = self.record['stages'].get(stage)
+        if entry is None or entry.get('version') != STAGE_VERSIONS[stage] or entry.get('key', '') != key:
+            return False
+        return not any(upstream in self.recomputed for upstream in STAGE_INPUTS[stage])
+
+    def get(self, stage):
+        return self.record['stages'][stage]
+
+    def put(self, stage, key='', **data):
+        self.record['stages'][stage] = dict(data, version=STAGE_VERSIONS[stage], key=key)
+        self.recomputed.add(stage)
+
+    def threshold(self):
+        """The thresholded page image, loaded from the store on first use"""
+        if self._image is None:
+            if self.store is None or not self.fresh('threshold'):
+                raise StaleArtifactsError('Thresholded page is missing or out of date')
+            self._image = self.store.load_image(self.digest, self.number)
+            if self._image is None:
+                raise StaleArtifactsError('Thresholded page is missing')
+        return self._image
+
+    def put_threshold(self, image):
+        self._image = image
+        if self.store is not None:
+            self.store.save_image(self.digest, self.number, image)
+        self.put('threshold')
+
+    def __getstate__(self):
+        # Page pool workers load the image themselves instead of receiving it pickled
+        state = self.__dict__.copy()
+        state['_image'] = None
+        return state
+
+
+class ArtifactStore:
+    """Artifacts on disk, one directory per document digest, evicted least recently used first"""
+
+    def __init__(self, directory, max_bytes=None):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._bytes = None
+        # Last size accounted for each document directory, so re-saves only add the difference
+        self._sizes = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def __getstate__(self):
+        # Stores travel to page pool workers with their pages; locks cannot be pickled
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    def document_dir(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def page(self, digest, number, record=None):
+        return PageArtifacts(self, digest, number, record)
+
+    def load(self, digest):
+        """The document's manifest ({'pages': [record, ...]}), or None"""
+        path = os.path.join(self.document_dir(digest), MANIFEST)
+        try:
+            with open(path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+        # Touch the manifest so eviction is least-recently-used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return manifest
+
+    def save(self, digest, records):
+        """Write the manifest for a document's page records"""
+        directory = self.document_dir(digest)
+        os.makedirs(directory, exist_ok=True)
+        self._write(os.path.join(directory, MANIFEST), json.dumps({'pages': records}).encode('utf-8'))
+        self._account(directory)
+
+    def save_image(self, digest, number, image):
+        directory = self.document_dir(digest)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"page-{number}.npz")
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        except OSError:
+            return  # Evicted by another worker since it was created
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                # Thresholded pages are 0/255: one bit per pixel
+                np.savez_compressed(f, bits=np.packbits(image > 127), shape=np.array(image.shape))
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def load_image(self, digest, number):
+        path = os.path.join(self.document_dir(digest), f"page-{number}.npz")
+        try:
+            with np.load(path) as data:
+                height, width = (int(v) for v in data['shape'])
+                bits = np.unpackbits(data['bits'], count=height * width)
+        except (OSError, ValueError, KeyError):
+            return None
+        return bits.reshape(height, width) * np.uint8(255)
+
+    def _write(self, path, payload):
+        # Write to a temp file first so concurrent readers never see a partial manifest
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        except OSError:
+            return  # Evicted by another worker since it was created
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def _account(self, directory):
+        if not self.max_bytes:
+            return
+        size = _dir_size(directory)
+        with self._lock:
+            if self._bytes is not None:
+                self._bytes += size - self._sizes.get(directory, 0)
+            self._sizes[directory] = size
+            over_budget = self._bytes is None or self._bytes > self.max_bytes
+        # Only walk the artifact directory when the running total says we may be over budget
+        if over_budget:
+            self._evict()
+
+    def _evict(self):
+        # Other workers evict from the same directory, so anything may vanish while it is walked
+        documents = []
+        total = 0
+        for prefix in _listdir(self.directory):
+            prefix_dir = os.path.join(self.directory, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for digest in _listdir(prefix_dir):
+                directory = os.path.join(prefix_dir, digest)
+                try:
+                    used = os.stat(os.path.join(directory, MANIFEST)).st_mtime
+                except OSError:
+                    # Still being processed, or orphaned by a failed request
+                    try:
+                        used = os.stat(directory).st_mtime
+                    except OSError:
+                        continue
+                size = _dir_size(directory)
+                documents.append((used, size, directory))
+                total += size
+
+        # Drop the least recently used documents until we are back under 90% of the budget
+        kept = {directory: size for _, size, directory in documents}
+        if total > self.max_bytes:
+            target = self.max_bytes * 0.9
+            for _, size, directory in sorted(documents):
+                if total <= target:
+                    break
+                shutil.rmtree(directory, ignore_errors=True)
+                del kept[directory]
+                total -= size
+
+        with self._lock:
+            self._bytes = total
+            self._sizes = kept
+
+
+def _listdir(directory):
+    try:
+        return os.listdir(directory)
+    except OSError:
+        return []
+
+
+def _dir_size(directory):
+    total = 0
+    for name in _listdir(directory):
+        try:
+            total += os.stat(os.path.join(directory, name)).st_size
+        except OSError:
+            continue
+    return total
+
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+
+"""
+Reproducible benchmark suite for the OCR pipeline.
+
+Runs the full `run_pipeline` path used by POST /process and each of its stages
+(preprocess, layout, detect_tables, OCR of the remaining text regions,
+detect_diagrams, wordboxes.confidence) over the images in samples/ plus
+deterministic synthetic A4 pages rendered at several resolutions and an A1
+drawing large enough to be OCR'd in tiles. Reports latency percentiles per
+stage, pages/sec with 1..N worker processes, peak traced memory and
+Tesseract call counts.
+
+Usage:
+    python benchmark.py run --output baseline.json
+    python benchmark.py run --output current.json --compare baseline.json
+    python benchmark.py compare baseline.json current.json --threshold 0.15
+
+Comparison exits with status 1 when any latency grows (or throughput drops) by
+more than the threshold, so it can gate CI.
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import app as engine
+import engine_pool
+import metrics
+import tiling
+import wordboxes
+from artifacts import region_key
+from layout import analyze_layout
+from pages import iter_pages
+from preprocess import binarize, start_memory_tracking, track_peak_memory
+
+SAMPLES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'samples')
+SAMPLE_FILES = ('flowchart.jpg', 'handwriting.jpg', 'table.jpg')
+
+SYNTHETIC_DPIS = (150, 300, 600)
+A4_INCHES = (8.27, 11.69)
+
+# The poster case is large enough to be OCR'd in tiles
+POSTER_DPI = 300
+A1_INCHES = (23.39, 33.11)
+
+DEFAULT_OPTIONS = {
+    'detect_tables': True,
+    'detect_handwriting': True,
+    'multi_language': False,
+    'preserve_formatting': True,
+    'detect_diagrams': True
+}
+
+STAGES = ('pipeline', 'preprocess', 'layout', 'ocr', 'tables', 'diagrams', 'confidence')
+
+# Latencies below this are dominated by timer noise and never flagged
+MIN_COMPARABLE_MS = 1.0
+
+SYNTHETIC_TEXT = [
+    'Flowchart: Start -> Validate input -> Process -> End',
+    'The quick brown fox jumps over the lazy dog 0123456789.',
+    'Invoices are matched against purchase orders before payment.',
+    'Sequence diagram: Client -> API -> OCR Engine -> Database'
+]
+
+SYNTHETIC_TABLE = [
+    ['Item', 'Qty', 'Price'],
+    ['Widget', '4', '12.50'],
+    ['Gadget', '10', '3.99'],
+    ['Gizmo', '1', '149.00']
+]
+
+
+def synthetic_page(dpi):
+    """Deterministic A4 page with text lines, a ruled table and flowchart labels, as PNG bytes"""
+    width, height = int(A4_INCHES[0] * dpi), int(A4_INCHES[1] * dpi)
+    page = np.full((height, width), 255, np.uint8)
+    scale = dpi / 100
+    margin = int(0.75 * dpi)
+    line_height = int(0.35 * dpi)
+
+    y = margin
+    for paragraph in range(3):
+        for line in SYNTHETIC_TEXT:
+            cv2.putText(page, line, (margin, y), cv2.FONT_HERSHEY_SIMPLEX, 0.5 * scale, 0, max(1, int(scale)))
+            y += line_height
+        y += line_height
+
+    # Ruled table
+    cell_w, cell_h = int(1.8 * dpi), int(0.4 * dpi)
+    top = y
+    for r, row in enumerate(SYNTHETIC_TABLE):
+        for c, cell in enumerate(row):
+            x0, y0 = margin + c * cell_w, top + r * cell_h
+            cv2.rectangle(page, (x0, y0), (x0 + cell_w, y0 + cell_h), 0, max(1, int(scale)))
+            cv2.putText(page, cell, (x0 + int(0.1 * dpi), y0 + int(0.27 * dpi)),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.5 * scale, 0, max(1, int(scale)))
+
+    buffer = io.BytesIO()
+    Image.fromarray(page).save(buffer, 'PNG', dpi=(dpi, dpi))
+    return buffer.getvalue()
+
+
+def synthetic_poster(dpi):
+    """Deterministic A1 drawing: a grid of boxes with small labels spread over the sheet, as PNG bytes"""
+    width, height = int(A1_INCHES[0] * dpi), int(A1_INCHES[1] * dpi)
+    page = np.full((height, width), 255, np.uint8)
+    scale = dpi / 100
+    cell_w, cell_h = width // 6, height // 10
+    for r in range(10):
+        for c in range(6):
+            x0, y0 = c * cell_w, r * cell_h
+            cv2.rectangle(page, (x0 + cell_w // 8, y0 + cell_h // 4), (x0 + cell_w * 7 // 8, y0 + cell_h * 3 // 4),
+                          0, max(1, int(scale)))
+            label = SYNTHETIC_TEXT[(r * 6 + c) % len(SYNTHETIC_TEXT)][:24]
+            cv2.putText(page, label, (x0 + cell_w // 8, y0 + cell_h // 5), cv2.FONT_HERSHEY_SIMPLEX,
+                        0.4 * scale, 0, max(1, int(scale)))
+
+    buffer = io.BytesIO()
+    Image.fromarray(page).save(buffer, 'PNG', dpi=(dpi, dpi))
+    return buffer.getvalue()
+
+
+def load_corpus(samples_dir, dpis, poster=True):
+    """(name, bytes) cases: decodable sample images first, then synthetic pages and the tiled poster"""
+    corpus = []
+    for name in SAMPLE_FILES:
+        path = os.path.join(samples_dir, name)
+        if not os.path.exists(path):
+            continue
+        with open(path, 'rb') as f:
+            data = f.read()
+        if cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE) is None:
+            print(f"Skipping {name}: not a decodable image", file=sys.stderr)
+            continue
+        corpus.append((name, data))
+
+    for dpi in dpis:
+        corpus.append((f"synthetic-a4-{dpi}dpi", synthetic_page(dpi)))
+    if poster:
+        corpus.append((f"synthetic-a1-{POSTER_DPI}dpi", synthetic_poster(POSTER_DPI)))
+    return corpus
+
+
+def percentiles(samples_ms):
+    ordered = sorted(samples_ms)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        'p50': round(pick(0.5), 3),
+        'p90': round(pick(0.9), 3),
+        'p99': round(pick(0.99), 3),
+        'mean': round(statistics.fmean(ordered), 3),
+        'min': round(ordered[0], 3),
+        'max': round(ordered[-1], 3)
+    }
+
+
+def timed(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def bench_case(data, options, iterations):
+    """Time the full pipeline and each stage for one input, after one warm-up run"""
+    timings = {stage: [] for stage in STAGES}
+    tesseract_calls = peak_memory = None
+    size = None
+
+    for iteration in range(iterations + 1):
+        with metrics.collect_stats() as stats, track_peak_memory() as memory:
+            _, pipeline_ms = timed(engine.run_pipeline, data, options)
+
+        page, preprocess_ms = timed(lambda: binarize(next(iter_pages(data))))
+        layout, layout_ms = timed(analyze_layout, page)
+        # Same regions as process_page: detected tables are read by detect_tables, not again by OCR
+        tables, tables_ms = timed(lambda: engine.detect_tables(None, page, layout=layout))
+        table_boxes = {region_key(table['bbox']) for table in tables}
+        boxes = [region['bbox'] for region in layout.reading_order() if region_key(region['bbox']) not in table_boxes]
+        boxes += [node for region in layout.diagram_regions() for node in region['nodes']]
+        words, ocr_ms = timed(engine.read_regions, page, boxes)
+        text = '\n\n'.join(wordboxes.to_text(region_words) for region_words in words)
+        _, diagrams_ms = timed(engine.detect_diagrams, text)
+        _, confidence_ms = timed(wordboxes.confidence, words)
+
+        if iteration == 0:
+            continue  # Warm-up: loads models, fills allocator pools
+        stage_ms = (pipeline_ms, preprocess_ms, layout_ms, ocr_ms, tables_ms, diagrams_ms, confidence_ms)
+        for stage, elapsed in zip(STAGES, stage_ms):
+            timings[stage].append(elapsed)
+        tesseract_calls = stats.tesseract_calls
+        peak_memory = max(peak_memory or 0, memory['peakBytes'] or 0)
+        size = [int(page.shape[1]), int(page.shape[0])]
+
+    return {
+        'pageSize': size,
+        'tiled': tiling.needs_tiling((size[1], size[0])),
+        'tesseractCalls': tesseract_calls,
+        'peakMemoryBytes': peak_memory,
+        'latencyMs': {stage: percentiles(samples) for stage, samples in timings.items()}
+    }
+
+
+def _process_document(args):
+    data, options = args
+    return len(engine.run_pipeline(data, options)['pages'])
+
+
+def bench_throughput(corpus, options, workers, rounds):
+    """Pages per second when documents are OCR'd by a pool of worker processes"""
+    jobs = [(data, options) for _ in range(rounds) for _, data in corpus]
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(_process_document, jobs[:workers]))  # Warm up every worker
+        start = time.perf_counter()
+        pages = sum(executor.map(_process_document, jobs))
+        elapsed = time.perf_counter() - start
+    return round(pages / elapsed, 3)
+
+
+def environment():
+    try:
+        tesseract_version = str(engine_pool.pytesseract.get_tesseract_version())
+    except Exception:
+        tesseract_version = None
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpuCount': os.cpu_count(),
+        'opencv': cv2.__version__,
+        'tesseract': tesseract_version,
+        'tesserocr': engine_pool.available(),
+        'pipelineVersion': engine.PIPELINE_VERSION
+    }
+
+
+def run(args):
+    # Page-level parallelism inside a document would skew per-document latency
+    engine.PAGE_WORKERS = 1
+    engine_pool.warm()
+    start_memory_tracking(force=True)
+
+    corpus = load_corpus(args.samples, args.dpi, poster=not args.no_poster)
+    if not corpus:
+        print('No benchmark inputs', file=sys.stderr)
+        return 2
+
+    results = {
+        'createdAt': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'environment': environment(),
+        'iterations': args.iterations,
+        'cases': {},
+        'throughput': {}
+    }
+
+    for name, data in corpus:
+        print(f"Benchmarking {name} ...", file=sys.stderr)
+        results['cases'][name] = bench_case(data, DEFAULT_OPTIONS, args.iterations)
+
+    for workers in args.workers:
+        print(f"Measuring throughput with {workers} worker(s) ...", file=sys.stderr)
+        results['throughput'][str(workers)] = bench_throughput(corpus, DEFAULT_OPTIONS, workers, args.rounds)
+
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print_summary(results)
+
+    if args.compare:
+        with open(args.compare) as f:
+            return report_regressions(json.load(f), results, args.threshold)
+    return 0
+
+
+def print_summary(results):
+    print(f"{'case':28} {'stage':11} {'p50 ms':>10} {'p90 ms':>10} {'p99 ms':>10}")
+    for name, case in results['cases'].items():
+        for stage, latency in case['latencyMs'].items():
+            print(f"{name:28} {stage:11} {latency['p50']:10.1f} {latency['p90']:10.1f} {latency['p99']:10.1f}")
+        print(f"{name:28} tesseract calls: {case['tesseractCalls']}, peak memory: "
+              f"{(case['peakMemoryBytes'] or 0) / (1024 * 1024):.1f} MB, page: {case['pageSize']}"
+              f"{' (tiled)' if case.get('tiled') else ''}")
+    for workers, pages_per_second in results['throughput'].items():
+        print(f"throughput with {workers} worker(s): {pages_per_second} pages/sec")
+
+
+def find_regressions(baseline, current, threshold):
+    """Human-readable descriptions of every metric that regressed by more than threshold"""
+    regressions = []
+    for name, case in current['cases'].items():
+        base_case = baseline['cases'].get(name)
+        if base_case is None:
+            continue
+        for stage, latency in case['latencyMs'].items():
+            before = base_case['latencyMs'].get(stage, {}).get('p50')
+            after = latency['p50']
+            if before is None or max(before, after) < MIN_COMPARABLE_MS:
+                continue
+            if after > before * (1 + threshold):
+                regressions.append(f"{name} {stage} p50: {before:.1f} ms -> {after:.1f} ms "
+                                   f"(+{(after / before - 1) * 100:.0f}%)")
+        if base_case.get('tesseractCalls') is not None and case['tesseractCalls'] > base_case['tesseractCalls']:
+            regressions.append(f"{name} tesseract calls: {base_case['tesseractCalls']} -> {case['tesseractCalls']}")
+        before_mem, after_mem = base_case.get('peakMemoryBytes'), case.get('peakMemoryBytes')
+        if before_mem and after_mem and after_mem > before_mem * (1 + threshold):
+            regressions.append(f"{name} peak memory: {before_mem} -> {after_mem} bytes")
+
+    for workers, after in current['throughput'].items():
+        before = baseline['throughput'].get(workers)
+        if before and after < before * (1 - threshold):
+            regressions.append(f"throughput with {workers} worker(s): {before} -> {after} pages/sec")
+    return regressions
+
+
+def report_regressions(baseline, current, threshold):
+    if baseline.get('environment') != current.get('environment'):
+        print('Warning: baseline was recorded in a different environment', file=sys.stderr)
+    regressions = find_regressions(baseline, current, threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if not regressions:
+        print(f"No regressions beyond {threshold * 100:.0f}%")
+    return 1 if regressions else 0
+
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    return report_regressions(baseline, current, args.threshold)
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the OCR pipeline')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = commands.add_parser('run', help='Run the benchmarks and save the results as JSON')
+    run_parser.add_argument('--output', default='benchmark.json', help='Where to write the results')
+    run_parser.add_argument('--samples', default=SAMPLES_DIR, help='Directory with the sample images')
+    run_parser.add_argument('--iterations', type=int, default=5, help='Timed runs per input')
+    run_parser.add_argument('--dpi', type=int_list, default=list(SYNTHETIC_DPIS),
+                            help='Resolutions of the synthetic pages, e.g. 150,300,600')
+    run_parser.add_argument('--no-poster', action='store_true', help='Skip the tiled A1 poster case')
+    run_parser.add_argument('--workers', type=int_list, default=[1, os.cpu_count() or 1],
+                            help='Worker process counts for the throughput test, e.g. 1,2,4')
+    run_parser.add_argument('--rounds', type=int, default=2, help='Passes over the corpus per throughput test')
+    run_parser.add_argument('--compare', help='Baseline JSON to check the new results against')
+    run_parser.add_argument('--threshold', type=float, default=0.1, help='Allowed slowdown, e.g. 0.1 for 10%%')
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser('compare', help='Compare two saved result files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1, help='Allowed slowdown, e.g. 0.1 for 10%%')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,184 @@
+"""
+Content-addressed cache for OCR results.
+
+Results are keyed on the SHA-256 of the uploaded image bytes combined with the
+normalized OCR options and the pipeline version. The first tier is an in-memory
+LRU bounded by the serialized size of its entries; the optional second tier
+stores entries as JSON files on disk so they survive restarts and are shared by
+all worker processes.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+def image_digest(data):
+    """SHA-256 hex digest of the raw image bytes"""
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_key(digest, options, version):
+    """Build a cache key from an image digest, the OCR options and the pipeline version"""
+    normalized = json.dumps({k: bool(v) for k, v in options.items()}, sort_keys=True)
+    return hashlib.sha256(f"{version}:{digest}:{normalized}".encode('utf-8')).hexdigest()
+
+
+class ResultCache:
+    """Two-tier (memory LRU + optional disk) cache of OCR results"""
+
+    def __init__(self, max_bytes, disk_dir=None, disk_max_bytes=None):
+        self.max_bytes = max_bytes
+        self.disk_dir = disk_dir or None
+        self.disk_max_bytes = disk_max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._disk_bytes = None
+        self._lock = threading.Lock()
+        self._counters = {
+            'memoryHits': 0,
+            'diskHits': 0,
+            'misses': 0,
+            'evictions': 0,
+            'diskEvictions': 0
+        }
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    def get(self, key):
+        """Return the cached result for key, or None on a miss"""
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+                self._counters['memoryHits'] += 1
+                return json.loads(payload)
+
+        payload = self._read_disk(key)
+        if payload is not None:
+            with self._lock:
+                self._counters['diskHits'] += 1
+                self._remember(key, payload)
+            return json.loads(payload)
+
+        with self._lock:
+            self._counters['misses'] += 1
+        return None
+
+    def put(self, key, result):
+        payload = json.dumps(result).encode('utf-8')
+        with self._lock:
+            self._remember(key, payload)
+        self._write_disk(key, payload)
+
+    def stats(self):
+        with self._lock:
+            counters = dict(self._counters)
+            entries = len(self._entries)
+            size = self._bytes
+
+        lookups = counters['memoryHits'] + counters['diskHits'] + counters['misses']
+        counters.update({
+            'entries': entries,
+            'bytes': size,
+            'maxBytes': self.max_bytes,
+            'diskEnabled': self.disk_dir is not None,
+            'hitRatio': (counters['memoryHits'] + counters['diskHits']) / lookups if lookups else 0
+        })
+        return counters
+
+    def _remember(self, key, payload):
+        # Caller holds the lock
+        if len(payload) > self.max_bytes:
+            return
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self._bytes -= len(previous)
+        self._entries[key] = payload
+        self._bytes += len(payload)
+        while self._bytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= len(evicted)
+            self._counters['evictions'] += 1
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _read_disk(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._disk_path(key)
+        try:
+            with open(path, 'rb') as f:
+                payload = f.read()
+        except OSError:
+            return None
+        # Touch the entry so disk eviction is least-recently-used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return payload
+
+    def _write_disk(self, key, payload):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file first so concurrent readers never see a partial entry
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.replace(tmp_path, path)
+        except OSError:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        if self.disk_max_bytes:
+            with self._lock:
+                if self._disk_bytes is not None:
+                    self._disk_bytes += len(payload)
+                over_budget = self._disk_bytes is None or self._disk_bytes > self.disk_max_bytes
+            # Only walk the cache directory when the running total says we may be over budget
+            if over_budget:
+                self._evict_disk()
+
+    def _evict_disk(self):
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.disk_dir):
+            for name in names:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                files.append((st.st_mtime, st.st_size, path))
+                total += st.st_size
+
+        if total <= self.disk_max_bytes:
+            with self._lock:
+                self._disk_bytes = total
+            return
+
+        # Drop the least recently used entries until we are back under 90% of the budget
+        target = self.disk_max_bytes * 0.9
+        for _, size, path in sorted(files):
+            if total <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+            with self._lock:
+                self._counters['diskEvictions'] += 1
+
+        with self._lock:
+            self._disk_bytes = total
@@ -0,0 +1,233 @@
+"""
+Pool of warm, long-lived Tesseract engines.
+
+pytesseract forks a `tesseract` process for every call, writes the image to a
+temp file and reloads the language models each time. When the tesserocr
+bindings are installed we instead keep initialized TessBaseAPI instances per
+(lang, oem, psm) combination and hand numpy buffers to them in memory. Without
+tesserocr the module falls back to pytesseract so the engine keeps working.
+"""
+
+import os
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+import pytesseract
+
+import metrics
+
+try:
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
+# Maximum number of engines per (lang, oem, psm) combination in one process
+TESSERACT_POOL_SIZE = int(os.environ.get('TESSERACT_POOL_SIZE', str(os.cpu_count() or 1)))
+
+# Combinations initialized up front by warm(); "lang:oem:psm" separated by commas
+TESSERACT_WARM_ENGINES = os.environ.get('TESSERACT_WARM_ENGINES', 'eng:3:6,eng:1:6,eng:3:3')
+
+# Layout regions are single text blocks; the masked fallback lets Tesseract segment the page
+REGION_PSM = 6
+MASKED_PSM = 3
+OSD_PSM = 0  # Orientation and script detection only
+
+TSV_INT_COLUMNS = ('level', 'page_num', 'block_num', 'par_num', 'line_num', 'word_num',
+                   'left', 'top', 'width', 'height')
+
+
+class EnginePool:
+    """Bounded pool of TessBaseAPI instances keyed by (lang, oem, psm)"""
+
+    def __init__(self, size):
+        self.size = max(1, size)
+        self._cond = threading.Condition()
+        self._idle = {}
+        self._created = {}
+
+    def reset(self):
+        """Forget every engine, e.g. in a freshly forked child process"""
+        self._cond = threading.Condition()
+        self._idle = {}
+        self._created = {}
+
+    @contextmanager
+    def borrow(self, lang, oem, psm):
+        key = (lang, oem, psm)
+        engine = self._acquire(key)
+        try:
+            yield engine
+        finally:
+            engine.Clear()
+            with self._cond:
+                self._idle[key].append(engine)
+                self._cond.notify()
+
+    def warm(self, keys):
+        """Create one engine for each key so the first request skips model loading"""
+        for key in keys:
+            with self.borrow(*key):
+                pass
+
+    def _acquire(self, key):
+        with self._cond:
+            while True:
+                idle = self._idle.setdefault(key, [])
+                if idle:
+                    return idle.pop()
+                if self._created.get(key, 0) < self.size:
+                    self._created[key] = self._created.get(key, 0) + 1
+                    break
+                self._cond.wait()
+
+        lang, oem, psm = key
+        try:
+            return tesserocr.PyTessBaseAPI(lang=lang, oem=tesserocr.OEM(oem), psm=tesserocr.PSM(psm))
+        except Exception:
+            with self._cond:
+                self._created[key] -= 1
+                self._cond.notify()
+            raise
+
+
+pool = EnginePool(TESSERACT_POOL_SIZE)
+
+# Engines must never be shared with forked children (gunicorn workers, process pools)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=pool.reset)
+
+
+def available():
+    """True when warm in-process engines are used instead of pytesseract subprocesses"""
+    return tesserocr is not None
+
+
+def warm():
+    """Initialize the engines listed in TESSERACT_WARM_ENGINES"""
+    if not available():
+        return
+    keys = []
+    for spec in TESSERACT_WARM_ENGINES.split(','):
+        if spec.strip():
+            lang, oem, psm = spec.strip().split(':')
+            keys.append((lang, int(oem), int(psm)))
+    pool.warm(keys)
+
+
+def _set_image(engine, image):
+    image = np.ascontiguousarray(image)
+    height, width = image.shape[:2]
+    channels = 1 if image.ndim == 2 else image.shape[2]
+    engine.SetImageBytes(image.tobytes(), width, height, channels, width * channels)
+
+
+def image_to_data(image, lang='eng', oem=3, psm=3):
+    """OCR a numpy image and return word boxes in pytesseract's Output.DICT layout"""
+    metrics.count_tesseract_call()
+    if not available():
+        return pytesseract.image_to_data(image, lang=lang, config=f'--oem {oem} --psm {psm}',
+                                         output_type=pytesseract.Output.DICT)
+
+    with pool.borrow(lang, oem, psm) as engine:
+        _set_image(engine, image)
+        engine.Recognize()
+        tsv = engine.GetTSVText(0)
+
+    return parse_tsv(tsv)
+
+
+def detect_script(image):
+    """Name of the script (e.g. 'Latin', 'Cyrillic') Tesseract's OSD finds on a page, or None"""
+    metrics.count_tesseract_call()
+    try:
+        if not available():
+            return pytesseract.image_to_osd(image, output_type=pytesseract.Output.DICT).get('script')
+        with pool.borrow('eng', 3, OSD_PSM) as engine:
+            _set_image(engine, image)
+            osd = engine.DetectOrientationScript()
+    except (pytesseract.TesseractError, RuntimeError):
+        # Missing osd.traineddata, or too little text to decide
+        return None
+    return osd.get('script_name') if osd else None
+
+
+def image_regions_to_data(image, boxes, lang='eng', oem=3):
+    """OCR the (x, y, w, h) boxes of a numpy image and return word boxes for each box
+
+    One recognition pass per box yields the words, their page coordinates,
+    confidences and block/paragraph/line numbers in pytesseract's Output.DICT
+    layout, so the text and the word boxes never need separate Tesseract calls.
+    Warm engines read each box as a single text block. The pytesseract fallback
+    blanks everything outside the boxes, reads what is left in a single
+    subprocess call and hands the words back to the box they fall in.
+    """
+    if not boxes:
+        return []
+
+    if available():
+        results = []
+        with pool.borrow(lang, oem, REGION_PSM) as engine:
+            _set_image(engine, image)
+            for x, y, w, h in boxes:
+                metrics.count_tesseract_call()
+                engine.SetRectangle(int(x), int(y), int(w), int(h))
+                engine.Recognize()
+                # Word boxes are reported in page coordinates, not relative to the rectangle
+                results.append(parse_tsv(engine.GetTSVText(0)))
+        return results
+
+    # Crop to the union of the boxes and paint everything else white
+    left = min(x for x, _, _, _ in boxes)
+    top = min(y for _, y, _, _ in boxes)
+    right = max(x + w for x, _, w, _ in boxes)
+    bottom = max(y + h for _, y, _, h in boxes)
+    masked = np.full((bottom - top, right - left), 255, np.uint8)
+    for x, y, w, h in boxes:
+        masked[y-top:y-top+h, x-left:x-left+w] = image[y:y+h, x:x+w]
+
+    data = image_to_data(masked, lang=lang, oem=oem, psm=MASKED_PSM)
+    results = [{column: [] for column in data} for _ in boxes]
+    for i, word in enumerate(data['text']):
+        if not word.strip():
+            continue
+        cx = data['left'][i] + data['width'][i] / 2 + left
+        cy = data['top'][i] + data['height'][i] / 2 + top
+        for index, (x, y, w, h) in enumerate(boxes):
+            if x <= cx < x + w and y <= cy < y + h:
+                for column, values in data.items():
+                    results[index][column].append(values[i])
+                results[index]['left'][-1] += left
+                results[index]['top'][-1] += top
+                break
+    return results
+
+
+def data_to_text(data):
+    """Text of word boxes in Output.DICT layout, one line per Tesseract text line"""
+    lines = []
+    last_line = None
+    for i, word in enumerate(data['text']):
+        word = word.strip()
+        if not word:
+            continue
+        line = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        if line != last_line:
+            lines.append([])
+            last_line = line
+        lines[-1].append(word)
+    return '\n'.join(' '.join(words) for words in lines)
+
+
+def parse_tsv(tsv):
+    """Parse Tesseract TSV output (without header) into column lists"""
+    data = {column: [] for column in TSV_INT_COLUMNS + ('conf', 'text')}
+    for row in tsv.splitlines():
+        fields = row.split('\t', 11)
+        if len(fields) < 11:
+            continue
+        for column, value in zip(TSV_INT_COLUMNS, fields):
+            data[column].append(int(value))
+        data['conf'].append(float(fields[10]))
+        data['text'].append(fields[11] if len(fields) > 11 else '')
+    return data
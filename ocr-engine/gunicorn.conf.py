@@ -0,0 +1,29 @@
+# Production server settings for the OCR engine.
+#
+# The app is imported once in the master (preload_app) so OpenCV, numpy and the
+# Flask app are loaded before forking and shared copy-on-write. Each worker then
+# initializes its own warm Tesseract engines after the fork.
+#
+# Every worker can start its own page process pool (PAGE_WORKERS), so the CPUs
+# are split between them: with the default one worker per core, pages are OCR'd
+# in the worker itself. Set GUNICORN_WORKERS=1 to give one request all the cores.
+
+import multiprocessing
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:6000')
+workers = int(os.environ.get('GUNICORN_WORKERS', str(multiprocessing.cpu_count())))
+# Read by app.py, which preload_app imports after this file
+os.environ.setdefault('PAGE_WORKERS', str(max(1, multiprocessing.cpu_count() // workers)))
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '300'))
+preload_app = True
+
+
+def post_fork(server, worker):
+    import engine_pool
+    engine_pool.warm()
+
+
+def child_exit(server, worker):
+    import metrics
+    metrics.mark_process_dead(worker.pid)
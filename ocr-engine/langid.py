@@ -0,0 +1,148 @@
+"""
+Language identification ahead of full-page OCR.
+
+Running Tesseract with every configured language ('eng+fra+deu+spa+ita')
+makes it evaluate all five models on every line. Instead, multi-language pages
+get a cheap identification pass, and the page is then OCR'd with only the
+languages it actually contains:
+
+1. When the configured languages span several scripts, Tesseract's OSD pass
+   picks the script and drops languages written in other scripts.
+2. A few lines from the largest text regions are read with SAMPLE_LANG, and
+   the words are matched against stopwords that are distinctive for each
+   language.
+
+If the sample is too short to decide, every configured language is used as before.
+"""
+
+import os
+import re
+
+import engine_pool
+
+# Languages considered when multi-language OCR is requested
+OCR_LANGUAGES = [lang.strip() for lang in os.environ.get('OCR_LANGUAGES', 'eng,fra,deu,spa,ita').split(',')
+                 if lang.strip()]
+
+# Sampling: the largest text regions, each cut to a few lines
+SAMPLE_LANG = 'eng'
+LANGID_SAMPLE_REGIONS = int(os.environ.get('LANGID_SAMPLE_REGIONS', '3'))
+LANGID_SAMPLE_LINES = 8
+LINE_PITCH = 2.5  # Line spacing in median glyph heights
+LANGID_MIN_WORDS = 8  # Shorter samples are inconclusive
+
+# Secondary languages need this share of the top language's stopword hits
+LANGID_SECONDARY_SHARE = 0.3
+LANGID_MAX_LANGUAGES = 2
+LANGID_MIN_HITS = 2
+
+# Tesseract OSD script names and the language packs written in them
+SCRIPT_LANGUAGES = {
+    'Latin': {'eng', 'fra', 'deu', 'spa', 'ita', 'por', 'nld', 'pol', 'swe', 'dan', 'nor', 'fin', 'ces', 'tur'},
+    'Cyrillic': {'rus', 'ukr', 'bul', 'srp', 'bel', 'mkd'},
+    'Greek': {'ell'},
+    'Arabic': {'ara', 'fas', 'urd'},
+    'Hebrew': {'heb'},
+    'Devanagari': {'hin', 'mar', 'nep'},
+    'Han': {'chi_sim', 'chi_tra'},
+    'Japanese': {'jpn'},
+    'Hangul': {'kor'},
+    'Thai': {'tha'}
+}
+
+STOPWORDS = {
+    'eng': {'the', 'and', 'of', 'to', 'in', 'is', 'that', 'for', 'it', 'with', 'as', 'was', 'on', 'are',
+            'be', 'this', 'by', 'at', 'or', 'from', 'have', 'an', 'which', 'not', 'but', 'were', 'they',
+            'their', 'has', 'will', 'would', 'been', 'there', 'we', 'you', 'all', 'can', 'what'},
+    'fra': {'le', 'la', 'les', 'de', 'des', 'du', 'et', 'est', 'un', 'une', 'pour', 'dans', 'que', 'qui',
+            'sur', 'pas', 'au', 'aux', 'avec', 'ce', 'ces', 'il', 'elle', 'sont', 'nous', 'vous', 'ou',
+            'mais', 'leur', 'cette', 'par', 'plus', 'être', 'été', 'fait', 'comme'},
+    'deu': {'der', 'die', 'das', 'und', 'ist', 'nicht', 'mit', 'den', 'dem', 'ein', 'eine', 'einer',
+            'zu', 'von', 'auf', 'für', 'sich', 'auch', 'es', 'wird', 'werden', 'sind', 'oder', 'bei',
+            'aus', 'wie', 'nach', 'noch', 'über', 'wir', 'sie', 'ich', 'haben', 'kann', 'dass', 'im'},
+    'spa': {'el', 'la', 'los', 'las', 'de', 'del', 'y', 'que', 'en', 'un', 'una', 'por', 'para', 'con',
+            'no', 'es', 'se', 'lo', 'su', 'sus', 'al', 'como', 'más', 'pero', 'está', 'son', 'fue',
+            'este', 'esta', 'entre', 'cuando', 'muy', 'sin', 'sobre', 'también', 'hay', 'ser'},
+    'ita': {'il', 'la', 'lo', 'gli', 'le', 'di', 'del', 'della', 'dei', 'delle', 'e', 'che', 'un', 'una',
+            'per', 'con', 'non', 'sono', 'è', 'nel', 'nella', 'alla', 'anche', 'come', 'più', 'questo',
+            'questa', 'essere', 'ha', 'hanno', 'stato', 'ma', 'tra', 'se', 'suo', 'sua', 'dalla'}
+}
+
+# Words used by more than one language say nothing about which one a page is in
+DISTINCTIVE_STOPWORDS = {
+    lang: words - set().union(*(other for key, other in STOPWORDS.items() if key != lang))
+    for lang, words in STOPWORDS.items()
+}
+
+WORD = re.compile(r"[^\W\d_]+")
+
+
+def script_of(lang):
+    for script, languages in SCRIPT_LANGUAGES.items():
+        if lang in languages:
+            return script
+    return None
+
+
+def score_languages(text, candidates):
+    """Number of distinctive stopwords of each candidate language found in text"""
+    words = WORD.findall(text.lower())
+    return {lang: sum(1 for word in words if word in DISTINCTIVE_STOPWORDS.get(lang, ())) for lang in candidates}
+
+
+def choose_languages(text, candidates):
+    """Minimal language set for a text sample, or None when the sample is inconclusive"""
+    if len(WORD.findall(text)) < LANGID_MIN_WORDS:
+        return None
+    scores = score_languages(text, candidates)
+    best = max(scores.values(), default=0)
+    if best < LANGID_MIN_HITS:
+        return None
+    ranked = sorted(candidates, key=lambda lang: scores[lang], reverse=True)
+    threshold = max(LANGID_MIN_HITS, best * LANGID_SECONDARY_SHARE)
+    return [lang for lang in ranked if scores[lang] >= threshold][:LANGID_MAX_LANGUAGES]
+
+
+def sample_boxes(layout):
+    """The top few lines of the largest text regions, with whether each box is the whole region"""
+    max_height = int(LANGID_SAMPLE_LINES * LINE_PITCH * layout.char_height)
+    regions = sorted(layout.text_regions(), key=lambda r: r['bbox'][2] * r['bbox'][3], reverse=True)
+    boxes = []
+    for region in regions[:LANGID_SAMPLE_REGIONS]:
+        x, y, w, h = region['bbox']
+        boxes.append(([x, y, w, min(h, max_height)], h <= max_height))
+    return boxes
+
+
+def identify_languages(image, layout, oem=3, candidates=None):
+    """Pick the languages to OCR a thresholded page with
+
+    Returns (languages, words) where words maps the bboxes of text regions that
+    were read completely while sampling to their word boxes (pytesseract's
+    Output.DICT layout). They are only returned when the page turns out to be
+    in SAMPLE_LANG alone, so the caller can skip reading those regions again.
+    """
+    candidates = list(candidates or OCR_LANGUAGES)
+    if len(candidates) <= 1:
+        return candidates, {}
+
+    # OSD only helps when the candidates are written in different scripts
+    if len({script_of(lang) for lang in candidates}) > 1:
+        script = engine_pool.detect_script(image)
+        same_script = [lang for lang in candidates if script_of(lang) == script]
+        if same_script:
+            candidates = same_script
+        if len(candidates) == 1:
+            return candidates, {}
+
+    # Stopword sampling reads Latin-script text with SAMPLE_LANG
+    if any(script_of(lang) != 'Latin' for lang in candidates):
+        return candidates, {}
+
+    boxes = sample_boxes(layout)
+    sampled = engine_pool.image_regions_to_data(image, [box for box, _ in boxes], lang=SAMPLE_LANG, oem=oem)
+    text = ' '.join(engine_pool.data_to_text(data) for data in sampled)
+    languages = choose_languages(text, candidates) or candidates
+    if languages != [SAMPLE_LANG]:
+        return languages, {}
+    return languages, {tuple(box): data for (box, whole), data in zip(boxes, sampled) if whole}
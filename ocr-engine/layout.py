@@ -0,0 +1,316 @@
+"""
+Single-pass page layout analysis.
+
+analyze_layout() looks at a thresholded page once and finds the ruled lines,
+connected components and regions on it. A region is a text block, a table
+grid or a figure. Figures are either pictures, which are never OCR'd, or
+diagrams made of closed shapes joined by connectors. The rest of the pipeline
+consumes the result. Tesseract only reads text blocks, table detection works
+from the grids found here, and the geometric diagram detector turns diagram
+figures into Mermaid code. Blank margins are never passed to Tesseract.
+"""
+
+import cv2
+import numpy as np
+
+REGION_TEXT = 'text'
+REGION_TABLE = 'table'
+REGION_FIGURE = 'figure'
+
+# Table detection tuning
+TABLE_MIN_AREA = 10000  # Minimum table area in px^2
+TABLE_MIN_ASPECT = 0.5
+TABLE_MAX_ASPECT = 5
+TABLE_LINE_SCALE = 30  # Rule lines must be at least 1/30 of the page width/height
+TABLE_LINE_COVERAGE = 0.5  # A row/column line must span half the table
+TABLE_FRAME_COVERAGE = 0.9  # At least two rows and columns must span (almost) all of it
+TABLE_MAX_OVERLAP = 0.3  # Candidates overlapping a bigger table by more than this are dropped
+
+# Region segmentation tuning, relative to the median character height
+MASK_SCALE = 4  # Region masks are built at 1/4 resolution
+DEFAULT_CHAR_HEIGHT = 20  # Used when a page has too few glyphs to measure
+LARGE_COMPONENT_HEIGHT = 3  # Components taller than 3 characters are graphics, not glyphs
+LARGE_COMPONENT_WIDTH = 15
+PICTURE_MIN_DENSITY = 0.35  # Figures with more ink than this are pictures (photos, logos)
+
+# Diagram detection tuning
+NODE_MIN_SIZE = 1.5  # A diagram node's interior is at least 1.5 characters on each side
+DIAGRAM_MIN_NODES = 2
+DIAGRAM_MAX_COMPONENTS = 500
+
+
+class PageLayout:
+    """Result of analyze_layout(): rule-line masks, glyph metrics and classified regions
+
+    Each region is a dict with 'type' and 'bbox' ([x, y, w, h]); tables also
+    carry 'rows'/'cols' (rule line positions relative to the bbox) and diagram
+    figures carry 'nodes' and 'edges'.
+    """
+
+    def __init__(self, width, height, char_height, horizontal, vertical, regions):
+        self.width = width
+        self.height = height
+        self.char_height = char_height
+        self.horizontal = horizontal
+        self.vertical = vertical
+        self.regions = regions
+
+    def to_dict(self):
+        """JSON-serializable copy of the regions; the rule-line masks are not kept"""
+        return {'width': self.width, 'height': self.height, 'charHeight': self.char_height,
+                'regions': [dict(region) for region in self.regions]}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['width'], data['height'], data['charHeight'], None, None,
+                   [dict(region) for region in data['regions']])
+
+    def of_type(self, region_type):
+        return [region for region in self.regions if region['type'] == region_type]
+
+    def text_regions(self):
+        return self.of_type(REGION_TEXT)
+
+    def table_regions(self):
+        return self.of_type(REGION_TABLE)
+
+    def diagram_regions(self):
+        return [region for region in self.of_type(REGION_FIGURE) if region.get('nodes')]
+
+    def reading_order(self, include_diagrams=False):
+        """Text and table regions top to bottom, then left to right within a line band"""
+        band = max(1, self.char_height)
+        regions = [r for r in self.regions if r['type'] in (REGION_TEXT, REGION_TABLE) or
+                   (include_diagrams and r.get('nodes'))]
+        return sorted(regions, key=lambda r: (r['bbox'][1] // band, r['bbox'][0]))
+
+
+def detect_rule_lines(ink):
+    """Return masks of the horizontal and vertical rule lines in an ink mask"""
+    height, width = ink.shape[:2]
+    h_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (max(width // TABLE_LINE_SCALE, 10), 1))
+    v_kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (1, max(height // TABLE_LINE_SCALE, 10)))
+    horizontal = cv2.morphologyEx(ink, cv2.MORPH_OPEN, h_kernel)
+    vertical = cv2.morphologyEx(ink, cv2.MORPH_OPEN, v_kernel)
+    return horizontal, vertical
+
+
+def find_line_positions(mask, axis, min_coverage=TABLE_LINE_COVERAGE):
+    """Find the centre coordinates of rule lines spanning most of a region
+
+    axis=1 sums each row (horizontal lines), axis=0 sums each column (vertical lines).
+    """
+    span = mask.shape[axis]
+    coverage = np.count_nonzero(mask, axis=axis)
+    hits = np.flatnonzero(coverage >= span * min_coverage)
+    if hits.size == 0:
+        return []
+
+    # Consecutive pixel rows/columns belong to the same (thick) line
+    breaks = np.flatnonzero(np.diff(hits) > 1) + 1
+    return [int(run.mean()) for run in np.split(hits, breaks)]
+
+
+def suppress_overlapping_boxes(boxes):
+    """Drop boxes that are nested in or largely overlap a bigger box"""
+    kept = []
+    for box in sorted(boxes, key=lambda b: b[2] * b[3], reverse=True):
+        x, y, w, h = box
+        overlaps = False
+        for kx, ky, kw, kh in kept:
+            ix = max(0, min(x + w, kx + kw) - max(x, kx))
+            iy = max(0, min(y + h, ky + kh) - max(y, ky))
+            if ix * iy > TABLE_MAX_OVERLAP * w * h:
+                overlaps = True
+                break
+        if not overlaps:
+            kept.append(box)
+    return kept
+
+
+def find_table_grids(horizontal, vertical):
+    """Table regions from the rule-line masks: outermost grids with at least two rows"""
+    # Only outermost grid contours are candidates, and overlapping ones are suppressed
+    grid = cv2.dilate(cv2.bitwise_or(horizontal, vertical), np.ones((3, 3), np.uint8))
+    contours, _ = cv2.findContours(grid, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    candidates = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        # Filter regions based on area and aspect ratio
+        if w * h < TABLE_MIN_AREA:
+            continue
+        # Tables usually have an aspect ratio close to 1 or wider
+        if TABLE_MIN_ASPECT <= w / h <= TABLE_MAX_ASPECT:
+            candidates.append((x, y, w, h))
+
+    tables = []
+    for x, y, w, h in suppress_overlapping_boxes(candidates):
+        rows = find_line_positions(horizontal[y:y+h, x:x+w], axis=1)
+        cols = find_line_positions(vertical[y:y+h, x:x+w], axis=0)
+        # Single boxed cells and stacked boxes (flowchart nodes) have no continuous frame
+        framed = (len(find_line_positions(horizontal[y:y+h, x:x+w], 1, TABLE_FRAME_COVERAGE)) >= 2 and
+                  len(find_line_positions(vertical[y:y+h, x:x+w], 0, TABLE_FRAME_COVERAGE)) >= 2)
+        if framed and len(rows) >= 3 and len(cols) >= 2:
+            tables.append({'type': REGION_TABLE, 'bbox': [x, y, w, h], 'rows': rows, 'cols': cols})
+    return tables
+
+
+def _inside(boxes, regions):
+    """Boolean mask of the (x, y, w, h) rows of boxes whose centre lies in any region"""
+    cx = boxes[:, 0] + boxes[:, 2] / 2
+    cy = boxes[:, 1] + boxes[:, 3] / 2
+    inside = np.zeros(len(boxes), bool)
+    for region in regions:
+        x, y, w, h = region['bbox']
+        inside |= (cx >= x) & (cx < x + w) & (cy >= y) & (cy < y + h)
+    return inside
+
+
+def _merge_boxes(boxes, shape, grow_x, grow_y):
+    """Group nearby boxes into blocks by dilating them on a low-resolution mask"""
+    height, width = shape
+    mask = np.zeros((height // MASK_SCALE + 1, width // MASK_SCALE + 1), np.uint8)
+    for x, y, w, h in boxes:
+        cv2.rectangle(mask, (int(x) // MASK_SCALE, int(y) // MASK_SCALE),
+                      ((int(x + w) - 1) // MASK_SCALE, (int(y + h) - 1) // MASK_SCALE), 255, -1)
+    kernel = np.ones((max(1, grow_y // MASK_SCALE), max(1, grow_x // MASK_SCALE)), np.uint8)
+    mask = cv2.dilate(mask, kernel)
+    contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+
+    blocks = []
+    for contour in contours:
+        x, y, w, h = cv2.boundingRect(contour)
+        x0, y0 = x * MASK_SCALE, y * MASK_SCALE
+        x1, y1 = min(width, (x + w) * MASK_SCALE), min(height, (y + h) * MASK_SCALE)
+        blocks.append([x0, y0, x1 - x0, y1 - y0])
+    return blocks
+
+
+def _shrink_to_members(block, boxes):
+    """Tighten a dilated block to the boxes it contains, plus a small margin"""
+    x, y, w, h = block
+    inside = boxes[(boxes[:, 0] >= x) & (boxes[:, 1] >= y) &
+                   (boxes[:, 0] + boxes[:, 2] <= x + w) & (boxes[:, 1] + boxes[:, 3] <= y + h)]
+    if len(inside) == 0:
+        return block
+    x0, y0 = inside[:, 0].min(), inside[:, 1].min()
+    x1, y1 = (inside[:, 0] + inside[:, 2]).max(), (inside[:, 1] + inside[:, 3]).max()
+    return [int(x0), int(y0), int(x1 - x0), int(y1 - y0)]
+
+
+def _pad(bbox, margin, width, height):
+    x, y, w, h = bbox
+    x0, y0 = max(0, x - margin), max(0, y - margin)
+    return [x0, y0, min(width, x + w + margin) - x0, min(height, y + h + margin) - y0]
+
+
+def analyze_layout(thresh):
+    """Analyze a thresholded page (black ink on white) and classify its regions"""
+    height, width = thresh.shape
+    ink = cv2.bitwise_not(thresh)
+    horizontal, vertical = detect_rule_lines(ink)
+    tables = find_table_grids(horizontal, vertical)
+
+    _, _, stats, _ = cv2.connectedComponentsWithStats(ink, connectivity=8)
+    boxes = stats[1:, :4]  # Label 0 is the background
+    areas = stats[1:, 4]
+
+    # Glyph size drives every other threshold
+    plausible = boxes[(boxes[:, 3] >= 5) & (boxes[:, 3] <= height // 20), 3]
+    char_height = int(np.median(plausible)) if len(plausible) >= 10 else DEFAULT_CHAR_HEIGHT
+
+    keep = (boxes[:, 2] * boxes[:, 3] >= max(4, char_height * char_height // 50))  # Speckles
+    if tables:
+        keep &= ~_inside(boxes, tables)
+    large = (boxes[:, 3] > LARGE_COMPONENT_HEIGHT * char_height) | \
+            ((boxes[:, 2] > LARGE_COMPONENT_WIDTH * char_height) & (boxes[:, 3] > 1.5 * char_height))
+    glyphs, graphics = boxes[keep & ~large], boxes[keep & large]
+    graphic_areas = areas[keep & large]
+
+    # Graphics close to each other (boxes, arrows, picture fragments) form one figure
+    figures = []
+    for bbox in _merge_boxes(graphics, (height, width), char_height, char_height):
+        bbox = _shrink_to_members(bbox, graphics)
+        x, y, w, h = bbox
+        in_figure = _inside(graphics, [{'bbox': bbox}])
+        density = graphic_areas[in_figure].sum() / max(1, w * h)
+        figure = {'type': REGION_FIGURE, 'bbox': bbox, 'density': float(density)}
+        if density < PICTURE_MIN_DENSITY:
+            nodes, edges = find_diagram_graph(ink[y:y+h, x:x+w], char_height)
+            if len(nodes) >= DIAGRAM_MIN_NODES:
+                figure.update(nodes=[[nx + x, ny + y, nw, nh] for nx, ny, nw, nh in nodes], edges=edges)
+            else:
+                # Sparse strokes without a node structure (handwriting, signatures) are read as text
+                figure['type'] = REGION_TEXT
+        figures.append(figure)
+
+    # Glyphs inside figures are read with them (diagram labels per node) or not at all (pictures)
+    if figures and len(glyphs):
+        glyphs = glyphs[~_inside(glyphs, figures)]
+
+    # Words on a line merge horizontally, lines of a paragraph merge vertically
+    text_blocks = [
+        {'type': REGION_TEXT, 'bbox': _pad(_shrink_to_members(block, glyphs), char_height // 2, width, height)}
+        for block in _merge_boxes(glyphs, (height, width), char_height * 3, char_height * 2)
+    ]
+
+    regions = tables + figures + text_blocks
+    for region in figures:
+        if region['type'] == REGION_TEXT:
+            region['bbox'] = _pad(region['bbox'], char_height // 2, width, height)
+        region.pop('density', None)
+    return PageLayout(width, height, char_height, horizontal, vertical, regions)
+
+
+def find_diagram_graph(ink, char_height):
+    """Find the nodes (closed shapes) of a diagram figure and the connectors joining them
+
+    Returns node bboxes (relative to the figure) in reading order and edges as
+    (from, to) node index pairs, directed top-to-bottom / left-to-right.
+    """
+    contours, hierarchy = cv2.findContours(ink, cv2.RETR_CCOMP, cv2.CHAIN_APPROX_SIMPLE)
+    if hierarchy is None or len(contours) > DIAGRAM_MAX_COMPONENTS * 4:
+        return [], []
+
+    # Holes big enough to hold a label are the interiors of boxes, diamonds and circles
+    min_side = NODE_MIN_SIZE * char_height
+    holes = []
+    for contour, (_, _, _, parent) in zip(contours, hierarchy[0]):
+        if parent < 0:
+            continue
+        x, y, w, h = cv2.boundingRect(contour)
+        if w >= min_side and h >= min_side:
+            holes.append((contour, [x, y, w, h]))
+    if len(holes) < DIAGRAM_MIN_NODES:
+        return [], []
+
+    holes.sort(key=lambda hole: (hole[1][1] // char_height, hole[1][0]))
+
+    # Paint each node (interior plus outline) with its index, then look at what ink is left over
+    outline = max(3, char_height // 3)
+    node_map = np.zeros(ink.shape, np.uint16)
+    for index, (contour, _) in enumerate(holes, start=1):
+        cv2.drawContours(node_map, [contour], -1, index, -1)
+        cv2.drawContours(node_map, [contour], -1, index, outline * 2)
+    connectors = ink.copy()
+    connectors[node_map > 0] = 0
+
+    # Connector strokes start and end next to node outlines
+    count, labels, stats, _ = cv2.connectedComponentsWithStats(connectors, connectivity=8)
+    if count > DIAGRAM_MAX_COMPONENTS:
+        return [], []
+    touch_map = cv2.dilate(node_map, np.ones((outline, outline), np.uint8))
+
+    edges = set()
+    for label in range(1, count):
+        x, y, w, h, area = stats[label]
+        if max(w, h) < char_height // 2:
+            continue
+        component = labels[y:y+h, x:x+w] == label
+        grown = cv2.dilate(component.astype(np.uint8), np.ones((3, 3), np.uint8)).astype(bool)
+        touched = sorted(set(np.unique(touch_map[y:y+h, x:x+w][grown])) - {0})
+        for other in touched[1:]:
+            edges.add((int(touched[0]) - 1, int(other) - 1))
+
+    return [bbox for _, bbox in holes], sorted(edges)
@@ -0,0 +1,244 @@
+"""
+Pipeline instrumentation for the OCR engine.
+
+Each request collects a RequestStats: the time spent in every pipeline stage
+(decode, threshold, layout, ocr, ...), how many times Tesseract was invoked and
+the size of every page. Pages OCR'd in the page process pool or tiled across
+it collect deferred stats that are sent back and merged into the serving
+worker's, so a document's numbers add up however it was split. The totals go
+to the `Server-Timing` header and to Prometheus histograms served on
+`/metrics`; gunicorn runs several workers, so set PROMETHEUS_MULTIPROC_DIR to
+aggregate them.
+
+CPU time is spent here rather than in the API, so this is also where sampling
+profiles are offered: with PROFILING_ENABLED=true a request sent with
+`?profile=true` or `X-Profile: true` is profiled with pyinstrument and the
+report written to PROFILE_DIR is named in the `X-Profile-Report` header.
+
+prometheus_client and pyinstrument are optional.
+"""
+
+import contextvars
+import os
+import resource
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import Response, g, jsonify, request
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:
+    prometheus_client = None
+
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+PROFILING_ENABLED = os.environ.get('PROFILING_ENABLED', 'false').lower() == 'true'
+PROFILE_DIR = os.environ.get('PROFILE_DIR', '/tmp/ocr-profiles')
+PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL', '0.001'))
+
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+if prometheus_client is not None:
+    STAGE_SECONDS = prometheus_client.Histogram(
+        'ocr_engine_stage_seconds', 'Time spent in each pipeline stage', ['stage'], buckets=STAGE_BUCKETS)
+    REQUEST_SECONDS = prometheus_client.Histogram(
+        'ocr_engine_request_seconds', 'Request latency', ['endpoint', 'status'], buckets=STAGE_BUCKETS)
+    TESSERACT_CALLS = prometheus_client.Histogram(
+        'ocr_engine_tesseract_calls_per_request', 'Tesseract invocations per request',
+        buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128))
+    PAGE_PIXELS = prometheus_client.Histogram(
+        'ocr_engine_page_megapixels', 'Size of OCR\'d pages after normalization',
+        buckets=(0.5, 1, 2, 4, 8, 16, 32, 64))
+    PAGE_DIMENSION = prometheus_client.Histogram(
+        'ocr_engine_page_dimension_pixels', 'Width and height of OCR\'d pages', ['axis'],
+        buckets=(500, 1000, 2000, 3000, 4000, 5000, 7000, 10000))
+    REQUEST_PEAK_MEMORY = prometheus_client.Histogram(
+        'ocr_engine_request_peak_memory_bytes', 'Peak traced memory per request',
+        buckets=tuple(2 ** n * 1024 * 1024 for n in range(11)))
+    PEAK_RSS = prometheus_client.Gauge(
+        'ocr_engine_peak_rss_bytes', 'Peak resident set size of the process', multiprocess_mode='max')
+
+_current = contextvars.ContextVar('ocr_request_stats', default=None)
+
+
+class RequestStats:
+    """Per-request stage durations, Tesseract call count and page sizes
+
+    Deferred stats are not observed into the Prometheus metrics of the process
+    collecting them; whoever merges them observes them instead. Page pool
+    processes use this so their work is recorded by the serving worker.
+    """
+
+    def __init__(self, deferred=False):
+        self.deferred = deferred
+        self.stages = {}
+        self.tesseract_calls = 0
+        self.pages = []
+
+    def as_dict(self):
+        return {'stages': self.stages, 'tesseractCalls': self.tesseract_calls, 'pages': self.pages}
+
+    def merge(self, other):
+        """Add and observe deferred stats collected elsewhere, given as_dict() output"""
+        for name, seconds in other['stages'].items():
+            self.stages[name] = self.stages.get(name, 0.0) + seconds
+            if prometheus_client is not None:
+                STAGE_SECONDS.labels(name).observe(seconds)
+        self.tesseract_calls += other['tesseractCalls']
+        for width, height in other['pages']:
+            _observe_page_metrics(width, height)
+        self.pages.extend(other['pages'])
+
+
+@contextmanager
+def collect_stats(deferred=False):
+    """Collect stats for the enclosed block into a fresh RequestStats"""
+    stats = RequestStats(deferred)
+    token = _current.set(stats)
+    try:
+        yield stats
+    finally:
+        _current.reset(token)
+
+
+def current_stats():
+    return _current.get()
+
+
+@contextmanager
+def stage(name):
+    """Time a pipeline stage"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stats = _current.get()
+        if prometheus_client is not None and not (stats is not None and stats.deferred):
+            STAGE_SECONDS.labels(name).observe(elapsed)
+        if stats is not None:
+            stats.stages[name] = stats.stages.get(name, 0.0) + elapsed
+
+
+def timed_iter(iterable, name):
+    """Iterate while timing each step as a stage, e.g. lazy page decoding"""
+    iterator = iter(iterable)
+    while True:
+        with stage(name):
+            item = next(iterator, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+
+def count_tesseract_call():
+    stats = _current.get()
+    if stats is not None:
+        stats.tesseract_calls += 1
+
+
+def _observe_page_metrics(width, height):
+    if prometheus_client is not None:
+        PAGE_PIXELS.observe(width * height / 1e6)
+        PAGE_DIMENSION.labels('width').observe(width)
+        PAGE_DIMENSION.labels('height').observe(height)
+
+
+def observe_page(width, height):
+    stats = _current.get()
+    if stats is None or not stats.deferred:
+        _observe_page_metrics(width, height)
+    if stats is not None:
+        stats.pages.append([width, height])
+
+
+def observe_peak_memory(peak_bytes):
+    if prometheus_client is not None and peak_bytes is not None:
+        REQUEST_PEAK_MEMORY.observe(peak_bytes)
+
+
+def peak_rss_bytes():
+    # ru_maxrss is reported in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def server_timing(stats, total):
+    """Server-Timing header value: one entry per stage plus the request total, in ms"""
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in stats.stages.items()]
+    entries.append(f"tesseract;desc=\"{stats.tesseract_calls} calls\"")
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ', '.join(entries)
+
+
+def _profile_requested():
+    flag = request.args.get('profile') or request.headers.get('X-Profile', '')
+    return PROFILING_ENABLED and pyinstrument is not None and flag.lower() == 'true'
+
+
+def init_app(app):
+    """Instrument every request of a Flask app and register GET /metrics"""
+
+    @app.before_request
+    def start_request_stats():
+        g.metrics_start = time.perf_counter()
+        g.metrics_stats = RequestStats()
+        g.metrics_token = _current.set(g.metrics_stats)
+        g.profiler = None
+        if _profile_requested():
+            g.profiler = pyinstrument.Profiler(interval=PROFILE_INTERVAL)
+            g.profiler.start()
+
+    @app.after_request
+    def finish_request_stats(response):
+        if 'metrics_start' not in g:
+            return response
+        total = time.perf_counter() - g.metrics_start
+        stats = g.metrics_stats
+        endpoint = request.endpoint or 'unknown'
+
+        if prometheus_client is not None and endpoint != 'metrics_endpoint':
+            REQUEST_SECONDS.labels(endpoint, str(response.status_code)).observe(total)
+            if stats.tesseract_calls or stats.pages:
+                TESSERACT_CALLS.observe(stats.tesseract_calls)
+            PEAK_RSS.set(peak_rss_bytes())
+
+        response.headers['Server-Timing'] = server_timing(stats, total)
+
+        if g.profiler is not None:
+            g.profiler.stop()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            name = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{endpoint}.html"
+            with open(os.path.join(PROFILE_DIR, name), 'w') as f:
+                f.write(g.profiler.output_html())
+            response.headers['X-Profile-Report'] = name
+        return response
+
+    @app.teardown_request
+    def reset_request_stats(exc):
+        # Streamed responses tear the request down twice; only the first reset applies
+        token = g.pop('metrics_token', None)
+        if token is not None:
+            _current.reset(token)
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics_endpoint():
+        if prometheus_client is None:
+            return jsonify({'error': 'Metrics require the prometheus_client package'}), 501
+        if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+            registry = prometheus_client.CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+        else:
+            registry = prometheus_client.REGISTRY
+        return Response(prometheus_client.generate_latest(registry), mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
+
+def mark_process_dead(pid):
+    """gunicorn child_exit hook: drop a dead worker's live gauges in multiprocess mode"""
+    if prometheus_client is not None and 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+        multiprocess.mark_process_dead(pid)
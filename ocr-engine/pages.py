@@ -0,0 +1,79 @@
+"""
+Lazy page decoding for single- and multi-page documents.
+
+Documents are decoded straight from the uploaded bytes, without temp files.
+Pages are yielded one at a time as grayscale numpy arrays, normalized to the
+OCR target resolution, so a long PDF or TIFF is never held fully decoded in
+memory. PDFs are rendered with pypdfium2 (optional), TIFFs are walked frame by
+frame with Pillow and other images are decoded by OpenCV.
+"""
+
+import io
+import os
+
+import numpy as np
+from PIL import Image, ImageSequence
+
+from preprocess import OCR_TARGET_DPI, decode_grayscale, normalize_resolution
+
+try:
+    import pypdfium2 as pdfium
+except ImportError:
+    pdfium = None
+
+# Resolution PDF pages are rasterized at before OCR
+PDF_RENDER_DPI = int(os.environ.get('PDF_RENDER_DPI', str(OCR_TARGET_DPI)))
+
+TIFF_MAGIC = (b'II*\x00', b'MM\x00*')
+
+
+def is_pdf(data):
+    return bytes(data[:5]) == b'%PDF-'
+
+
+def is_tiff(data):
+    return bytes(data[:4]) in TIFF_MAGIC
+
+
+def iter_pages(data):
+    """Yield each page of an uploaded document as a normalized grayscale numpy array"""
+    if is_pdf(data):
+        yield from _iter_pdf_pages(data)
+    elif is_tiff(data):
+        yield from _iter_pil_pages(data)
+    else:
+        image = decode_grayscale(data)
+        if image is None:
+            # Formats OpenCV cannot decode (e.g. GIF) go through Pillow
+            yield from _iter_pil_pages(data)
+        else:
+            yield image
+
+
+def _iter_pdf_pages(data):
+    if pdfium is None:
+        raise ValueError('PDF support requires the pypdfium2 package')
+
+    pdf = pdfium.PdfDocument(data)
+    try:
+        for index in range(len(pdf)):
+            page = pdf[index]
+            bitmap = page.render(scale=PDF_RENDER_DPI / 72, grayscale=True,
+                                 force_bitmap_format=pdfium.raw.FPDFBitmap_Gray)
+            # Copy out of the bitmap buffer before it is released
+            array = bitmap.to_numpy()
+            array = np.array(array.reshape(array.shape[0], array.shape[1]))
+            bitmap.close()
+            page.close()
+            # Rendered at the target DPI already; only oversized (poster) pages are capped
+            yield normalize_resolution(array)
+    finally:
+        pdf.close()
+
+
+def _iter_pil_pages(data):
+    with Image.open(io.BytesIO(data)) as image:
+        # ImageSequence seeks frame by frame, so only the current TIFF page is decoded
+        for frame in ImageSequence.Iterator(image):
+            dpi = frame.info.get('dpi', (None,))[0]
+            yield normalize_resolution(np.array(frame.convert('L')), dpi if dpi and dpi >= 50 else None)
@@ -0,0 +1,158 @@
+"""
+Memory-lean image preprocessing.
+
+Uploads are decoded straight to 8-bit grayscale (JPEGs are downscaled by the
+decoder itself when the scan is far above the target resolution), oversized
+scans are normalized to OCR_TARGET_DPI, and binarization overwrites the
+grayscale buffer in place. A page therefore costs one full-resolution buffer
+instead of the PIL/RGB/BGR/gray/threshold copies it used to.
+
+Otsu's global threshold is used for evenly lit scans; pages with uneven
+illumination (phone photos, shadows, yellowed paper) get an adaptive threshold.
+"""
+
+import io
+import os
+import tracemalloc
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+from PIL import Image
+
+# Resolution pages are normalized to before OCR; Tesseract is tuned for ~300 dpi
+OCR_TARGET_DPI = int(os.environ.get('OCR_TARGET_DPI', '300'))
+
+# Longest side of a page OCR'd in one pass (A4 at 600 dpi is ~7000 px)
+OCR_MAX_PAGE_SIDE = int(os.environ.get('OCR_MAX_PAGE_SIDE', '7000'))
+
+# Pages with more pixels than this once at OCR_TARGET_DPI are not capped to
+# OCR_MAX_PAGE_SIDE but OCR'd in tiles (tiling.py); about A1 at 300 dpi
+OCR_TILE_THRESHOLD_PIXELS = int(os.environ.get('OCR_TILE_THRESHOLD_PIXELS', str(60 * 1000 * 1000)))
+
+# Background brightness spread (stddev of a text-free background estimate) above which
+# a page is considered unevenly lit and thresholded adaptively
+ADAPTIVE_BACKGROUND_STDDEV = float(os.environ.get('ADAPTIVE_BACKGROUND_STDDEV', '12'))
+ADAPTIVE_BLOCK_FRACTION = 40  # Adaptive neighbourhood is 1/40 of the shorter page side
+ADAPTIVE_C = 10
+
+# Report the peak traced allocation of every request. tracemalloc slows every
+# allocation down, so this is for diagnostics; the benchmark always enables it
+OCR_TRACK_MEMORY = os.environ.get('OCR_TRACK_MEMORY', 'false').lower() == 'true'
+
+REDUCED_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_GRAYSCALE_8),
+    (4, cv2.IMREAD_REDUCED_GRAYSCALE_4),
+    (2, cv2.IMREAD_REDUCED_GRAYSCALE_2)
+)
+
+
+def start_memory_tracking(force=False):
+    """Start tracemalloc once per process (when OCR_TRACK_MEMORY is set, or forced); numpy and OpenCV buffers are traced through numpy"""
+    if (force or OCR_TRACK_MEMORY) and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+@contextmanager
+def track_peak_memory():
+    """Measure the peak traced memory above the baseline while the block runs
+
+    Yields a dict whose 'peakBytes' is filled in on exit (None when tracking is off).
+    """
+    stats = {'peakBytes': None}
+    if not tracemalloc.is_tracing():
+        yield stats
+        return
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    try:
+        yield stats
+    finally:
+        stats['peakBytes'] = max(0, tracemalloc.get_traced_memory()[1] - baseline)
+
+
+def image_dpi(data):
+    """Horizontal DPI from the image header, or None; only the header is parsed"""
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            dpi = image.info.get('dpi')
+    except Exception:
+        return None
+    if not dpi or not dpi[0] or dpi[0] < 50:
+        # Some encoders write 0 or 1 dpi placeholders; those say nothing about the scan
+        return None
+    return float(dpi[0])
+
+
+def scale_factor(width, height, dpi):
+    """Downscale factor (>= 1) that brings a page to the target resolution and size cap
+
+    Pages large enough to be tiled keep the target resolution, so small text on
+    drawings and posters stays legible.
+    """
+    factor = max(1.0, (dpi or 0) / OCR_TARGET_DPI)
+    if (width / factor) * (height / factor) > OCR_TILE_THRESHOLD_PIXELS:
+        return factor
+    return max(factor, max(width, height) / OCR_MAX_PAGE_SIDE)
+
+
+def normalize_resolution(gray, dpi=None):
+    """Downscale an oversized grayscale page to the target resolution"""
+    height, width = gray.shape
+    factor = scale_factor(width, height, dpi)
+    if factor <= 1.05:
+        return gray
+    size = (max(1, round(width / factor)), max(1, round(height / factor)))
+    return cv2.resize(gray, size, interpolation=cv2.INTER_AREA)
+
+
+def decode_grayscale(data):
+    """Decode an image straight to a normalized 8-bit grayscale array, or None if OpenCV cannot
+
+    When the scan is at least twice the target resolution the decoder is asked
+    for a reduced image (JPEG does this in the DCT domain), so the full-size
+    page is never materialized.
+    """
+    buffer = np.frombuffer(data, np.uint8)
+    dpi = image_dpi(data)
+
+    reduction = 1
+    if dpi and dpi / OCR_TARGET_DPI >= 2:
+        for step, flag in REDUCED_FLAGS:
+            if dpi / OCR_TARGET_DPI >= step:
+                gray = cv2.imdecode(buffer, flag)
+                if gray is not None:
+                    reduction = step
+                break
+
+    if reduction == 1:
+        gray = cv2.imdecode(buffer, cv2.IMREAD_GRAYSCALE)
+        if gray is None:
+            return None
+
+    return normalize_resolution(gray, dpi / reduction if dpi else None)
+
+
+def is_unevenly_lit(gray):
+    """Estimate the page background with text removed and check how much it varies"""
+    height, width = gray.shape
+    scale = 256 / max(height, width)
+    small = cv2.resize(gray, (max(1, round(width * scale)), max(1, round(height * scale))),
+                       interpolation=cv2.INTER_AREA) if scale < 1 else gray
+    # Closing with a kernel wider than a stroke paints dark text with the surrounding paper
+    background = cv2.morphologyEx(small, cv2.MORPH_CLOSE, np.ones((7, 7), np.uint8))
+    return float(background.std()) > ADAPTIVE_BACKGROUND_STDDEV
+
+
+def binarize(gray):
+    """Threshold a grayscale page in place and return it (black text on white)
+
+    The caller's buffer is overwritten; pass a copy if the grayscale is still needed.
+    """
+    if is_unevenly_lit(gray):
+        block = max(3, min(gray.shape) // ADAPTIVE_BLOCK_FRACTION) | 1
+        cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY,
+                              block, ADAPTIVE_C, dst=gray)
+    else:
+        cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU, dst=gray)
+    return gray
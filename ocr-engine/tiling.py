@@ -0,0 +1,245 @@
+"""
+Tiled, parallel OCR for very large scans.
+
+Engineering drawings and posters are too big for one Tesseract pass: an A0
+sheet at 300 dpi is about 10,000 x 14,000 pixels, and a single call over it
+runs for tens of seconds on one core. Pages that are still above
+OCR_TILE_THRESHOLD_PIXELS once normalized to OCR_TARGET_DPI (preprocess.py
+leaves them at that resolution instead of capping their size) are cut into
+overlapping tiles, which are read in parallel across the page process pool:
+
+1. Each tile is cropped with everything outside the layout boxes painted white,
+   so drawing linework is never OCR'd, and tiles without text are skipped.
+2. Every tile returns its words with page coordinates and confidences.
+3. Words read twice in an overlap zone are merged: complete words win over
+   words cut by a tile edge, then higher confidence wins.
+4. The surviving words are handed back to the layout box they fall in and
+   grouped into lines, in the layout engine_pool.image_regions_to_data returns.
+
+The overlap has to be larger than the tallest text line, so that every line is
+complete in at least one tile.
+"""
+
+import collections
+import math
+import os
+
+import numpy as np
+
+import engine_pool
+import metrics
+from preprocess import OCR_TILE_THRESHOLD_PIXELS
+
+OCR_TILE_SIZE = int(os.environ.get('OCR_TILE_SIZE', '4096'))
+OCR_TILE_OVERLAP = int(os.environ.get('OCR_TILE_OVERLAP', '256'))
+
+# Tiles cropped and queued on the pool at a time
+OCR_TILE_WINDOW = 2 * (os.cpu_count() or 1)
+
+# A word covered this much by a word from another tile is a duplicate
+DUPLICATE_OVERLAP = 0.5
+
+# Words that end this close to a tile edge shared with a neighbour were cut by it
+EDGE_MARGIN = 2
+
+
+def needs_tiling(shape):
+    height, width = shape[:2]
+    return height * width > OCR_TILE_THRESHOLD_PIXELS
+
+
+def tile_starts(length, size, overlap):
+    """Start offsets of overlapping tiles covering [0, length)"""
+    if length <= size:
+        return [0]
+    stride = size - overlap
+    count = math.ceil((length - overlap) / stride)
+    # Spread the tiles evenly so the last one ends exactly at the page edge
+    return [round(i * (length - size) / (count - 1)) for i in range(count)]
+
+
+def tile_grid(width, height, size=OCR_TILE_SIZE, overlap=OCR_TILE_OVERLAP):
+    """[x, y, w, h] boxes of overlapping tiles covering a page"""
+    size = max(size, 2 * overlap + 1)
+    return [[x, y, min(size, width - x), min(size, height - y)]
+            for y in tile_starts(height, size, overlap)
+            for x in tile_starts(width, size, overlap)]
+
+
+def _intersect(a, b):
+    x = max(a[0], b[0])
+    y = max(a[1], b[1])
+    right = min(a[0] + a[2], b[0] + b[2])
+    bottom = min(a[1] + a[3], b[1] + b[3])
+    if right <= x or bottom <= y:
+        return None
+    return [x, y, right - x, bottom - y]
+
+
+def masked_tile(image, tile, boxes):
+    """Crop a tile, keeping only the pixels inside the boxes; None when no box touches it"""
+    x, y, w, h = tile
+    crop = None
+    for box in boxes:
+        part = _intersect(tile, box)
+        if part is None:
+            continue
+        if crop is None:
+            crop = np.full((h, w), 255, np.uint8)
+        px, py, pw, ph = part
+        crop[py-y:py-y+ph, px-x:px-x+pw] = image[py:py+ph, px:px+pw]
+    return crop
+
+
+def ocr_tile(crop, tile, page_size, lang='eng', oem=3):
+    """OCR one tile; returns (words in page coordinates, deferred stats)
+
+    Runs in page pool workers, so the Tesseract calls are reported back to the
+    request as deferred stats.
+    """
+    x, y, w, h = tile
+    page_width, page_height = page_size
+    # Only edges shared with a neighbouring tile cut words; page edges do not
+    inner = (x > 0, y > 0, x + w < page_width, y + h < page_height)
+
+    with metrics.collect_stats(deferred=True) as stats:
+        data = engine_pool.image_to_data(crop, lang=lang, oem=oem, psm=engine_pool.MASKED_PSM)
+
+    words = []
+    for i, text in enumerate(data['text']):
+        text = text.strip()
+        if not text:
+            continue
+        left, top, width, height = data['left'][i], data['top'][i], data['width'][i], data['height'][i]
+        cut = ((inner[0] and left <= EDGE_MARGIN) or
+               (inner[1] and top <= EDGE_MARGIN) or
+               (inner[2] and left + width >= w - EDGE_MARGIN) or
+               (inner[3] and top + height >= h - EDGE_MARGIN))
+        words.append({
+            'text': text,
+            'left': left + x,
+            'top': top + y,
+            'width': width,
+            'height': height,
+            'conf': float(data['conf'][i]),
+            'tile': tuple(tile),
+            'cut': cut
+        })
+    return words, stats.as_dict()
+
+
+def merge_words(words, cell_size=OCR_TILE_OVERLAP):
+    """Drop words read twice in the overlap between tiles
+
+    Complete words are kept before words cut by a tile edge, and confident
+    words before doubtful ones. A word is dropped when a kept word from another
+    tile covers DUPLICATE_OVERLAP of it. Candidates are found through a grid of
+    cell_size cells, so only nearby words are compared.
+    """
+    cell_size = max(cell_size, 1)
+    grid = {}
+    kept = []
+    for word in sorted(words, key=lambda w: (w['cut'], -w['conf'])):
+        x0, y0 = word['left'] // cell_size, word['top'] // cell_size
+        x1 = (word['left'] + word['width']) // cell_size
+        y1 = (word['top'] + word['height']) // cell_size
+        cells = [(cx, cy) for cx in range(x0, x1 + 1) for cy in range(y0, y1 + 1)]
+
+        area = max(word['width'] * word['height'], 1)
+        box = [word['left'], word['top'], word['width'], word['height']]
+        duplicate = False
+        for cell in cells:
+            for other in grid.get(cell, ()):
+                if other['tile'] == word['tile']:
+                    continue
+                common = _intersect(box, [other['left'], other['top'], other['width'], other['height']])
+                if common is not None and common[2] * common[3] >= DUPLICATE_OVERLAP * area:
+                    duplicate = True
+                    break
+            if duplicate:
+                break
+        if duplicate:
+            continue
+
+        kept.append(word)
+        for cell in cells:
+            grid.setdefault(cell, []).append(word)
+    return kept
+
+
+def words_to_lines(words):
+    """Group words into text lines by their vertical centres, top to bottom and left to right"""
+    lines = []
+    for word in sorted(words, key=lambda w: w['top'] + w['height'] / 2):
+        centre = word['top'] + word['height'] / 2
+        if lines:
+            line = lines[-1]
+            if abs(centre - line['centre']) <= 0.5 * max(word['height'], line['height']):
+                line['words'].append(word)
+                count = len(line['words'])
+                line['centre'] += (centre - line['centre']) / count
+                line['height'] = max(line['height'], word['height'])
+                continue
+        lines.append({'centre': centre, 'height': word['height'], 'words': [word]})
+    return [sorted(line['words'], key=lambda w: w['left']) for line in lines]
+
+
+def read_words(image, boxes, lang='eng', oem=3, executor=None):
+    """OCR the boxes of a large page tile by tile and return the merged words
+
+    Tiles are read on executor when given (the page pool), serially otherwise.
+    Tiles are cropped as they are submitted, so only a bounded window of them
+    is held in memory next to the page.
+    """
+    height, width = image.shape[:2]
+    jobs = ((crop, tile, (width, height), lang, oem)
+            for tile in tile_grid(width, height)
+            for crop in [masked_tile(image, tile, boxes)] if crop is not None)
+
+    results = []
+    if executor is None:
+        results = [ocr_tile(*job) for job in jobs]
+    else:
+        in_flight = collections.deque()
+        for job in jobs:
+            in_flight.append(executor.submit(ocr_tile, *job))
+            if len(in_flight) >= OCR_TILE_WINDOW:
+                results.append(in_flight.popleft().result())
+        results.extend(future.result() for future in in_flight)
+
+    stats = metrics.current_stats()
+    words = []
+    for tile_words, tile_stats in results:
+        words.extend(tile_words)
+        if stats is not None:
+            stats.merge(tile_stats)
+    return merge_words(words)
+
+
+def image_regions_to_data(image, boxes, lang='eng', oem=3, executor=None):
+    """Tiled counterpart of engine_pool.image_regions_to_data: word boxes for each box"""
+    if not boxes:
+        return []
+
+    box_words = [[] for _ in boxes]
+    for word in read_words(image, boxes, lang=lang, oem=oem, executor=executor):
+        cx = word['left'] + word['width'] / 2
+        cy = word['top'] + word['height'] / 2
+        for index, (x, y, w, h) in enumerate(boxes):
+            if x <= cx < x + w and y <= cy < y + h:
+                box_words[index].append(word)
+                break
+
+    results = []
+    for words in box_words:
+        data = {column: [] for column in ('text', 'left', 'top', 'width', 'height', 'conf',
+                                          'block_num', 'par_num', 'line_num')}
+        for number, line in enumerate(words_to_lines(words), start=1):
+            for word in line:
+                for column in ('text', 'left', 'top', 'width', 'height', 'conf'):
+                    data[column].append(word[column])
+                data['block_num'].append(1)
+                data['par_num'].append(1)
+                data['line_num'].append(number)
+        results.append(data)
+    return results
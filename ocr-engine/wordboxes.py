@@ -0,0 +1,94 @@
+"""
+Compact word-level OCR output.
+
+Every page result carries the words Tesseract recognised as parallel columns
+instead of a list of dicts:
+
+    {'text': [...], 'left': [...], 'top': [...], 'width': [...], 'height': [...],
+     'conf': [...], 'block': [...], 'line': [...]}
+
+Boxes are in page pixel coordinates and confidences are Tesseract's word
+confidences rounded to integers (0-100). 'block' numbers the layout regions of
+the page in reading order and 'line' numbers the text lines of the page, so
+the page text, hOCR and ALTO can all be rebuilt from the columns. Page text and
+word boxes come from the same recognition pass, and the page and document
+confidences are computed from the words.
+"""
+
+WORD_COLUMNS = ('text', 'left', 'top', 'width', 'height', 'conf', 'block', 'line')
+
+
+def empty():
+    return {column: [] for column in WORD_COLUMNS}
+
+
+def from_data(data, dx=0, dy=0):
+    """Words of one region from pytesseract's Output.DICT layout, offset by (dx, dy)
+
+    Rows without text (page, block and line rows) and words Tesseract rejected
+    are dropped. Blocks and lines are numbered from 0 in the order they appear.
+    """
+    words = empty()
+    blocks = {}
+    lines = {}
+    for i, text in enumerate(data['text']):
+        text = text.strip()
+        conf = float(data['conf'][i])
+        if not text or conf < 0:
+            continue
+        line = (data['block_num'][i], data['par_num'][i], data['line_num'][i])
+        words['text'].append(text)
+        words['left'].append(int(data['left'][i]) + dx)
+        words['top'].append(int(data['top'][i]) + dy)
+        words['width'].append(int(data['width'][i]))
+        words['height'].append(int(data['height'][i]))
+        words['conf'].append(int(round(conf)))
+        words['block'].append(blocks.setdefault(data['block_num'][i], len(blocks)))
+        words['line'].append(lines.setdefault(line, len(lines)))
+    return words
+
+
+def to_data(words):
+    """The columns in pytesseract's Output.DICT layout, e.g. for fill_table_cells()"""
+    return {column: words[column] for column in ('text', 'left', 'top', 'width', 'height', 'conf')}
+
+
+def to_text(words):
+    """Text of the words, one line per text line and a blank line between blocks"""
+    parts = []
+    last_block = last_line = None
+    for text, block, line in zip(words['text'], words['block'], words['line']):
+        if line != last_line:
+            if parts:
+                parts.append('\n\n' if block != last_block else '\n')
+            last_block, last_line = block, line
+        elif parts:
+            parts.append(' ')
+        parts.append(text)
+    return ''.join(parts)
+
+
+def concat(regions):
+    """Join the words of a page's regions, one block per region, numbering lines page-wide"""
+    page = empty()
+    block = line_offset = 0
+    for words in regions:
+        if not words['text']:
+            continue
+        for column in WORD_COLUMNS[:-2]:
+            page[column].extend(words[column])
+        page['block'].extend(block for _ in words['text'])
+        page['line'].extend(line + line_offset for line in words['line'])
+        block += 1
+        line_offset += max(words['line']) + 1
+    return page
+
+
+def confidence(pages):
+    """Mean word confidence over the words of pages, weighted by word length; 0 without words"""
+    total = weight = 0
+    for words in pages:
+        for text, conf in zip(words['text'], words['conf']):
+            total += conf * len(text)
+            weight += len(text)
+    return total / weight if weight else 0